@@ -0,0 +1,180 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""GET /v1/items under many concurrent clients, Flask versus ASGI.
+
+Both applications are driven in process, without a network server: the
+Flask application by a fixed number of WSGI worker threads, the ASGI one by
+one asyncio task per client. A delay can be added to every SQL statement
+to stand in for the round trip to a database server.
+
+Usage: python benchmarks/bench_asgi_vs_flask.py [--clients 200]
+       [--requests 2000] [--wsgi-threads 8] [--latency-ms 5]
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from opp.common import utils
+
+
+def percentile(latencies, fraction):
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def setup(test_dir, latency, async_workers):
+    conf_filepath = os.path.join(test_dir, 'opp.cfg')
+    with open(conf_filepath, 'w') as conf_file:
+        conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s\n" %
+                        os.path.join(test_dir, 'bench.sqlite'))
+        if async_workers:
+            conf_file.write("async_db_workers = %d\n" % async_workers)
+    os.environ['OPP_TOP_CONFIG'] = conf_filepath
+    utils.execute("opp-db --config_file %s init" % conf_filepath)
+    utils.execute("opp-db --config_file %s add-user -uu -pp "
+                  "--phrase=123456" % conf_filepath)
+
+    if latency:
+        @event.listens_for(Engine, 'before_cursor_execute')
+        def delay(*args):
+            time.sleep(latency)
+
+
+async def call_asgi(app, method, path, headers, data=None):
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': b"",
+             'headers': [(name.lower().encode(), value.encode())
+                         for name, value in headers.items()]}
+    messages = [{'type': 'http.request', 'body': (data or "").encode()}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]['status'], json.loads(sent[1]['body'].decode())
+
+
+def flask_requester(hdrs, threads):
+    from opp.flask.json_server import app
+
+    # Requests beyond the worker threads wait in the executor queue, the
+    # same way they would wait for a free worker of a WSGI server
+    executor = ThreadPoolExecutor(max_workers=threads)
+
+    def get_items():
+        resp = app.test_client().get('/v1/items', headers=hdrs)
+        return resp.status_code, resp.data
+
+    async def request():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, get_items)
+    return request, executor.shutdown
+
+
+def asgi_requester(hdrs):
+    from opp.asgi.json_server import app
+    from opp.db import async_api
+
+    async def request():
+        return await call_asgi(app, 'GET', '/v1/items', hdrs)
+    return request, async_api.shutdown_executor
+
+
+async def drive(request, clients, requests):
+    """
+    Issue `requests` requests from `clients` closed loop clients.
+
+    :returns: tuple of elapsed seconds and the list of request latencies
+    """
+    remaining = [requests]
+    latencies = []
+
+    async def client():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.monotonic()
+            status, body = await request()
+            assert status == 200, body
+            latencies.append(time.monotonic() - start)
+
+    start = time.monotonic()
+    await asyncio.gather(*[client() for i in range(clients)])
+    return time.monotonic() - start, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=200,
+                        help="number of concurrent clients")
+    parser.add_argument('--requests', type=int, default=2000,
+                        help="total number of requests per application")
+    parser.add_argument('--wsgi-threads', type=int, default=8,
+                        help="number of WSGI worker threads")
+    parser.add_argument('--async-workers', type=int, default=0,
+                        help="size of the async database executor, "
+                             "defaults to the connection pool size")
+    parser.add_argument('--latency-ms', type=float, default=5,
+                        help="delay added to every SQL statement")
+    args = parser.parse_args()
+
+    test_dir = tempfile.mkdtemp(prefix='opp_bench_')
+    try:
+        setup(test_dir, args.latency_ms / 1000.0, args.async_workers)
+        # Both applications accept the tokens issued by either of them
+        from opp.flask.json_server import app
+        resp = app.test_client().post(
+            '/v1/auth', headers={'Content-Type': "application/json"},
+            data=json.dumps({'username': "u", 'password': "p"}))
+        hdrs = {'x-opp-phrase': "123456",
+                'x-opp-jwt': json.loads(resp.data.decode())['access_token']}
+        results = []
+        for name, (request, shutdown) in (
+                ('flask', flask_requester(hdrs, args.wsgi_threads)),
+                ('asgi', asgi_requester(hdrs))):
+            results.append((name, asyncio.run(drive(request, args.clients,
+                                                    args.requests))))
+            shutdown()
+        from opp.db import api
+        api.dispose_engines()
+    finally:
+        shutil.rmtree(test_dir)
+
+    print("clients: %d, requests: %d, wsgi threads: %d, "
+          "statement latency: %.1fms" % (
+              args.clients, args.requests, args.wsgi_threads,
+              args.latency_ms))
+    for name, (elapsed, latencies) in results:
+        print("%-6s req/s: %8.1f  p50: %7.1fms  p99: %7.1fms" %
+              (name, len(latencies) / elapsed,
+               percentile(latencies, 0.5) * 1000,
+               percentile(latencies, 0.99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
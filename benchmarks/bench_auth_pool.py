@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Latency of vault reads during a burst of logins, with the password checks
+run by every request thread as before, and by the bounded password pool.
+
+Each login runs in its own thread, like a request of a threaded server. A
+separate thread keeps decrypting a vault meanwhile and reports how long each
+read took.
+
+Usage: python benchmarks/bench_auth_pool.py [--burst 32] [--workers 2]
+       [--queue-size 8]
+"""
+
+import argparse
+import threading
+import time
+
+from opp.common import aescipher, utils
+
+
+def read_latencies(cipher, encrypted, stop):
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        cipher.decrypt_many(encrypted, binary=True)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run_burst(burst, check):
+    """
+    :returns: tuple of the number of rejected logins, the duration of the
+    burst and the vault read latencies measured meanwhile
+    """
+    cipher = aescipher.AESCipher("123456")
+    encrypted = cipher.encrypt_many(["item %d" % i for i in range(2000)],
+                                    binary=True)
+    hashed = utils.hashpw("p")
+    rejected = []
+    stop = threading.Event()
+    latencies = []
+    reader = threading.Thread(target=lambda: latencies.extend(
+        read_latencies(cipher, encrypted, stop)))
+
+    def login():
+        try:
+            check("p", hashed)
+        except utils.PoolSaturated:
+            rejected.append(1)
+
+    logins = [threading.Thread(target=login) for i in range(burst)]
+    reader.start()
+    start = time.perf_counter()
+    for thread in logins:
+        thread.start()
+    for thread in logins:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    reader.join()
+    return len(rejected), elapsed, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--burst', type=int, default=32,
+                        help="number of simultaneous logins")
+    parser.add_argument('--workers', type=int, default=2,
+                        help="password pool workers")
+    parser.add_argument('--queue-size', type=int, default=8,
+                        help="password pool queue depth")
+    args = parser.parse_args()
+
+    pool = utils.PasswordPool(args.workers, args.queue_size)
+    try:
+        results = [('inline', run_burst(args.burst, utils.checkpw)),
+                   ('pool', run_burst(args.burst, pool.checkpw))]
+    finally:
+        pool.shutdown()
+
+    print("burst: %d logins, pool: %d workers, queue of %d" % (
+        args.burst, args.workers, args.queue_size))
+    for name, (rejected, elapsed, latencies) in results:
+        print("%-6s rejected: %3d  burst: %.2fs  vault reads: %4d  "
+              "median: %7.1fms  max: %7.1fms" % (
+                  name, rejected, elapsed, len(latencies),
+                  latencies[len(latencies) // 2] * 1000,
+                  latencies[-1] * 1000))
+    print("pool stats: %s" % pool.stats())
+
+
+if __name__ == '__main__':
+    main()
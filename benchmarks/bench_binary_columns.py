@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare the size and read throughput of items stored as base64 text, as
+done before the ciphertext columns became binary, and as raw bytes.
+
+Usage: python benchmarks/bench_binary_columns.py [--count 10000]
+"""
+
+import argparse
+import base64
+import os
+import shutil
+import tempfile
+import time
+
+from opp.common import aescipher, opp_config
+from opp.db import api, models
+
+
+def make_session(test_dir, name):
+    db_filepath = os.path.join(test_dir, '%s.sqlite' % name)
+    conf_filepath = os.path.join(test_dir, '%s.cfg' % name)
+    with open(conf_filepath, 'w') as conf_file:
+        conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" % db_filepath)
+    conf = opp_config.OppConfig(conf_filepath)
+    models.Base.metadata.create_all(api.get_engine(conf))
+    session = api.get_scoped_session(conf)
+    with session.begin():
+        api.user_create(session, models.User(username="u", password="p",
+                                             phrase_check="OK"))
+    return session, api.user_get_by_username(session, "u"), db_filepath
+
+
+def make_rows(cipher, count):
+    items = [{field: "%s value %d" % (field, i)
+              for field in models.Item.SECRET_FIELDS} for i in range(count)]
+    rows = models.Item.encrypt_many(items, cipher)
+    for row in rows:
+        row['category_id'] = None
+    return rows
+
+
+def store(session, user, rows, binary):
+    with session.begin():
+        if binary:
+            api.item_create_bulk(session, user, rows)
+            return
+        # Plain SQL bypasses the Ciphertext type to write the legacy text
+        session.execute(
+            "INSERT INTO items (user_id, sort_id, record, details, "
+            "created_at, updated_at) VALUES (:user_id, 0, :record, "
+            ":details, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)",
+            [{'user_id': user.id,
+              'record': base64.b64encode(row['record']).decode(),
+              'details': base64.b64encode(row['details']).decode()}
+             for row in rows])
+
+
+def measure(session, user, cipher, db_filepath, repeat):
+    """
+    :returns: tuple of the total size of the records in bytes, the database
+    file size and the fastest time to read and decrypt all items
+    """
+    size = session.execute(
+        "SELECT SUM(length(CAST(record AS BLOB)) + "
+        "length(CAST(details AS BLOB))) FROM items").scalar()
+    # Move the pages out of the write-ahead log before reading the file size
+    session.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        items = api.item_getall(session, user, with_category=False)
+        models.Item.extract_many(items, cipher, with_category=False)
+        elapsed = time.perf_counter() - start
+        best = min(best or elapsed, elapsed)
+        session.expunge_all()
+    session.remove()
+    return size, os.path.getsize(db_filepath), best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=10000,
+                        help="number of items in the vault")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of reads, the fastest one is reported")
+    args = parser.parse_args()
+
+    cipher = aescipher.AESCipher("123456")
+    rows = make_rows(cipher, args.count)
+    results = {}
+    test_dir = tempfile.mkdtemp(prefix='opp_bench_')
+    try:
+        for name, binary in (('text', False), ('binary', True)):
+            session, user, db_filepath = make_session(test_dir, name)
+            store(session, user, rows, binary)
+            results[name] = measure(session, user, cipher, db_filepath,
+                                    args.repeat)
+        api.dispose_engines()
+    finally:
+        shutil.rmtree(test_dir)
+
+    print("items: %d" % args.count)
+    for name in ('text', 'binary'):
+        size, file_size, elapsed = results[name]
+        print("%-6s records: %8d bytes  file: %8d bytes  read: %.3fs "
+              "(%.0f items/s)" % (name, size, file_size, elapsed,
+                                  args.count / elapsed))
+    print("record size: %.0f%%, read speedup: %.2fx" % (
+        100.0 * results['binary'][0] / results['text'][0],
+        results['text'][2] / results['binary'][2]))
+
+
+if __name__ == '__main__':
+    main()
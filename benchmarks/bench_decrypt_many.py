@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare per field and batch decryption of the items of a vault, as done
+by GET /v1/items and GET /v1/fetchall.
+
+Usage: python benchmarks/bench_decrypt_many.py [--count 10000]
+"""
+
+import argparse
+import time
+
+from opp.common import aescipher
+from opp.db import models
+
+
+def make_items(cipher, count, binary):
+    items = []
+    for i in range(count):
+        item = models.Item(id=i, sort_id=i, category_id=None)
+        values = ["%s value %d" % (field, i)
+                  for field in models.Item.SECRET_FIELDS]
+        if binary:
+            values = cipher.encrypt_many(values, binary=True)
+        else:
+            values = [cipher.encrypt(value) for value in values]
+        for field, value in zip(models.Item.SECRET_FIELDS, values):
+            setattr(item, field, value)
+        items.append(item)
+    return items
+
+
+def bench_per_field(cipher, items):
+    start = time.perf_counter()
+    extracted = []
+    for item in items:
+        entry = {'id': item.id}
+        for field in models.Item.SECRET_FIELDS:
+            entry[field] = cipher.decrypt(getattr(item, field))
+        entry['sort_id'] = item.sort_id
+        entry['category_id'] = item.category_id
+        extracted.append(entry)
+    return time.perf_counter() - start, extracted
+
+
+def bench_batch(cipher, items):
+    start = time.perf_counter()
+    extracted = models.Item.extract_many(items, cipher, with_category=False)
+    return time.perf_counter() - start, extracted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=10000,
+                        help="number of items in the vault")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of runs, the fastest one is reported")
+    args = parser.parse_args()
+
+    cipher = aescipher.AESCipher("123456")
+    # Base64 text values as stored before the columns became binary
+    text_items = make_items(cipher, args.count, binary=False)
+    items = make_items(cipher, args.count, binary=True)
+    per_field = batch = None
+    for i in range(args.repeat):
+        elapsed, expected = bench_per_field(cipher, text_items)
+        per_field = min(per_field or elapsed, elapsed)
+        elapsed, extracted = bench_batch(cipher, items)
+        batch = min(batch or elapsed, elapsed)
+        assert extracted == expected
+
+    print("items: %d, fields: %d" % (args.count,
+                                     args.count * len(items[0].SECRET_FIELDS)))
+    print("decrypt per field: %.3fs" % per_field)
+    print("decrypt_many:      %.3fs" % batch)
+    print("speedup:           %.1fx" % (per_field / batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare reading all fields of the items of a vault with reading only the
+fields of a list view, as done by GET /v1/items?fields=name,url.
+
+Usage: python benchmarks/bench_item_fields.py [--count 10000]
+       [--blob-size 4096]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from opp.common import aescipher, opp_config
+from opp.db import api, models
+
+
+def make_session(test_dir):
+    db_filepath = os.path.join(test_dir, 'bench.sqlite')
+    conf_filepath = os.path.join(test_dir, 'bench.cfg')
+    with open(conf_filepath, 'w') as conf_file:
+        conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" % db_filepath)
+    conf = opp_config.OppConfig(conf_filepath)
+    models.Base.metadata.create_all(api.get_engine(conf))
+    session = api.get_scoped_session(conf)
+    with session.begin():
+        api.user_create(session, models.User(username="u", password="p",
+                                             phrase_check="OK"))
+    return session, api.user_get_by_username(session, "u")
+
+
+def make_rows(cipher, count, blob_size):
+    items = []
+    for i in range(count):
+        item = {field: "%s value %d" % (field, i)
+                for field in models.Item.SECRET_FIELDS}
+        item['blob'] = "b" * blob_size
+        items.append(item)
+    rows = models.Item.encrypt_many(items, cipher)
+    for row in rows:
+        row['category_id'] = None
+    return rows
+
+
+def bench_read(session, cipher, fields, repeat):
+    best = None
+    for i in range(repeat):
+        # Start from an empty identity map
+        session.remove()
+        user = api.user_get_by_username(session, "u")
+        start = time.perf_counter()
+        with session.begin():
+            items = api.item_getall(session, user, fields=fields)
+            models.Item.extract_many(items, cipher, fields=fields)
+        elapsed = time.perf_counter() - start
+        best = min(best or elapsed, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=10000,
+                        help="number of items in the vault")
+    parser.add_argument('--blob-size', type=int, default=4096,
+                        help="size of the blob field of every item")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of reads, the fastest one is reported")
+    args = parser.parse_args()
+
+    cipher = aescipher.AESCipher("123456")
+    test_dir = tempfile.mkdtemp(prefix='opp_bench_')
+    try:
+        session, user = make_session(test_dir)
+        with session.begin():
+            api.item_create_bulk(session, user, make_rows(
+                cipher, args.count, args.blob_size))
+        full = bench_read(session, cipher, None, args.repeat)
+        listed = bench_read(session, cipher, ['name', 'url'], args.repeat)
+        session.remove()
+        api.dispose_engines()
+    finally:
+        shutil.rmtree(test_dir)
+
+    print("items: %d, blob size: %d" % (args.count, args.blob_size))
+    print("all fields:      %.3fs" % full)
+    print("fields=name,url: %.3fs" % listed)
+    print("speedup:         %.1fx" % (full / listed))
+
+
+if __name__ == '__main__':
+    main()
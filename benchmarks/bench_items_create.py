@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare ORM and bulk item inserts used by PUT /v1/items.
+
+Usage: python benchmarks/bench_items_create.py [--count 10000]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from opp.common import aescipher, opp_config
+from opp.db import api, models
+
+
+def make_session(test_dir, name):
+    db_filepath = os.path.join(test_dir, '%s.sqlite' % name)
+    conf_filepath = os.path.join(test_dir, '%s.cfg' % name)
+    with open(conf_filepath, 'w') as conf_file:
+        conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" % db_filepath)
+    conf = opp_config.OppConfig(conf_filepath)
+    models.Base.metadata.create_all(api.get_engine(conf))
+    session = api.get_scoped_session(conf)
+    with session.begin():
+        api.user_create(session, models.User(username="u", password="p",
+                                             phrase_check="OK"))
+    return session, api.user_get_by_username(session, "u")
+
+
+def make_rows(count):
+    cipher = aescipher.AESCipher("123456")
+    row = models.Item.encrypt_many(
+        [{field: "%s value" % field for field in models.Item.SECRET_FIELDS}],
+        cipher)[0]
+    row['category_id'] = None
+    return [dict(row) for i in range(count)]
+
+
+def bench_orm(session, user, rows):
+    # The per-row ORM path PUT /v1/items used before item_create_bulk
+    start = time.perf_counter()
+    with session.begin():
+        items = [models.Item(user=user, **row) for row in rows]
+        items = api.item_create(session, items)
+        ids = [item.id for item in items]
+    assert len(ids) == len(rows)
+    return time.perf_counter() - start
+
+
+def bench_bulk(session, user, rows):
+    start = time.perf_counter()
+    with session.begin():
+        ids = api.item_create_bulk(session, user, rows)
+    assert len(ids) == len(rows)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=10000,
+                        help="number of items to insert")
+    args = parser.parse_args()
+
+    test_dir = tempfile.mkdtemp(prefix='opp_bench_')
+    try:
+        rows = make_rows(args.count)
+        orm = bench_orm(*make_session(test_dir, 'orm'), rows)
+        bulk = bench_bulk(*make_session(test_dir, 'bulk'), rows)
+        api.dispose_engines()
+    finally:
+        shutil.rmtree(test_dir)
+
+    print("items: %d" % args.count)
+    print("orm add_all + flush: %.3fs" % orm)
+    print("bulk executemany:    %.3fs" % bulk)
+    print("speedup:             %.1fx" % (orm / bulk))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Cost of the passphrase key derivation functions, and of checking the
+passphrase of every request of a session with and without the cache of
+derived keys.
+
+The verified cipher cache is bypassed, as it is after every update of the
+user or in a server process the session did not reach yet, so that each
+request checks the passphrase against the phrase check.
+
+Usage: python benchmarks/bench_kdf.py [--sessions 10] [--requests 20]
+"""
+
+import argparse
+import time
+import types
+
+from opp.common import aescipher, cache
+
+
+def bench_derive(kdf, repeat):
+    salt = aescipher.new_phrase_kdf({'phrase_kdf': kdf})[1]
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        aescipher.derive_key("secret passphrase", kdf, salt)
+        elapsed = time.perf_counter() - start
+        best = min(best or elapsed, elapsed)
+    return best
+
+
+def bench_sessions(kdf, sessions, requests, cache_size):
+    aescipher._KEYS = cache.TTLCache(cache_size, 3600)
+    users = []
+    for i in range(sessions):
+        salt = aescipher.new_phrase_kdf({'phrase_kdf': kdf})[1]
+        phrase = "passphrase %d" % i
+        cipher = aescipher.AESCipher.from_key(
+            aescipher.derive_key(phrase, kdf, salt))
+        users.append((types.SimpleNamespace(
+            id=i, kdf=kdf, kdf_salt=salt,
+            phrase_check=cipher.encrypt("OK")), phrase))
+
+    start = time.perf_counter()
+    for user, phrase in users:
+        for j in range(requests):
+            assert aescipher.check_phrase(user, phrase) is not None
+    return (time.perf_counter() - start) / (sessions * requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sessions', type=int, default=10,
+                        help="number of users, each with its own passphrase")
+    parser.add_argument('--requests', type=int, default=20,
+                        help="number of requests per session")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of derivations, the fastest is reported")
+    args = parser.parse_args()
+
+    print("sessions: %d, requests per session: %d" % (args.sessions,
+                                                      args.requests))
+    for kdf in sorted(aescipher.KDFS):
+        derive = bench_derive(kdf, args.repeat)
+        uncached = bench_sessions(kdf, args.sessions, args.requests, 0)
+        cached = bench_sessions(kdf, args.sessions, args.requests, 256)
+        print("%-9s derive: %8.3fms  per request uncached: %8.3fms  "
+              "cached: %6.3fms" % (kdf, derive * 1000, uncached * 1000,
+                                   cached * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Concurrent SQLite reads and writes, with and without the SQLite profile.
+
+The legacy setup uses the rollback journal, no busy timeout and a shared
+pool for readers and writers. The profile uses WAL, a busy timeout and a
+single serialized writer with retries next to a pool of readers.
+
+Usage: python benchmarks/bench_sqlite_concurrency.py [--readers 8]
+       [--writers 4] [--seconds 5]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from sqlalchemy import exc
+
+from opp.common import aescipher, opp_config
+from opp.db import api, models
+
+LEGACY = ("sqlite_single_writer = false\n"
+          "sqlite_journal_mode = DELETE\n"
+          "sqlite_synchronous = FULL\n"
+          "sqlite_busy_timeout = 0\n")
+
+
+def make_config(test_dir, name, options):
+    db_filepath = os.path.join(test_dir, '%s.sqlite' % name)
+    conf_filepath = os.path.join(test_dir, '%s.cfg' % name)
+    with open(conf_filepath, 'w') as conf_file:
+        conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s\n%s" %
+                        (db_filepath, options))
+    conf = opp_config.OppConfig(conf_filepath)
+    models.Base.metadata.create_all(api.get_engine(conf))
+    session = api.get_scoped_session(conf)
+    with session.begin():
+        api.user_create(session, models.User(username="u", password="p",
+                                             phrase_check="OK"))
+    session.remove()
+    return conf
+
+
+def make_rows(count):
+    cipher = aescipher.AESCipher("123456")
+    row = models.Item.encrypt_many(
+        [{field: "%s value" % field for field in models.Item.SECRET_FIELDS}],
+        cipher)[0]
+    row['category_id'] = None
+    return [dict(row) for i in range(count)]
+
+
+def reader(conf, deadline, counts):
+    session = api.get_scoped_session(conf, readonly=True)
+    user = api.user_get_by_username(session, "u")
+    while time.monotonic() < deadline:
+        try:
+            with session.begin():
+                api.category_getall(session, user)
+                api.item_getall(session, user, limit=100,
+                                with_category=False)
+            counts['reads'] += 1
+        except exc.OperationalError:
+            counts['read_errors'] += 1
+    session.remove()
+
+
+def writer(conf, deadline, counts, legacy):
+    session = api.get_scoped_session(conf)
+    user = api.user_get_by_username(session, "u")
+    rows = make_rows(10)
+    while time.monotonic() < deadline:
+        try:
+            if legacy:
+                with session.begin():
+                    api.item_create_bulk(session, user, rows)
+            else:
+                api.run_write(session, lambda: api.item_create_bulk(
+                    session, user, rows))
+            counts['writes'] += 1
+        except (exc.OperationalError, RuntimeError):
+            counts['write_errors'] += 1
+    session.remove()
+
+
+def run(conf, readers, writers, seconds, legacy):
+    counts = {'reads': 0, 'read_errors': 0, 'writes': 0, 'write_errors': 0}
+    deadline = time.monotonic() + seconds
+    threads = ([threading.Thread(target=reader,
+                                 args=(conf, deadline, counts))
+                for i in range(readers)] +
+               [threading.Thread(target=writer,
+                                 args=(conf, deadline, counts, legacy))
+                for i in range(writers)])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--readers', type=int, default=8,
+                        help="number of reader threads")
+    parser.add_argument('--writers', type=int, default=4,
+                        help="number of writer threads")
+    parser.add_argument('--seconds', type=float, default=5,
+                        help="duration of each run")
+    args = parser.parse_args()
+
+    test_dir = tempfile.mkdtemp(prefix='opp_bench_')
+    try:
+        results = []
+        for name, options in (('legacy', LEGACY), ('profile', "")):
+            conf = make_config(test_dir, name, options)
+            counts = run(conf, args.readers, args.writers, args.seconds,
+                         name == 'legacy')
+            results.append((name, counts))
+        api.dispose_engines()
+    finally:
+        shutil.rmtree(test_dir)
+
+    print("readers: %d, writers: %d, %.1fs per run" %
+          (args.readers, args.writers, args.seconds))
+    for name, counts in results:
+        print("%-8s reads/s: %8.1f  writes/s: %7.1f  "
+              "read errors: %d  write errors: %d" %
+              (name, counts['reads'] / args.seconds,
+               counts['writes'] / args.seconds,
+               counts['read_errors'], counts['write_errors']))
+
+
+if __name__ == '__main__':
+    main()
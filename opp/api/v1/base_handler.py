@@ -13,10 +13,86 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
+import binascii
 from collections import OrderedDict
+from datetime import datetime
+import functools
 import json
 
+from sqlalchemy import exc
+
 from opp.common import aescipher
+from opp.db import api, models
+
+
+# Largest page a client may request with the `limit` query parameter
+MAX_PAGE_SIZE = 1000
+
+
+# Header carrying the token of a user's last write, which the client sends
+# back so that its reads skip a lagging replica
+WRITE_TOKEN_HEADER = 'x-opp-write'
+
+
+# Format of the time stamp carried by sync tokens
+SYNC_TOKEN_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+def _encode_token(text):
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip("=")
+
+
+def _decode_token(token):
+    padded = token + "=" * (-len(token) % 4)
+    return base64.urlsafe_b64decode(padded.encode()).decode()
+
+
+def encode_cursor(sort_id, row_id):
+    """
+    Build the opaque pagination cursor pointing past a row.
+
+    :param sort_id: sort id of the last row of a page
+    :param row_id: id of the last row of a page
+
+    :returns: URL safe cursor string
+    """
+    return _encode_token("%d:%d" % (sort_id or 0, row_id))
+
+
+def decode_cursor(cursor):
+    """
+    Parse a pagination cursor built by `encode_cursor`.
+
+    :returns: (sort_id, id) tuple
+    """
+    try:
+        sort_id, row_id = _decode_token(cursor).split(":")
+        return int(sort_id), int(row_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise OppError("Invalid pagination cursor!")
+
+
+def encode_sync_token(timestamp):
+    """
+    Build the opaque token a client passes to fetch the changes made
+    after `timestamp`.
+
+    :returns: URL safe token string
+    """
+    return _encode_token(timestamp.strftime(SYNC_TOKEN_FORMAT))
+
+
+def decode_sync_token(token):
+    """
+    Parse a sync token built by `encode_sync_token`.
+
+    :returns: datetime of the previous sync
+    """
+    try:
+        return datetime.strptime(_decode_token(token), SYNC_TOKEN_FORMAT)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise OppError("Invalid sync token!")
 
 
 class BaseResponseHandler(object):
@@ -32,6 +108,10 @@ class BaseResponseHandler(object):
         self.user = user
         # SQLAlchemy scoped session
         self.session = session
+        # Cipher of the verified passphrase, set by `respond`
+        self.cipher = None
+        # Headers to send along with the response
+        self.headers = {}
 
     def _check_payload(self, check_dict=None):
         """
@@ -77,6 +157,71 @@ class BaseResponseHandler(object):
 
         return payload_objects
 
+    def _get_page(self):
+        """
+        Parse the keyset pagination parameters from the query string:
+        `limit` is the page size and `after` the cursor returned along with
+        the previous page.
+
+        :returns: tuple of page size, None if paging was not requested, and
+        the (sort_id, id) position to continue after, None for the first page
+        """
+        args = getattr(self.request, 'args', None) or {}
+        limit = args.get('limit')
+        after = args.get('after')
+        if limit is None:
+            if after is not None:
+                raise OppError("Pagination cursor requires a limit!")
+            return None, None
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise OppError("Invalid pagination limit!",
+                           "Limit must be a number in the range between "
+                           "1 and %d." % MAX_PAGE_SIZE)
+        if after is not None:
+            after = decode_cursor(after)
+        return limit, after
+
+    def _next_page(self, rows, limit):
+        """
+        Split off the extra row fetched to find out whether another page
+        follows.
+
+        :param rows: up to `limit` + 1 rows ordered by (sort_id, id)
+        :param limit: page size, None if paging was not requested
+
+        :returns: tuple of the rows of the page and the cursor of the next
+        page, None on the last page
+        """
+        if not limit or len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1].sort_id, rows[-1].id)
+
+    def _get_fields(self):
+        """
+        Parse the `fields` query parameter, the comma separated names of
+        the item fields to return.
+
+        :returns: list of field names, None to return all fields
+        """
+        args = getattr(self.request, 'args', None) or {}
+        fields = args.get('fields')
+        if fields is None:
+            return None
+        fields = [field.strip() for field in fields.split(",")
+                  if field.strip()]
+        if not fields:
+            raise OppError("Invalid fields parameter!",
+                           "At least one item field is required.")
+        try:
+            return list(models.Item.get_fields(fields))
+        except ValueError as e:
+            raise OppError("Invalid fields parameter!", str(e))
+
     def _do_get(self, phrase):
         """This is the HTTP GET handler implemented in the derived class."""
         raise OppError("Action not implemented")
@@ -105,29 +250,52 @@ class BaseResponseHandler(object):
             except KeyError:
                 raise OppError("Passphrase header missing!")
 
-            cipher = aescipher.AESCipher(phrase)
-            try:
-                if cipher.decrypt(self.user.phrase_check) != "OK":
-                    raise OppError("Incorrect passphrase supplied!")
-            except UnicodeDecodeError:
+            self.cipher = aescipher.get_verified_cipher(self.user, phrase)
+            if self.cipher is None:
                 raise OppError("Incorrect passphrase supplied!")
         else:
             phrase = None
 
-        with self.session.begin():
-            if self.request.method == "GET":
-                response = self._do_get(phrase)
-            elif self.request.method == "PUT":
-                response = self._do_put(phrase)
-            elif self.request.method == "POST":
-                response = self._do_post(phrase)
-            elif self.request.method == "DELETE":
-                response = self._do_delete()
-            else:
-                raise OppError("Method not supported!")
+        if self.request.method == "GET":
+            return self._read(phrase)
+        elif self.request.method == "PUT":
+            work = functools.partial(self._do_put, phrase)
+        elif self.request.method == "POST":
+            work = functools.partial(self._do_post, phrase)
+        elif self.request.method == "DELETE":
+            work = self._do_delete
+        else:
+            raise OppError("Method not supported!")
 
+        try:
+            response = api.run_write(self.session, work)
+        except exc.OperationalError as e:
+            if not api.is_locked_error(e):
+                raise
+            raise OppError("Database is busy, please retry!", None, 503,
+                           {'Retry-After': "1"})
+        write_token = api.record_write(self.session, self.user)
+        if write_token:
+            self.headers[WRITE_TOKEN_HEADER] = write_token
         return response
 
+    def _read(self, phrase):
+        """
+        Run the GET handler in a read transaction, on the read replica if
+        one is configured and the write token sent back by the client does
+        not show a write of the user just before.
+        """
+        primary = self.session
+        write_token = self.request.headers.get(WRITE_TOKEN_HEADER)
+        self.session = api.get_read_session(primary, self.user, write_token)
+        try:
+            with self.session.begin():
+                return self._do_get(phrase)
+        finally:
+            if self.session is not primary:
+                self.session.remove()
+                self.session = primary
+
 
 class OppError(Exception):
     """Generic error class for propagating HTTP error codes and messages."""
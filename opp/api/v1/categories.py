@@ -15,7 +15,6 @@
 
 from opp.api.v1 import base_handler as bh
 from opp.db import api, models
-from opp.common import aescipher
 
 
 class ResponseHandler(bh.BaseResponseHandler):
@@ -31,25 +30,23 @@ class ResponseHandler(bh.BaseResponseHandler):
 
         :returns: success result along with decrypted categories array
         """
-        response = []
-        cipher = aescipher.AESCipher(phrase)
+        cipher = self.cipher
         try:
-            categories = api.category_getall(self.session, self.user)
-            for category in categories:
-                response.append(category.extract(cipher))
+            categories = api.category_getall(self.session, self.user,
+                                             with_items=False)
+            response = models.Category.extract_many(categories, cipher)
         except UnicodeDecodeError:
             raise bh.OppError("Unable to decrypt data!")
         except Exception:
             raise bh.OppError("Unable to fetch categories from the database!")
         return {'result': "success", 'categories': response}
 
-    def _do_put(self, phrase):
+    def _names_from_payload(self):
         """
-        Create a list of categories, given an array of names.
-
-        :param phrase: decryption passphrase
+        Parse and encrypt the names of a create request.
 
-        :returns: success result along with array of newly created categories
+        :returns: tuple of the list of names and the list of their encrypted
+        columns
         """
         payload_dicts = [{'name': "category_names",
                           'is_list': True,
@@ -57,35 +54,50 @@ class ResponseHandler(bh.BaseResponseHandler):
         payload_objects = self._check_payload(payload_dicts)
         cat_list = payload_objects[0]
 
-        cipher = aescipher.AESCipher(phrase)
-        categories = []
         for cat in cat_list:
             # Check for empty category name
             if not cat:
                 raise bh.OppError("Empty category name in list!")
-            try:
-                blob = cipher.encrypt(cat)
-                categories.append(models.Category(name=blob, user=self.user))
-            except (TypeError, AttributeError):
-                raise bh.OppError("Invalid category name in list!")
-
         try:
-            categories = api.category_create(self.session, categories)
-        except Exception:
-            raise bh.OppError("Unable to add new categories to the database!")
+            rows = models.Category.encrypt_many(cat_list, self.cipher)
+        except (TypeError, AttributeError):
+            raise bh.OppError("Invalid category name in list!")
+        return cat_list, rows
+
+    def _created(self, cat_list, ids):
+        """
+        :param cat_list: names of the categories which were just created
+        :param ids: ids of the created categories
 
+        :returns: success result along with array of newly created categories
+        """
         response = []
-        for category in categories:
-            response.append(category.extract(cipher))
+        for cat_id, cat in zip(ids, cat_list):
+            response.append({'id': cat_id, 'name': cat, 'sort_id': 0})
         return {'result': "success", 'categories': response}
 
-    def _do_post(self, phrase):
+    def _do_put(self, phrase):
         """
-        Update a list of category names, identified by id.
+        Create a list of categories, given an array of names.
 
         :param phrase: decryption passphrase
 
-        :returns: success result
+        :returns: success result along with array of newly created categories
+        """
+        cat_list, rows = self._names_from_payload()
+
+        try:
+            ids = api.category_create_bulk(self.session, self.user, rows)
+        except Exception:
+            raise bh.OppError("Unable to add new categories to the database!")
+        return self._created(cat_list, ids)
+
+    def _updates_from_payload(self):
+        """
+        Parse and encrypt the categories of an update request.
+
+        :returns: list of the encrypted columns of the categories, along with
+        their ids
         """
         payload_dicts = [{'name': "categories",
                           'is_list': True,
@@ -93,8 +105,8 @@ class ResponseHandler(bh.BaseResponseHandler):
         payload_objects = self._check_payload(payload_dicts)
         cat_list = payload_objects[0]
 
-        cipher = aescipher.AESCipher(phrase)
-        categories = []
+        rows = []
+        names = []
         for cat in cat_list:
             # Make sure category id is parsed from request
             try:
@@ -112,27 +124,50 @@ class ResponseHandler(bh.BaseResponseHandler):
             if not category:
                 raise bh.OppError("Empty category name in list!")
 
-            try:
-                blob = cipher.encrypt(category)
-                categories.append(models.Category(id=cat_id, name=blob,
-                                                  user=self.user))
-            except (TypeError, AttributeError):
-                raise bh.OppError("Invalid category name in list!")
+            rows.append({'id': cat_id})
+            names.append(category)
 
         try:
-            api.category_update(self.session, categories)
-            return {'result': "success"}
-        except Exception:
-            raise bh.OppError("Unable to update categories in the database!")
+            names = models.Category.encrypt_many(names, self.cipher)
+        except (TypeError, AttributeError):
+            raise bh.OppError("Invalid category name in list!")
+        for row, name in zip(rows, names):
+            row.update(name)
+        return rows
+
+    def _updated(self, missing):
+        """
+        :param missing: ids of the categories which do not exist
 
-    def _do_delete(self):
+        :returns: success result
         """
-        Delete a list of categories, identified by id, with optional `cascade`.
-        specifier to proprage deletion of items belonging to the deleted
-        categories.
+        if missing:
+            raise bh.OppError("Invalid category id in list!",
+                              "Unknown category ids: %s" %
+                              ", ".join(str(cat_id) for cat_id in missing))
+        return {'result': "success"}
+
+    def _do_post(self, phrase):
+        """
+        Update a list of category names, identified by id.
+
+        :param phrase: decryption passphrase
 
         :returns: success result
         """
+        rows = self._updates_from_payload()
+
+        try:
+            missing = api.category_update_bulk(self.session, self.user, rows)
+        except Exception:
+            raise bh.OppError("Unable to update categories in the database!")
+        return self._updated(missing)
+
+    def _deletes_from_payload(self):
+        """
+        :returns: tuple of the ids of the categories to delete and whether
+        to delete their items as well, from the request payload
+        """
         payload_dicts = [{'name': "ids",
                           'is_list': True,
                           'required': True},
@@ -147,10 +182,37 @@ class ResponseHandler(bh.BaseResponseHandler):
             raise bh.OppError("Empty category id list!")
         if cascade is not True and cascade is not False:
             raise bh.OppError("Invalid cascade value!")
+        return categories, cascade
+
+    def _deleted(self, deleted, items, cascade):
+        """
+        :param deleted: number of deleted categories
+        :param items: number of deleted or updated items
+        :param cascade: whether the items were deleted
+
+        :returns: success result along with the number of deleted categories
+        and deleted or updated items
+        """
+        if cascade:
+            return {'result': "success", 'deleted': deleted,
+                    'items_deleted': items}
+        return {'result': "success", 'deleted': deleted,
+                'items_updated': items}
+
+    def _do_delete(self):
+        """
+        Delete a list of categories, identified by id, with optional `cascade`.
+        specifier to proprage deletion of items belonging to the deleted
+        categories.
+
+        :returns: success result along with the number of deleted categories
+        and deleted or updated items
+        """
+        categories, cascade = self._deletes_from_payload()
 
         try:
-            api.category_delete_by_id(self.session, self.user,
-                                      categories, cascade)
-            return {'result': "success"}
+            deleted, items = api.category_delete_by_id(self.session, self.user,
+                                                       categories, cascade)
         except Exception:
             raise bh.OppError("Unable to delete categories from the database!")
+        return self._deleted(deleted, items, cascade)
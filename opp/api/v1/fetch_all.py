@@ -13,9 +13,19 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from datetime import datetime, timedelta
+
 from opp.api.v1 import base_handler as bh
-from opp.common import aescipher
-from opp.db import api
+from opp.common import opp_config
+from opp.db import api, models
+
+
+CONFIG = opp_config.OppConfig()
+
+# Changes are time stamped before their transaction commits, so a change
+# stamped just before a sync token was issued may only become visible after
+# it. Every sync looks back this far past its token to pick those up.
+SYNC_OVERLAP = timedelta(seconds=5)
 
 
 class ResponseHandler(bh.BaseResponseHandler):
@@ -23,30 +33,141 @@ class ResponseHandler(bh.BaseResponseHandler):
     Response handler for the `fetchall` endpoint.
     """
 
-    def _do_get(self, phrase):
+    def _get_since(self):
+        """
+        Parse the `since` sync token from the query string.
+
+        :returns: time of the previous sync, None if not specified
+        """
+        args = getattr(self.request, 'args', None) or {}
+        token = args.get('since')
+        if token is None:
+            return None
+        return bh.decode_sync_token(token)
+
+    def _split_deleted(self, tombstones):
+        """
+        :param tombstones: list of (kind, record id) tuples, see
+        `api.tombstone_getall`
+
+        :returns: dictionary of the ids of the deleted categories and items
+        """
+        deleted = {'categories': [], 'items': []}
+        for kind, record_id in tombstones:
+            if kind == models.Tombstone.CATEGORY:
+                deleted['categories'].append(record_id)
+            else:
+                deleted['items'].append(record_id)
+        return deleted
+
+    def _fetch(self, phrase, limit, after, fields=None):
         """
-        Fetch all categories and items data for a particular user.
+        Fetch all categories and items data for a particular user. Items
+        may be fetched one page at a time, in which case the categories and
+        the sync token are only returned along with the first page.
 
         :param phrase: decryption passphrase
+        :param limit: page size, None to fetch all items
+        :param after: position to continue after, None for the first page
+        :param fields: names of the item fields to return, None for all
 
-        :returns: success result along with categories and items arrays
+        :returns: success result along with categories and items arrays and,
+        if more items follow, the cursor of the next page
         """
+        now = datetime.now()
         cat_array = []
         item_array = []
-        cipher = aescipher.AESCipher(phrase)
+        cipher = self.cipher
         try:
-            categories = api.category_getall(self.session, self.user)
-            for category in categories:
-                cat_array.append(category.extract(cipher, with_items=False))
+            if after is None:
+                categories = api.category_getall(self.session, self.user,
+                                                 with_items=False)
+                cat_array = models.Category.extract_many(categories, cipher)
 
-            items = api.item_getall(self.session, self.user)
-            for item in items:
-                item_array.append(item.extract(cipher, with_category=False))
+            items = api.item_getall(self.session, self.user,
+                                    limit=limit and limit + 1, after=after,
+                                    with_category=False, fields=fields)
+            items, cursor = self._next_page(items, limit)
+            item_array = models.Item.extract_many(items, cipher,
+                                                  with_category=False,
+                                                  fields=fields)
+        except UnicodeDecodeError:
+            raise bh.OppError("Unable to decrypt data!")
+        except Exception:
+            raise bh.OppError("Unable to fetch from the database!")
+
+        response = {'result': 'success',
+                    'categories': cat_array,
+                    'items': item_array}
+        if after is None:
+            response['sync_token'] = bh.encode_sync_token(now)
+        if cursor:
+            response['next'] = cursor
+        return response
+
+    def _sync(self, phrase, since, fields=None):
+        """
+        Fetch the categories and items created, updated or deleted since
+        the previous sync. Falls back to fetching everything when the
+        deletion records covering the previous sync may have been pruned.
+
+        :param phrase: decryption passphrase
+        :param since: time of the previous sync
+        :param fields: names of the item fields to return, None for all
+
+        :returns: success result along with the changed categories and items
+        arrays, the ids of the deleted ones and a new sync token
+        """
+        now = datetime.now()
+        days = CONFIG.getint('sync_tombstone_days', 30)
+        if since < now - timedelta(days=days):
+            response = self._fetch(phrase, None, None, fields)
+            response['full'] = True
+            return response
+
+        since -= SYNC_OVERLAP
+        cat_array = []
+        item_array = []
+        cipher = self.cipher
+        try:
+            categories = api.category_getall(self.session, self.user,
+                                             with_items=False, since=since)
+            cat_array = models.Category.extract_many(categories, cipher)
+
+            items = api.item_getall(self.session, self.user, since=since,
+                                    with_category=False, fields=fields)
+            item_array = models.Item.extract_many(items, cipher,
+                                                  with_category=False,
+                                                  fields=fields)
+
+            deleted = self._split_deleted(
+                api.tombstone_getall(self.session, self.user, since))
         except UnicodeDecodeError:
             raise bh.OppError("Unable to decrypt data!")
         except Exception:
             raise bh.OppError("Unable to fetch from the database!")
 
         return {'result': 'success',
+                'full': False,
                 'categories': cat_array,
-                'items': item_array}
+                'items': item_array,
+                'deleted': deleted,
+                'sync_token': bh.encode_sync_token(now)}
+
+    def _do_get(self, phrase):
+        """
+        Fetch all of the user's data, or only the changes since a previous
+        sync if a `since` sync token is specified.
+
+        :param phrase: decryption passphrase
+
+        :returns: success result along with categories and items arrays
+        """
+        limit, after = self._get_page()
+        since = self._get_since()
+        fields = self._get_fields()
+        if since is None:
+            return self._fetch(phrase, limit, after, fields)
+        if limit is not None:
+            raise bh.OppError("Sync token cannot be combined with pagination!")
+        return self._sync(phrase, since, fields)
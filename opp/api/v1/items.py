@@ -18,7 +18,7 @@ import re
 from xkcdpass import xkcd_password as xp
 
 from opp.api.v1 import base_handler as bh
-from opp.common import aescipher, opp_config
+from opp.common import opp_config
 from opp.db import api, models
 
 
@@ -146,70 +146,176 @@ class ResponseHandler(bh.BaseResponseHandler):
         valid_chars = re.search('[a-z]', s) and re.search('[A-Z]', s) and re.search('[!@#$%^&*()-+=\\_]', s)
         return valid_chars and len(s) >= numChars
 
-    def make_item(self, row, cipher, password, item_id=None):
+    def _parse_item(self, row, password):
         """
-        Extract various item data from the request and encrypt it
+        Extract various item data from the request
 
         :param row: item object parsed from JSON request
-        :param cipher: encryption cipher
         :param password: if specified, ignore the `password` field in
         in the item object and instead use this auto-generated password.
-        :param item_id: should be specified for item update operations,
-        None otherwise.
 
-        :returns Item ORM model for insertion into the database
+        :returns: dictionary of plain text item fields and category id
+        """
+        return {'name': self._parse_or_set_empty(row, 'name'),
+                'url': self._parse_or_set_empty(row, 'url'),
+                'account': self._parse_or_set_empty(row, 'account'),
+                'username': self._parse_or_set_empty(row, 'username'),
+                'password': (password or
+                             self._parse_or_set_empty(row, 'password')),
+                'blob': self._parse_or_set_empty(row, 'blob'),
+                'category_id': self._parse_or_set_empty(row, 'category_id',
+                                                        True)}
+
+    def _encrypt_items(self, items, cipher):
         """
-        # Extract various item data into a list
-        name = self._parse_or_set_empty(row, 'name')
-        url = self._parse_or_set_empty(row, 'url')
-        account = self._parse_or_set_empty(row, 'account')
-        username = self._parse_or_set_empty(row, 'username')
-        password = password or self._parse_or_set_empty(row, 'password')
-        blob = self._parse_or_set_empty(row, 'blob')
-        category_id = self._parse_or_set_empty(row, 'category_id', True)
+        Encrypt the fields of items parsed by `_parse_item`, all at once
+
+        :param items: list of dictionaries of plain text item fields
+        :param cipher: encryption cipher
 
+        :returns: list of dictionaries of item column values
+        """
         try:
-            return models.Item(id=item_id,
-                               name=cipher.encrypt(name),
-                               url=cipher.encrypt(url),
-                               account=cipher.encrypt(account),
-                               username=cipher.encrypt(username),
-                               password=cipher.encrypt(password),
-                               blob=cipher.encrypt(blob),
-                               category_id=category_id,
-                               user=self.user)
+            rows = models.Item.encrypt_many(items, cipher)
         except (AttributeError, TypeError):
             raise bh.OppError("Invalid item data in list!")
+        for row, item in zip(rows, items):
+            row['category_id'] = item['category_id']
+        return rows
+
+    def _category_ids(self, items):
+        """
+        :param items: list of parsed items
+
+        :returns: list of the distinct category ids referenced by the items
+        """
+        return list(set(item['category_id'] for item in items
+                        if item['category_id'] is not None))
+
+    def _categories_by_id(self, ids, categories):
+        """
+        Make sure all categories referenced by the items belong to the user
+
+        :param ids: category ids referenced by the items
+        :param categories: the user's categories fetched by these ids
+
+        :returns: dictionary of referenced categories keyed by id
+        """
+        categories = {category.id: category for category in categories}
+        if len(categories) != len(ids):
+            raise bh.OppError("Invalid category id in list!")
+        return categories
+
+    def _check_categories(self, items):
+        """
+        Make sure all categories referenced by the items belong to the user
+
+        :param items: list of parsed items
+
+        :returns: dictionary of referenced categories keyed by id
+        """
+        ids = self._category_ids(items)
+        if not ids:
+            return {}
+        try:
+            categories = api.category_getall(self.session, self.user,
+                                             ids, with_items=False)
+        except Exception:
+            raise bh.OppError("Unable to fetch categories from the database!")
+        return self._categories_by_id(ids, categories)
+
+    def _extract_items(self, items, categories, cipher):
+        """
+        Build the response for items which were just written, from the
+        plain text request data instead of decrypting the rows back.
+
+        :param items: list of parsed items with their ids
+        :param categories: categories referenced by the items, keyed by id
+        :param cipher: decryption cipher for the category names
+
+        :returns: list of items in the same form as `Item.extract`
+        """
+        response = []
+        for item in items:
+            extracted = {'id': item['id']}
+            for field in models.Item.SECRET_FIELDS:
+                extracted[field] = item[field]
+            if 'sort_id' in item:
+                extracted['sort_id'] = item['sort_id']
+            if item['category_id'] is None:
+                extracted['category'] = {'id': None}
+            else:
+                category = categories[item['category_id']]
+                extracted['category'] = category.extract(cipher)
+            response.append(extracted)
+        return response
+
+    def _get_item(self, item_id, fields):
+        """
+        Fetch a single item of the user, e.g. to show the fields left out of
+        a list view.
+
+        :param item_id: id of the item
+        :param fields: names of the fields to return, None for all
+
+        :returns: success result along with the decrypted item
+        """
+        try:
+            items = api.item_getall(self.session, self.user,
+                                    filter_ids=[item_id], fields=fields)
+            response = models.Item.extract_many(items, self.cipher,
+                                                fields=fields)
+        except UnicodeDecodeError:
+            raise bh.OppError("Unable to decrypt data!")
+        except Exception:
+            raise bh.OppError("Unable to fetch items from the database!")
+        if not response:
+            raise bh.OppError("Item not found!", None, 404)
+        return {'result': 'success', 'item': response[0]}
 
     def _do_get(self, phrase):
         """
-        Fetch all user's items.
+        Fetch user's items, optionally one page at a time, or a single item
+        if the request path ends with its id. Only the encrypted columns
+        needed for the requested `fields` are loaded and decrypted.
 
         :param phrase: decryption passphrase
 
-        :returns: success result along with decrypted items array
+        :returns: success result along with decrypted items array and, if
+        more items follow, the cursor of the next page
         """
-        response = []
-        cipher = aescipher.AESCipher(phrase)
+        fields = self._get_fields()
+        view_args = getattr(self.request, 'view_args', None) or {}
+        if view_args.get('item_id') is not None:
+            return self._get_item(view_args['item_id'], fields)
+
+        limit, after = self._get_page()
+        cipher = self.cipher
         try:
-            items = api.item_getall(self.session, self.user)
-            for item in items:
-                response.append(item.extract(cipher))
+            items = api.item_getall(self.session, self.user,
+                                    limit=limit and limit + 1, after=after,
+                                    fields=fields)
+            items, cursor = self._next_page(items, limit)
+            response = models.Item.extract_many(items, cipher, fields=fields)
         except UnicodeDecodeError:
             raise bh.OppError("Unable to decrypt data!")
         except Exception:
             raise bh.OppError("Unable to fetch items from the database!")
-        return {'result': 'success', 'items': response}
+        response = {'result': 'success', 'items': response}
+        if cursor:
+            response['next'] = cursor
+        return response
 
-    def _do_put(self, phrase):
+    def _items_from_payload(self, with_ids):
         """
-        Create a list of items, given an array of item parameters, with
+        Parse and encrypt the items of a create or update request, with
         option to specify auto-generation of common or unique passwords
         for each item.
 
-        :param phrase: decryption passphrase
+        :param with_ids: require the id of every item, for updates
 
-        :returns: success result along with array of newly created items
+        :returns: tuple of the list of parsed items and the list of their
+        encrypted columns
         """
         payload_dicts = [{'name': "items",
                           'is_list': True,
@@ -230,13 +336,21 @@ class ResponseHandler(bh.BaseResponseHandler):
             # Retrieve words dictionary
             words = self._get_words(genopts)
 
-            # Generate common password for all items
+            # Generate common password for all items if needed
             if unique is not True:
                 common_password = self._gen_pwd(words, genopts)
 
-        cipher = aescipher.AESCipher(phrase)
         items = []
         for row in item_list:
+            if with_ids:
+                # Make sure item id is parsed from request
+                try:
+                    item_id = row['id']
+                except KeyError:
+                    raise bh.OppError("Missing item id in list!")
+                if not item_id:
+                    raise bh.OppError("Empty item id in list!")
+
             if auto_pass is True:
                 if unique is True:
                     password = self._gen_pwd(words, genopts)
@@ -245,16 +359,63 @@ class ResponseHandler(bh.BaseResponseHandler):
             else:
                 password = None
 
-            items.append(self.make_item(row, cipher, password))
+            item = self._parse_item(row, password)
+            if with_ids:
+                item['id'] = item_id
+            items.append(item)
+
+        rows = self._encrypt_items(items, self.cipher)
+        if with_ids:
+            for columns, item in zip(rows, items):
+                columns['id'] = item['id']
+        return items, rows
+
+    def _created(self, items, ids, categories):
+        """
+        :param items: list of parsed items which were just created
+        :param ids: ids of the created items
+        :param categories: categories referenced by the items, keyed by id
+
+        :returns: success result along with array of newly created items
+        """
+        for item_id, item in zip(ids, items):
+            item['id'] = item_id
+            item['sort_id'] = 0
+        return {'result': 'success',
+                'items': self._extract_items(items, categories, self.cipher)}
+
+    def _updated(self, items, missing, categories):
+        """
+        :param items: list of parsed items which were just updated
+        :param missing: ids of the items which do not exist
+        :param categories: categories referenced by the items, keyed by id
+
+        :returns: success result along with array of updated items
+        """
+        if missing:
+            raise bh.OppError("Invalid item id in list!",
+                              "Unknown item ids: %s" %
+                              ", ".join(str(item_id) for item_id in missing))
+        return {'result': 'success',
+                'items': self._extract_items(items, categories, self.cipher)}
+
+    def _do_put(self, phrase):
+        """
+        Create a list of items, given an array of item parameters, see
+        `_items_from_payload`.
+
+        :param phrase: decryption passphrase
+
+        :returns: success result along with array of newly created items
+        """
+        items, rows = self._items_from_payload(False)
+        categories = self._check_categories(items)
 
         try:
-            items = api.item_create(self.session, items)
-            response = []
-            for item in items:
-                response.append(item.extract(cipher))
-            return {'result': 'success', 'items': response}
+            ids = api.item_create_bulk(self.session, self.user, rows)
         except Exception:
             raise bh.OppError("Unable to add new items to the database!")
+        return self._created(items, ids, categories)
 
     def _do_post(self, phrase):
         """
@@ -265,73 +426,35 @@ class ResponseHandler(bh.BaseResponseHandler):
 
         :returns: success result
         """
-        payload_dicts = [{'name': "items",
-                          'is_list': True,
-                          'required': True},
-                         {'name': "auto_pass",
-                          'is_list': False,
-                          'required': False},
-                         {'name': "unique",
-                          'is_list': False,
-                          'required': False},
-                         {'name': "genopts",
-                          'is_list': False,
-                          'required': False}]
-        item_list, auto_pass, unique, genopts = self._check_payload(
-            payload_dicts)
-
-        if auto_pass is True:
-            # Retrieve words dictionary
-            words = self._get_words(genopts)
-
-            # Generate common password for all items if needed
-            if unique is not True:
-                common_password = self._gen_pwd(words, genopts)
-
-        cipher = aescipher.AESCipher(phrase)
-        items = []
-        for row in item_list:
-            # Make sure item id is parsed from request
-            try:
-                item_id = row['id']
-            except KeyError:
-                raise bh.OppError("Missing item id in list!")
-            if not item_id:
-                raise bh.OppError("Empty item id in list!")
-
-            if auto_pass is True:
-                if unique is True:
-                    password = self._gen_pwd(words, genopts)
-                else:
-                    password = common_password
-            else:
-                password = None
-
-            items.append(self.make_item(row, cipher, password, item_id))
+        items, rows = self._items_from_payload(True)
+        categories = self._check_categories(items)
 
         try:
-            api.item_update(self.session, items)
-            response = []
-            for item in items:
-                response.append(item.extract(cipher))
-            return {'result': 'success', 'items': response}
+            missing = api.item_update_bulk(self.session, self.user, rows)
         except Exception:
             raise bh.OppError("Unable to update items in the database!")
+        return self._updated(items, missing, categories)
 
-    def _do_delete(self):
+    def _delete_ids(self):
         """
-        Delete a list of items, identified by id.
-
-        :returns: success result
+        :returns: ids of the items to delete, from the request payload
         """
         payload_dicts = [{'name': "ids",
                           'is_list': True,
                           'required': True}]
         payload_objects = self._check_payload(payload_dicts)
-        id_list = payload_objects[0]
+        return payload_objects[0]
+
+    def _do_delete(self):
+        """
+        Delete a list of items, identified by id.
+
+        :returns: success result along with the number of deleted items
+        """
+        id_list = self._delete_ids()
 
         try:
-            api.item_delete_by_id(self.session, self.user, id_list)
-            return {'result': "success"}
+            deleted = api.item_delete_by_id(self.session, self.user, id_list)
+            return {'result': "success", 'deleted': deleted}
         except Exception:
             raise bh.OppError("Unable to delete items from the database!")
@@ -0,0 +1,50 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from opp.api.v1 import base_handler as bh
+from opp.common import aescipher, opp_config, utils
+from opp.db import api
+
+
+class ResponseHandler(bh.BaseResponseHandler):
+    """
+    Response handler for the `metrics` endpoint.
+    """
+
+    def respond(self, require_phrase=False):
+        """
+        Report the statistics of the connection pools, caches and worker
+        pools of the process. They are kept in memory, so the database is
+        not queried, and pools or caches not created yet are left out
+        rather than created by the request.
+
+        :param require_phrase: not used
+
+        :returns: dictionary of statistics keyed by pool or cache name
+        """
+        if not opp_config.OppConfig().getboolean('metrics_enabled', False):
+            raise bh.OppError("Not Found", None, 404)
+        if self.request.method != "GET":
+            raise bh.OppError("Method not supported!")
+        response = {'db_pools': api.get_pool_stats()}
+        for name, stats in [
+                ('identity_cache', api.get_identity_cache_stats()),
+                ('cipher_cache', aescipher.get_cipher_cache_stats()),
+                ('kdf_cache', aescipher.get_key_cache_stats()),
+                ('decrypt_pool', aescipher.get_decrypt_pool_stats()),
+                ('password_pool', utils.get_password_pool_stats())]:
+            if stats is not None:
+                response[name] = stats
+        return response
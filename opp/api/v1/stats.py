@@ -0,0 +1,51 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from opp.api.v1 import base_handler as bh
+from opp.db import api
+
+
+class ResponseHandler(bh.BaseResponseHandler):
+    """
+    Response handler for the `stats` endpoint.
+    """
+
+    def _do_get(self, phrase):
+        """
+        Count the user's categories and items. Only aggregates are read, so
+        no passphrase is needed and nothing is decrypted.
+
+        :param phrase: not used
+
+        :returns: success result along with the item count of every
+        category, the number of items without a category, the totals and
+        the time of the last change
+        """
+        try:
+            category_counts, orphans, last_modified = api.user_stats(
+                self.session, self.user)
+        except Exception:
+            raise bh.OppError("Unable to fetch from the database!")
+
+        categories = [{'id': category_id, 'items': count}
+                      for category_id, count in category_counts]
+        return {'result': 'success',
+                'categories': categories,
+                'orphans': orphans,
+                'total_categories': len(categories),
+                'total_items': orphans + sum(category['items']
+                                             for category in categories),
+                'last_modified': (last_modified.isoformat()
+                                  if last_modified else None)}
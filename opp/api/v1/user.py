@@ -63,13 +63,16 @@ class ResponseHandler(bh.BaseResponseHandler):
             raise bh.OppError("Passphrase must be at least 6 characters long!")
 
         try:
-            cipher = aescipher.AESCipher(phrase)
-            ok = cipher.encrypt("OK")
             user = api.user_get_by_username(self.session, u)
             if user:
                 raise bh.OppError("User already exists!")
+            kdf, salt = aescipher.new_phrase_kdf()
+            cipher = aescipher.get_phrase_cipher(phrase, kdf, salt)
+            ok = cipher.encrypt("OK")
             hashed = utils.hashpw(p)
-            user = models.User(username=u, password=hashed, phrase_check=ok)
+            user = models.User(username=u, password=hashed, phrase_check=ok,
+                               kdf=kdf, kdf_salt=salt,
+                               data_key=aescipher.new_data_key(cipher))
             api.user_create(self.session, user)
             user = api.user_get_by_username(self.session, u)
             if user:
@@ -163,8 +166,7 @@ class ResponseHandler(bh.BaseResponseHandler):
             if not utils.checkpw(p, user.password):
                 raise bh.OppError("Incorrect password supplied!")
 
-            api.category_delete_all(self.session, user, True)
-            api.item_delete_all(self.session, user)
+            # Categories and items are removed by the database
             api.user_delete(self.session, user)
 
             user = api.user_get_by_username(self.session, u)
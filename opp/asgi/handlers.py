@@ -0,0 +1,424 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Response handlers of the ASGI application.
+
+They parse requests and build responses like the handlers of `opp.api.v1`,
+which they extend, but await the `opp.db.async_api` functions instead of
+using a session of their own. A database worker thread is thus only taken
+while a statement runs, rather than for the whole request, and the
+encryption and decryption work goes to the default executor of the loop.
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+import functools
+
+from sqlalchemy import exc
+
+from opp.api.v1 import base_handler as bh
+from opp.api.v1 import categories, fetch_all, items
+from opp.common import aescipher
+from opp.db import api, async_api, models
+
+
+class AsyncResponseHandler(bh.BaseResponseHandler):
+    """
+    Base class of the response handlers whose `respond` is a coroutine.
+    """
+
+    def __init__(self, request, user, conf=None):
+        super(AsyncResponseHandler, self).__init__(request, user, None)
+        # OppConfig instance
+        self.conf = conf
+        # Token of the user's last write sent back by the client, set by
+        # `respond` for GET requests
+        self.write_token = None
+
+    async def _offload(self, function, *args, **kwargs):
+        """Run CPU bound work in the default executor of the loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(function, *args, **kwargs))
+
+    def _read_options(self):
+        """
+        :returns: keyword arguments of the `async_api` readers serving the
+        GET requests, from the replica if the user did not just write
+        """
+        return {'replica': True, 'write_token': self.write_token,
+                'conf': self.conf}
+
+    async def _db_read(self, reads, message):
+        """
+        :param reads: awaitable of `async_api` reads
+        :param message: error message if the reads fail
+
+        :returns: result of the reads
+        """
+        try:
+            return await reads
+        except Exception:
+            raise bh.OppError(message)
+
+    async def _db_write(self, write, message):
+        """
+        :param write: awaitable of an `async_api` write
+        :param message: error message if the write fails
+
+        :returns: result of the write
+        """
+        try:
+            return await write
+        except exc.OperationalError as e:
+            if api.is_locked_error(e):
+                raise bh.OppError("Database is busy, please retry!", None,
+                                  503, {'Retry-After': "1"})
+            raise bh.OppError(message)
+        except Exception:
+            raise bh.OppError(message)
+
+    async def _decrypt(self, model, rows, message, **kwargs):
+        """
+        Decrypt rows with the `extract_many` method of their model.
+
+        :param message: error message if the rows cannot be extracted
+
+        :returns: list of dictionaries
+        """
+        try:
+            return await self._offload(model.extract_many, rows, self.cipher,
+                                       **kwargs)
+        except UnicodeDecodeError:
+            raise bh.OppError("Unable to decrypt data!")
+        except Exception:
+            raise bh.OppError(message)
+
+    async def respond(self, require_phrase=True):
+        """
+        Coroutine generating the response of a request, see
+        `BaseResponseHandler.respond`.
+        """
+        # Validate passphrase if required
+        if require_phrase:
+            try:
+                phrase = self.request.headers['x-opp-phrase']
+            except KeyError:
+                raise bh.OppError("Passphrase header missing!")
+
+            self.cipher = await self._offload(aescipher.get_verified_cipher,
+                                              self.user, phrase)
+            if self.cipher is None:
+                raise bh.OppError("Incorrect passphrase supplied!")
+        else:
+            phrase = None
+
+        if self.request.method == "GET":
+            self.write_token = self.request.headers.get(
+                bh.WRITE_TOKEN_HEADER)
+            return await self._do_get(phrase)
+        elif self.request.method == "PUT":
+            response = await self._do_put(phrase)
+        elif self.request.method == "POST":
+            response = await self._do_post(phrase)
+        elif self.request.method == "DELETE":
+            response = await self._do_delete()
+        else:
+            raise bh.OppError("Method not supported!")
+
+        session = api.get_scoped_session(self.conf)
+        try:
+            write_token = api.record_write(session, self.user)
+        finally:
+            session.remove()
+        if write_token:
+            self.headers[bh.WRITE_TOKEN_HEADER] = write_token
+        return response
+
+
+class ItemsHandler(AsyncResponseHandler, items.ResponseHandler):
+    """
+    Response handler for the `items` endpoint.
+    """
+
+    async def _check_categories(self, items):
+        """
+        Make sure all categories referenced by the items belong to the user
+
+        :param items: list of parsed items
+
+        :returns: dictionary of referenced categories keyed by id
+        """
+        ids = self._category_ids(items)
+        if not ids:
+            return {}
+        categories = await self._db_read(
+            async_api.category_getall(self.user, ids, conf=self.conf),
+            "Unable to fetch categories from the database!")
+        return self._categories_by_id(ids, categories)
+
+    async def _get_item(self, item_id, fields):
+        """
+        Fetch a single item of the user.
+
+        :param item_id: id of the item
+        :param fields: names of the fields to return, None for all
+
+        :returns: success result along with the decrypted item
+        """
+        message = "Unable to fetch items from the database!"
+        items = await self._db_read(
+            async_api.item_getall(self.user, filter_ids=[item_id],
+                                  fields=fields, **self._read_options()),
+            message)
+        response = await self._decrypt(models.Item, items, message,
+                                       fields=fields)
+        if not response:
+            raise bh.OppError("Item not found!", None, 404)
+        return {'result': 'success', 'item': response[0]}
+
+    async def _do_get(self, phrase):
+        """
+        Fetch user's items, see `items.ResponseHandler._do_get`.
+
+        :param phrase: decryption passphrase
+
+        :returns: success result along with decrypted items array and, if
+        more items follow, the cursor of the next page
+        """
+        fields = self._get_fields()
+        view_args = getattr(self.request, 'view_args', None) or {}
+        if view_args.get('item_id') is not None:
+            return await self._get_item(view_args['item_id'], fields)
+
+        limit, after = self._get_page()
+        message = "Unable to fetch items from the database!"
+        items = await self._db_read(
+            async_api.item_getall(self.user, limit=limit and limit + 1,
+                                  after=after, fields=fields,
+                                  **self._read_options()),
+            message)
+        items, cursor = self._next_page(items, limit)
+        response = {'result': 'success',
+                    'items': await self._decrypt(models.Item, items, message,
+                                                 fields=fields)}
+        if cursor:
+            response['next'] = cursor
+        return response
+
+    async def _do_put(self, phrase):
+        """
+        Create a list of items, see `items.ResponseHandler._do_put`.
+
+        :param phrase: decryption passphrase
+
+        :returns: success result along with array of newly created items
+        """
+        # Password generation and encryption are CPU bound
+        items, rows = await self._offload(self._items_from_payload, False)
+        categories = await self._check_categories(items)
+        ids = await self._db_write(
+            async_api.item_create_bulk(self.user, rows, conf=self.conf),
+            "Unable to add new items to the database!")
+        return self._created(items, ids, categories)
+
+    async def _do_post(self, phrase):
+        """
+        Update a list of items, see `items.ResponseHandler._do_post`.
+
+        :param phrase: decryption passphrase
+
+        :returns: success result
+        """
+        items, rows = await self._offload(self._items_from_payload, True)
+        categories = await self._check_categories(items)
+        missing = await self._db_write(
+            async_api.item_update_bulk(self.user, rows, conf=self.conf),
+            "Unable to update items in the database!")
+        return self._updated(items, missing, categories)
+
+    async def _do_delete(self):
+        """
+        Delete a list of items, identified by id.
+
+        :returns: success result along with the number of deleted items
+        """
+        id_list = self._delete_ids()
+        deleted = await self._db_write(
+            async_api.item_delete_by_id(self.user, id_list, conf=self.conf),
+            "Unable to delete items from the database!")
+        return {'result': "success", 'deleted': deleted}
+
+
+class CategoriesHandler(AsyncResponseHandler, categories.ResponseHandler):
+    """
+    Response handler for the `categories` endpoint.
+    """
+
+    async def _do_get(self, phrase):
+        """
+        Fetch all user's categories.
+
+        :param phrase: decryption passphrase
+
+        :returns: success result along with decrypted categories array
+        """
+        message = "Unable to fetch categories from the database!"
+        categories = await self._db_read(
+            async_api.category_getall(self.user, with_items=False,
+                                      **self._read_options()),
+            message)
+        response = await self._decrypt(models.Category, categories, message)
+        return {'result': "success", 'categories': response}
+
+    async def _do_put(self, phrase):
+        """
+        Create a list of categories, given an array of names.
+
+        :param phrase: decryption passphrase
+
+        :returns: success result along with array of newly created categories
+        """
+        cat_list, rows = await self._offload(self._names_from_payload)
+        ids = await self._db_write(
+            async_api.category_create_bulk(self.user, rows, conf=self.conf),
+            "Unable to add new categories to the database!")
+        return self._created(cat_list, ids)
+
+    async def _do_post(self, phrase):
+        """
+        Update a list of category names, identified by id.
+
+        :param phrase: decryption passphrase
+
+        :returns: success result
+        """
+        rows = await self._offload(self._updates_from_payload)
+        missing = await self._db_write(
+            async_api.category_update_bulk(self.user, rows, conf=self.conf),
+            "Unable to update categories in the database!")
+        return self._updated(missing)
+
+    async def _do_delete(self):
+        """
+        Delete a list of categories, identified by id, with optional
+        `cascade` specifier to propagate deletion of items belonging to the
+        deleted categories.
+
+        :returns: success result along with the number of deleted categories
+        and deleted or updated items
+        """
+        categories, cascade = self._deletes_from_payload()
+        deleted, items = await self._db_write(
+            async_api.category_delete_by_id(self.user, categories, cascade,
+                                            conf=self.conf),
+            "Unable to delete categories from the database!")
+        return self._deleted(deleted, items, cascade)
+
+
+class FetchAllHandler(AsyncResponseHandler, fetch_all.ResponseHandler):
+    """
+    Response handler for the `fetchall` endpoint. The reads of a request
+    run concurrently.
+    """
+
+    async def _fetch(self, phrase, limit, after, fields=None):
+        """
+        Fetch all categories and items data for a particular user, see
+        `fetch_all.ResponseHandler._fetch`.
+
+        :returns: success result along with categories and items arrays and,
+        if more items follow, the cursor of the next page
+        """
+        now = datetime.now()
+        message = "Unable to fetch from the database!"
+        reads = [async_api.item_getall(self.user, limit=limit and limit + 1,
+                                       after=after, with_category=False,
+                                       fields=fields, **self._read_options())]
+        if after is None:
+            reads.append(async_api.category_getall(
+                self.user, with_items=False, **self._read_options()))
+        results = await self._db_read(asyncio.gather(*reads), message)
+
+        items, cursor = self._next_page(results[0], limit)
+        cat_array = []
+        if after is None:
+            cat_array = await self._decrypt(models.Category, results[1],
+                                            message)
+        item_array = await self._decrypt(models.Item, items, message,
+                                         with_category=False, fields=fields)
+
+        response = {'result': 'success',
+                    'categories': cat_array,
+                    'items': item_array}
+        if after is None:
+            response['sync_token'] = bh.encode_sync_token(now)
+        if cursor:
+            response['next'] = cursor
+        return response
+
+    async def _sync(self, phrase, since, fields=None):
+        """
+        Fetch the changes since the previous sync, see
+        `fetch_all.ResponseHandler._sync`.
+
+        :returns: success result along with the changed categories and items
+        arrays, the ids of the deleted ones and a new sync token
+        """
+        now = datetime.now()
+        days = fetch_all.CONFIG.getint('sync_tombstone_days', 30)
+        if since < now - timedelta(days=days):
+            response = await self._fetch(phrase, None, None, fields)
+            response['full'] = True
+            return response
+
+        since -= fetch_all.SYNC_OVERLAP
+        message = "Unable to fetch from the database!"
+        options = self._read_options()
+        categories, items, tombstones = await self._db_read(asyncio.gather(
+            async_api.category_getall(self.user, with_items=False,
+                                      since=since, **options),
+            async_api.item_getall(self.user, since=since, with_category=False,
+                                  fields=fields, **options),
+            async_api.tombstone_getall(self.user, since, **options)),
+            message)
+
+        return {'result': 'success',
+                'full': False,
+                'categories': await self._decrypt(models.Category, categories,
+                                                  message),
+                'items': await self._decrypt(models.Item, items, message,
+                                             with_category=False,
+                                             fields=fields),
+                'deleted': self._split_deleted(tombstones),
+                'sync_token': bh.encode_sync_token(now)}
+
+    async def _do_get(self, phrase):
+        """
+        Fetch all of the user's data, or only the changes since a previous
+        sync if a `since` sync token is specified.
+
+        :param phrase: decryption passphrase
+
+        :returns: success result along with categories and items arrays
+        """
+        limit, after = self._get_page()
+        since = self._get_since()
+        fields = self._get_fields()
+        if since is None:
+            return await self._fetch(phrase, limit, after, fields)
+        if limit is not None:
+            raise bh.OppError("Sync token cannot be combined with pagination!")
+        return await self._sync(phrase, since, fields)
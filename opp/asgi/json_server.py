@@ -0,0 +1,343 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""ASGI variant of `opp.flask.json_server`.
+
+It serves the same /v1 routes through the same response handlers, and the
+JWTs it issues are interchangeable with the ones of the Flask application.
+The event loop only parses requests, checks tokens and writes responses.
+The items, categories and fetchall endpoints are served by the handlers of
+`opp.asgi.handlers`, which await each database call of `opp.db.async_api`;
+the remaining response handlers run as a whole in the executor of
+`opp.db.async_api`. Run it with any ASGI server, e.g.:
+
+    uvicorn opp.asgi.json_server:app
+"""
+
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import json
+import re
+from urllib.parse import parse_qsl
+
+import jwt
+
+from opp.api.v1 import base_handler, metrics, stats
+from opp.api.v1 import user as user_crud
+from opp.asgi import handlers
+from opp.common import aescipher, opp_config, utils
+from opp.db import api, async_api
+from opp.flask.flask_jwt import CONFIG_DEFAULTS, JWTError
+
+
+CONF = opp_config.OppConfig()
+LOG = utils.getLogger(__name__, CONF)
+
+if CONF['secret_key'] == "default-insecure":
+    LOG.warning("Config option 'secret_key' not specified."
+                " Using default insecure value!")
+EXP_DELTA = timedelta(seconds=utils.get_exp_delta(CONF, LOG))
+
+
+class Headers(object):
+    """Case insensitive view of the ASGI request headers."""
+
+    def __init__(self, raw_headers):
+        self._headers = {}
+        for name, value in raw_headers:
+            self._headers[name.decode('latin-1').lower()] = (
+                value.decode('latin-1'))
+
+    def __getitem__(self, name):
+        return self._headers[name.lower()]
+
+    def __contains__(self, name):
+        return name.lower() in self._headers
+
+    def get(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+
+class Request(object):
+    """
+    The subset of the Flask request interface used by the response
+    handlers.
+    """
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        # Servers disagree on whether the mount point is part of the path
+        root_path = scope.get('root_path', "")
+        self.path = scope['path']
+        if root_path and self.path.startswith(root_path):
+            self.path = self.path[len(root_path):]
+        self.headers = Headers(scope['headers'])
+        self.args = dict(parse_qsl(scope.get('query_string', b"").decode()))
+        # Ids parsed from the path, see ID_ROUTES
+        self.view_args = {}
+        self.body = body
+
+    def get_json(self):
+        if not self.body:
+            return None
+        try:
+            return json.loads(self.body.decode())
+        except ValueError:
+            raise base_handler.OppError("Invalid JSON payload!")
+
+
+def _encode_jwt(user, exp_delta=None):
+    if exp_delta:
+        try:
+            exp_delta = int(exp_delta)
+            if exp_delta > pow(2, 31):
+                LOG.warning("Invalid value specified for 'exp_delta'. "
+                            " Using default value: %s seconds." %
+                            EXP_DELTA.seconds)
+                exp_delta = EXP_DELTA
+            else:
+                exp_delta = timedelta(seconds=exp_delta)
+        except Exception:
+            LOG.warning("Invalid value specified for 'exp_delta'. "
+                        " Using default value of %s seconds" %
+                        EXP_DELTA.seconds)
+            exp_delta = EXP_DELTA
+    else:
+        exp_delta = EXP_DELTA
+
+    iat = datetime.utcnow()
+    payload = {'exp': iat + exp_delta, 'iat': iat,
+               'nbf': iat + CONFIG_DEFAULTS['JWT_NBF_DELTA'],
+               'identity': user.id, 'ver': user.version}
+    return jwt.encode(payload, CONF['secret_key'],
+                      algorithm=CONFIG_DEFAULTS['JWT_ALGORITHM'])
+
+
+def _decode_jwt(request):
+    token = request.headers.get(CONFIG_DEFAULTS['JWT_AUTH_HEADER'])
+    if not token:
+        raise JWTError('Authorization Required',
+                       'Request does not contain an access token',
+                       headers={'WWW-Authenticate': 'JWT realm="%s"' %
+                                CONFIG_DEFAULTS['JWT_DEFAULT_REALM']})
+    if len(token.split()) > 1:
+        raise JWTError('Invalid JWT header', 'Token contains spaces')
+
+    options = {'verify_' + claim: True
+               for claim in CONFIG_DEFAULTS['JWT_VERIFY_CLAIMS']}
+    options.update({'require_' + claim: True
+                    for claim in CONFIG_DEFAULTS['JWT_REQUIRED_CLAIMS']})
+    try:
+        return jwt.decode(token, CONF['secret_key'], options=options,
+                          algorithms=[CONFIG_DEFAULTS['JWT_ALGORITHM']],
+                          leeway=CONFIG_DEFAULTS['JWT_LEEWAY'])
+    except jwt.InvalidTokenError as e:
+        raise JWTError('Invalid token', str(e))
+
+
+def _enforce_content_type(request):
+    if request.method == 'GET':
+        return
+    content_type = request.headers.get('Content-Type')
+    if content_type is None:
+        raise base_handler.OppError("Mising Content-Type")
+    if content_type != "application/json":
+        raise base_handler.OppError("Invalid Content-Type")
+
+
+def _authenticate(request):
+    """
+    Parse the credentials exchanged for a JWT, see `flask_jwt`.
+
+    :returns: tuple of username, password and requested token lifetime
+    """
+    content_type = request.headers.get('Content-Type')
+    if not content_type:
+        raise JWTError("Bad Request", "Missing Content-Type", 400)
+    if content_type != "application/json":
+        raise JWTError("Bad Request", "Invalid Content-Type", 400)
+
+    data = request.get_json() or {}
+    username = data.get(CONFIG_DEFAULTS['JWT_AUTH_USERNAME_KEY'])
+    password = data.get(CONFIG_DEFAULTS['JWT_AUTH_PASSWORD_KEY'])
+    exp_delta = data.get(CONFIG_DEFAULTS['JWT_AUTH_EXPDELTA_KEY'])
+    if not all([username, password, len(data) >= 2]):
+        raise JWTError('Bad Request', 'Invalid credentials')
+    return username, password, exp_delta
+
+
+async def _checkpw(password, hashed):
+    """Check a password in the bounded password pool."""
+    try:
+        future = utils.get_password_pool().submit(password, hashed)
+    except utils.PoolSaturated as e:
+        raise base_handler.OppError(
+            "Too Many Requests", str(e), 429,
+            headers={'Retry-After': str(e.retry_after)})
+    return await asyncio.wrap_future(future)
+
+
+def _handler_work(handler_class, request, payload, require_phrase):
+    def work(session):
+        user = None
+        if payload is not None:
+            user = api.user_get_cached(session, payload['identity'],
+                                       payload.get('ver'))
+            if user is None:
+                raise JWTError('Invalid JWT', 'User does not exist')
+        handler = handler_class(request, user, session)
+        return handler.respond(require_phrase), handler.headers
+    return work
+
+
+# Path: (response handler, allowed methods, whether a JWT is required,
+# methods requiring the passphrase)
+ROUTES = {
+    '/v1/user': (user_crud.ResponseHandler, ('PUT', 'POST', 'DELETE'),
+                 False, ()),
+    '/v1/fetchall': (handlers.FetchAllHandler, ('GET',), True, ('GET',)),
+    '/v1/stats': (stats.ResponseHandler, ('GET',), True, ()),
+    '/v1/metrics': (metrics.ResponseHandler, ('GET',), True, ()),
+    '/v1/categories': (handlers.CategoriesHandler,
+                       ('GET', 'PUT', 'POST', 'DELETE'), True,
+                       ('GET', 'PUT', 'POST')),
+    '/v1/items': (handlers.ItemsHandler, ('GET', 'PUT', 'POST', 'DELETE'),
+                  True, ('GET', 'PUT', 'POST')),
+}
+
+# Paths ending with an id, tried when no path of ROUTES matches: (pattern
+# naming the id, route)
+ID_ROUTES = [
+    (re.compile(r'^/v1/items/(?P<item_id>[0-9]+)$'),
+     (handlers.ItemsHandler, ('GET',), True, ('GET',))),
+]
+
+
+def _route(request):
+    """
+    :returns: the route of the request path, see ROUTES
+    """
+    if request.path in ROUTES:
+        return ROUTES[request.path]
+    for pattern, route in ID_ROUTES:
+        match = pattern.match(request.path)
+        if match:
+            request.view_args = dict((name, int(value)) for name, value
+                                     in match.groupdict().items())
+            return route
+    raise base_handler.OppError("Not Found", None, 404)
+
+
+async def _dispatch(request):
+    """
+    Route a request to its handler.
+
+    :returns: tuple of the dictionary to send back as the JSON response
+    body and the response headers
+    """
+    if request.path == '/v1/health':
+        return {'status': "OpenPassPhrase service is running"}, {}
+
+    if request.path == CONFIG_DEFAULTS['JWT_AUTH_URL_RULE']:
+        if request.method != 'POST':
+            raise base_handler.OppError("Method Not Allowed", None, 405)
+        username, password, exp_delta = _authenticate(request)
+        user = await async_api.user_get_by_username(username)
+        # The password check is CPU bound and goes to its own bounded pool,
+        # so that logins cannot take all database workers
+        if user is None or not await _checkpw(password, user.password):
+            raise JWTError('Bad Request', 'Invalid credentials')
+        return {'access_token': _encode_jwt(user, exp_delta)}, {}
+
+    handler_class, methods, jwt_required, phrase_methods = _route(request)
+    if request.method not in methods:
+        raise base_handler.OppError("Method Not Allowed", None, 405)
+
+    payload = _decode_jwt(request) if jwt_required else None
+    _enforce_content_type(request)
+    require_phrase = request.method in phrase_methods
+    if issubclass(handler_class, handlers.AsyncResponseHandler):
+        user = await async_api.user_get_cached(payload['identity'],
+                                               payload.get('ver'))
+        if user is None:
+            raise JWTError('Invalid JWT', 'User does not exist')
+        handler = handler_class(request, user)
+        return await handler.respond(require_phrase), handler.headers
+
+    work = _handler_work(handler_class, request, payload, require_phrase)
+    return await async_api.run(work, readonly=request.method == 'GET')
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get('body', b"")
+        if not message.get('more_body', False):
+            return body
+
+
+async def _send_json(send, status, body, headers=None):
+    raw_headers = [(b"content-type", b"application/json"),
+                   (b"content-length", str(len(body)).encode())]
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode('latin-1'),
+                            value.encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            async_api.shutdown_executor()
+            aescipher.shutdown_decrypt_pool()
+            utils.shutdown_password_pool()
+            api.dispose_engines()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI application entry point."""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        raise ValueError("Unsupported ASGI scope type: %s" % scope['type'])
+
+    request = Request(scope, await _read_body(receive))
+    try:
+        response, headers = await _dispatch(request)
+    except base_handler.OppError as e:
+        LOG.error(e)
+        return await _send_json(send, e.status, e.json().encode(), e.headers)
+    except JWTError as e:
+        LOG.error(e)
+        body = json.dumps(OrderedDict([('status_code', e.status_code),
+                                       ('error', e.error),
+                                       ('description', e.description)]))
+        return await _send_json(send, e.status_code, body.encode(),
+                                e.headers)
+    except Exception:
+        LOG.exception("Unhandled error serving %s %s" %
+                      (request.method, request.path))
+        error = base_handler.OppError("Internal Server Error", None, 500)
+        return await _send_json(send, 500, error.json().encode())
+    await _send_json(send, 200, json.dumps(response).encode(), headers)
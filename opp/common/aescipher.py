@@ -1,12 +1,36 @@
 import base64
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import hashlib
+import hmac
+import os
+import threading
+import time
 
 from Crypto.Cipher import AES
 from Crypto import Random
 
+from opp.common import cache, opp_config
+
 
 BS = 16
 
+# Ciphers whose passphrase was verified against a user's phrase check,
+# see `get_verified_cipher`
+_VERIFIED = None
+_VERIFIED_LOCK = threading.Lock()
+
+# Keys derived from passphrases, see `get_phrase_cipher`
+_KEYS = None
+_KEYS_LOCK = threading.Lock()
+
+# Pool decrypting large result sets in parallel, see `get_decrypt_pool`
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+# Per process key of the digests identifying the verified ciphers, so that
+# the cache keys reveal nothing about the passphrases
+_DIGEST_KEY = os.urandom(32)
+
 
 def pad(s):
     padding = BS - len(s) % BS
@@ -24,17 +48,527 @@ def unpad(s):
 class AESCipher(object):
     """AES cipher utility class for encrypting/decrypting data."""
 
+    # Version of the user's data key, recorded with the rows encrypted by
+    # the cipher, see `get_data_cipher`
+    key_version = 1
+    # Cipher of the previous data key while the key is being rotated
+    retired = None
+
     def __init__(self, key):
         self.key = hashlib.sha256(key.encode('utf-8')).digest()
 
+    @classmethod
+    def from_key(cls, key):
+        """
+        :param key: raw 32 byte AES key, e.g. an unwrapped data key
+
+        :returns: AESCipher using the key as is
+        """
+        cipher = cls.__new__(cls)
+        cipher.key = key
+        return cipher
+
     def encrypt(self, raw):
         raw = pad(raw.encode('utf-8'))
         iv = Random.new().read(AES.block_size)
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
         return base64.b64encode(iv + cipher.encrypt(raw))
 
+    def encrypt_many(self, raws, binary=False):
+        """
+        Encrypt a batch of values, running their CBC chains in lock-step.
+
+        The IVs of all values are read at once. Then, one block position at
+        a time, the blocks of all values long enough to have one there are
+        XORed with their previous ciphertext blocks and encrypted with a
+        single AES call, so the number of calls grows with the length of the
+        longest value instead of with the number of values.
+
+        :param raws: list of strings to encrypt
+        :param binary: return the raw IV and ciphertext bytes instead of
+        their base64 encoding
+
+        :returns: list of encrypted values, the same as `encrypt` returns
+        unless `binary` is set
+        """
+        padded = [pad(raw.encode('utf-8')) for raw in raws]
+        if not padded:
+            return []
+        # Longest values first, so that the values having a block at any
+        # position are a prefix of `order`
+        order = sorted(range(len(padded)), key=lambda i: -len(padded[i]))
+        ivs = Random.new().read(BS * len(padded))
+        cipher = AES.new(self.key, AES.MODE_ECB)
+
+        columns = []
+        previous = ivs
+        count = len(order)
+        for pos in range(0, len(padded[order[0]]), BS):
+            while len(padded[order[count - 1]]) <= pos:
+                count -= 1
+            size = count * BS
+            blocks = b"".join(padded[i][pos:pos + BS] for i in order[:count])
+            previous = cipher.encrypt(
+                (int.from_bytes(blocks, 'big') ^
+                 int.from_bytes(previous[:size], 'big')).to_bytes(size,
+                                                                  'big'))
+            columns.append(previous)
+
+        encs = [None] * len(padded)
+        for rank, i in enumerate(order):
+            start = rank * BS
+            encs[i] = ivs[start:start + BS] + b"".join(
+                column[start:start + BS]
+                for column in columns[:len(padded[i]) // BS])
+        if not binary:
+            encs = [base64.b64encode(enc) for enc in encs]
+        return encs
+
     def decrypt(self, enc):
         enc = base64.b64decode(enc)
         iv = enc[:16]
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
         return unpad(cipher.decrypt(enc[16:])).decode('utf-8')
+
+    def decrypt_many(self, encs, binary=False):
+        """
+        Decrypt a batch of values with a single AES call.
+
+        CBC decryption of a block only depends on the block itself and on
+        the ciphertext block preceding it. The values, each one its IV
+        followed by its ciphertext, are therefore concatenated and all of
+        their blocks decrypted at once in ECB mode. XORing the result with
+        the concatenation shifted by one block yields the plain text, except
+        at the IV blocks, which are skipped.
+
+        :param encs: list of encrypted values as returned by `encrypt`
+        :param binary: the values are raw IV and ciphertext bytes instead of
+        their base64 encoding
+
+        :returns: list of decrypted strings in the same order
+        """
+        raw = encs if binary else [base64.b64decode(enc) for enc in encs]
+        for enc in raw:
+            if len(enc) < 2 * BS or len(enc) % BS:
+                raise ValueError("Invalid ciphertext length: %d" % len(enc))
+        data = b"".join(raw)
+        if not data:
+            return []
+        decrypted = AES.new(self.key, AES.MODE_ECB).decrypt(data)
+        size = len(data) - BS
+        plain = (int.from_bytes(decrypted[BS:], 'big') ^
+                 int.from_bytes(data[:-BS], 'big')).to_bytes(size, 'big')
+
+        values = []
+        offset = 0
+        for enc in raw:
+            # `plain` is one block behind `data`, so the plain text of a
+            # value starts at the offset of its IV block
+            end = offset + len(enc) - BS
+            values.append(unpad(plain[offset:end]).decode('utf-8'))
+            offset += len(enc)
+        return values
+
+
+def _derive_sha256(phrase, salt):
+    return hashlib.sha256(phrase).digest()
+
+
+def _scrypt(n, r, p):
+    def derive(phrase, salt):
+        return hashlib.scrypt(phrase, salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r, dklen=32)
+    return derive
+
+
+# Key derivation functions of the passphrases by the name recorded in
+# `User.kdf`. Entries are never changed once released, stronger parameters
+# get a new name so that existing users keep deriving the same keys.
+# Users without a recorded function derive with a single SHA-256.
+KDF_SHA256 = 'sha256'
+KDF_SCRYPT = 'scrypt-1'
+KDFS = {KDF_SHA256: _derive_sha256,
+        # About 100ms and 32MB per derivation, see bench_kdf.py
+        KDF_SCRYPT: _scrypt(2 ** 15, 8, 1)}
+
+
+def new_phrase_kdf(conf=None):
+    """
+    Pick the key derivation function of a new passphrase, configured by the
+    `phrase_kdf` option.
+
+    :param conf: OppConfig instance
+
+    :returns: tuple of the function name and a new random base64 salt
+    """
+    conf = conf or opp_config.OppConfig()
+    kdf = conf['phrase_kdf'] or KDF_SCRYPT
+    if kdf not in KDFS:
+        raise ValueError("Unknown key derivation function: %s" % kdf)
+    return kdf, base64.b64encode(os.urandom(16)).decode('ascii')
+
+
+def derive_key(phrase, kdf=None, salt=None):
+    """
+    :param phrase: passphrase
+    :param kdf: name of the key derivation function, see `KDFS`
+    :param salt: base64 salt of the passphrase
+
+    :returns: 32 byte AES key derived from the passphrase
+    """
+    try:
+        derive = KDFS[kdf or KDF_SHA256]
+    except KeyError:
+        raise ValueError("Unknown key derivation function: %s" % kdf)
+    return derive(phrase.encode('utf-8'),
+                  base64.b64decode(salt) if salt else b"")
+
+
+def get_key_cache(conf=None):
+    """
+    Return the process wide cache of derived keys, creating it on first use
+    with the `kdf_cache_size` and `kdf_cache_ttl` options.
+
+    :param conf: OppConfig instance
+
+    :returns: TTLCache
+    """
+    global _KEYS
+    if _KEYS is None:
+        with _KEYS_LOCK:
+            if _KEYS is None:
+                conf = conf or opp_config.OppConfig()
+                _KEYS = cache.TTLCache(
+                    conf.getint('kdf_cache_size', 256),
+                    conf.getint('kdf_cache_ttl', 3600))
+    return _KEYS
+
+
+def get_key_cache_stats():
+    """
+    :returns: statistics of the derived key cache, None if it was not
+    created yet
+    """
+    keys = _KEYS
+    return keys.stats() if keys is not None else None
+
+
+def get_phrase_cipher(phrase, kdf=None, salt=None):
+    """
+    Return the cipher of a passphrase, see `derive_key`.
+
+    Derived keys are cached under a keyed digest of the function, the salt
+    and the passphrase. A derived key never goes stale, a new passphrase
+    comes with a new salt, so unlike the verified ciphers the entries
+    outlive updates of the user and only the cheap phrase check is
+    repeated.
+
+    :returns: AESCipher
+    """
+    if not kdf or kdf == KDF_SHA256:
+        # Cheaper than the digest of the cache key
+        return AESCipher.from_key(derive_key(phrase, kdf, salt))
+
+    keys = get_key_cache()
+    message = "%s$%s$%d:%s" % (kdf, salt, len(phrase), phrase)
+    digest = hmac.new(_DIGEST_KEY, message.encode('utf-8'),
+                      hashlib.sha256).digest()
+    key = keys.get(digest)
+    if key is None:
+        key = derive_key(phrase, kdf, salt)
+        keys.put(digest, key)
+    return AESCipher.from_key(key)
+
+
+def get_cipher_cache(conf=None):
+    """
+    Return the process wide cache of verified ciphers, creating it on first
+    use with the `cipher_cache_size` and `cipher_cache_ttl` options.
+
+    :param conf: OppConfig instance
+
+    :returns: TTLCache
+    """
+    global _VERIFIED
+    if _VERIFIED is None:
+        with _VERIFIED_LOCK:
+            if _VERIFIED is None:
+                conf = conf or opp_config.OppConfig()
+                _VERIFIED = cache.TTLCache(
+                    conf.getint('cipher_cache_size', 256),
+                    conf.getint('cipher_cache_ttl', 300))
+    return _VERIFIED
+
+
+def get_cipher_cache_stats():
+    """
+    :returns: statistics of the verified cipher cache, None if it was not
+    created yet
+    """
+    verified = _VERIFIED
+    return verified.stats() if verified is not None else None
+
+
+def new_data_key(phrase_cipher):
+    """
+    Generate a random data key for a new user, or to rotate the key of an
+    existing one.
+
+    :param phrase_cipher: cipher of the user's passphrase
+
+    :returns: the data key wrapped by the passphrase cipher
+    """
+    return wrap_data_key(phrase_cipher, AESCipher.from_key(os.urandom(32)))
+
+
+def wrap_data_key(phrase_cipher, data_cipher):
+    """
+    :param phrase_cipher: cipher of the user's passphrase
+    :param data_cipher: cipher of the user's data key
+
+    :returns: the data key encrypted with the passphrase cipher
+    """
+    return phrase_cipher.encrypt(
+        base64.b64encode(data_cipher.key).decode('ascii'))
+
+
+def _unwrap_data_key(phrase_cipher, data_key, version):
+    cipher = AESCipher.from_key(base64.b64decode(
+        phrase_cipher.decrypt(data_key)))
+    cipher.key_version = version
+    return cipher
+
+
+def get_data_cipher(user, phrase_cipher):
+    """
+    Return the cipher encrypting a user's categories and items.
+
+    Users created before data keys were introduced have their data
+    encrypted with the passphrase cipher itself. Their first passphrase
+    change wraps that key as their data key instead of re-encrypting the
+    data, see `wrap_data_key`.
+
+    While the data key is rotated, the returned cipher is the one of the
+    next key, which encrypts all new data, and the cipher of the current key
+    is kept as its `retired` cipher for the data not re-encrypted yet, see
+    `get_version_cipher`.
+
+    :param user: User model
+    :param phrase_cipher: verified cipher of the user's passphrase
+
+    :returns: AESCipher
+    """
+    if user.data_key is None:
+        # Phrase ciphers are shared through the key cache
+        cipher = AESCipher.from_key(phrase_cipher.key)
+        cipher.key_version = user.key_version
+    else:
+        cipher = _unwrap_data_key(phrase_cipher, user.data_key,
+                                  user.key_version)
+    if user.next_data_key is None:
+        return cipher
+    next_cipher = _unwrap_data_key(phrase_cipher, user.next_data_key,
+                                   user.key_version + 1)
+    next_cipher.retired = cipher
+    return next_cipher
+
+
+def get_version_cipher(cipher, version):
+    """
+    :param cipher: cipher returned by `get_data_cipher`
+    :param version: data key version recorded with the encrypted data, None
+    for data which was not stored yet
+
+    :returns: the cipher of that version of the data key
+    """
+    if version is None or version == cipher.key_version:
+        return cipher
+    if cipher.retired is not None and version == cipher.retired.key_version:
+        return cipher.retired
+    raise ValueError("No cipher for data key version %d" % version)
+
+
+def check_phrase(user, phrase):
+    """
+    Check a passphrase against the user's phrase check, without caching the
+    verified cipher.
+
+    :param user: User model
+    :param phrase: passphrase to check
+
+    :returns: cipher of the passphrase, None if it is incorrect
+    """
+    cipher = get_phrase_cipher(phrase, user.kdf, user.kdf_salt)
+    try:
+        if cipher.decrypt(user.phrase_check) != "OK":
+            return None
+    except UnicodeDecodeError:
+        return None
+    return cipher
+
+
+def _verified_key(user, phrase):
+    message = "%d:%s%s%s%s%s" % (len(phrase), phrase, user.phrase_check,
+                                 user.data_key, user.next_data_key,
+                                 user.key_version)
+    digest = hmac.new(_DIGEST_KEY, message.encode('utf-8'),
+                      hashlib.sha256).digest()
+    return user.id, digest
+
+
+def get_verified_cipher(user, phrase):
+    """
+    Check a passphrase against the user's phrase check and return the
+    cipher of the user's data. Verified ciphers are cached under a keyed
+    digest of the user id, the passphrase, the phrase check and the wrapped
+    data keys, so repeated requests skip the key derivation and the check,
+    and a new phrase check or data key never matches the entries of the
+    previous one.
+
+    :param user: User model
+    :param phrase: passphrase supplied with the request
+
+    :returns: AESCipher of the user's data, see `get_data_cipher`, or None
+    if the passphrase is incorrect
+    """
+    ciphers = get_cipher_cache()
+    key = _verified_key(user, phrase)
+    cipher = ciphers.get(key)
+    if cipher is not None:
+        return cipher
+
+    generation = ciphers.generation
+    cipher = check_phrase(user, phrase)
+    if cipher is None:
+        return None
+    cipher = get_data_cipher(user, cipher)
+    ciphers.put(key, cipher, generation)
+    return cipher
+
+
+def invalidate_ciphers(user_id):
+    """Drop the verified ciphers of a user, e.g. after a passphrase change."""
+    if _VERIFIED is not None:
+        _VERIFIED.invalidate_matching(lambda key: key[0] == user_id)
+
+
+def _decrypt_shard(cipher, encs, binary):
+    return cipher.decrypt_many(encs, binary)
+
+
+class DecryptPool(object):
+    """
+    Pool of worker threads or processes decrypting the values of large
+    result sets in shards, so that a single request can use several cores.
+    """
+
+    def __init__(self, kind, size, threshold):
+        """
+        :param kind: 'thread' or 'process'
+        :param size: number of workers, less than 2 decrypts inline
+        :param threshold: minimum number of rows decrypted in the pool
+        """
+        if kind not in ('thread', 'process'):
+            raise ValueError("Invalid decrypt pool kind: %s" % kind)
+        self.kind = kind
+        self.size = size
+        self.threshold = threshold
+        self._executor = None
+        if size > 1:
+            if kind == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=size)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=size, thread_name_prefix='opp-decrypt')
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.rows = 0
+        self.time = 0.0
+        self.max_time = 0.0
+
+    def decrypt_many(self, cipher, encs, rows, binary=False):
+        """
+        Decrypt a batch of values, in parallel shards if the batch belongs
+        to at least `threshold` rows.
+
+        :param cipher: AESCipher instance
+        :param encs: list of encrypted values
+        :param rows: number of rows the values belong to
+        :param binary: see `AESCipher.decrypt_many`
+
+        :returns: list of decrypted strings in the same order
+        """
+        if self._executor is None or rows < self.threshold:
+            return cipher.decrypt_many(encs, binary)
+
+        start = time.monotonic()
+        shard = -(-len(encs) // self.size)
+        shards = [encs[i:i + shard] for i in range(0, len(encs), shard)]
+        values = []
+        # `map` yields the shards in order, which keeps the values in the
+        # order of the rows, i.e. by sort_id
+        for decrypted in self._executor.map(
+                _decrypt_shard, [cipher] * len(shards), shards,
+                [binary] * len(shards)):
+            values.extend(decrypted)
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.requests += 1
+            self.rows += rows
+            self.time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+        return values
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def stats(self):
+        with self._lock:
+            return {'kind': self.kind,
+                    'size': self.size,
+                    'threshold': self.threshold,
+                    'requests': self.requests,
+                    'rows': self.rows,
+                    'time': round(self.time, 6),
+                    'max_time': round(self.max_time, 6)}
+
+
+def get_decrypt_pool(conf=None):
+    """
+    Return the process wide decryption pool, creating it on first use with
+    the `decrypt_pool_kind`, `decrypt_pool_size` and
+    `decrypt_pool_threshold` options.
+
+    :param conf: OppConfig instance
+
+    :returns: DecryptPool
+    """
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                conf = conf or opp_config.OppConfig()
+                _POOL = DecryptPool(conf['decrypt_pool_kind'] or 'thread',
+                                    conf.getint('decrypt_pool_size', 0),
+                                    conf.getint('decrypt_pool_threshold',
+                                                2000))
+    return _POOL
+
+
+def get_decrypt_pool_stats():
+    """
+    :returns: statistics of the decryption pool, None if it was not created
+    yet
+    """
+    pool = _POOL
+    return pool.stats() if pool is not None else None
+
+
+def shutdown_decrypt_pool():
+    """Stop the workers of the decryption pool, if any were started."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown()
+            _POOL = None
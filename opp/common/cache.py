@@ -0,0 +1,117 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    Thread safe, size bounded LRU cache whose entries expire a fixed time
+    after they were stored.
+
+    Values loaded while an invalidation happens may already be stale, so
+    callers take the `generation` before loading a value and pass it to
+    `put`, which drops the value if any invalidation happened meanwhile.
+    """
+
+    def __init__(self, max_size, ttl):
+        """
+        :param max_size: maximum number of entries, 0 disables the cache
+        :param ttl: lifetime of the entries in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, check=None):
+        """
+        :param check: optional predicate, cached values it rejects are
+        dropped and count as misses
+
+        :returns: the cached value, None if missing or expired
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is None or entry[0] <= now or
+                    (check is not None and not check(entry[1]))):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def put(self, key, value, generation=None):
+        """
+        Store a value, evicting the least recently used entry if the cache
+        is full.
+
+        :param generation: `generation` read before loading the value, the
+        value is dropped if the cache was invalidated since
+        """
+        if not self.max_size:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop the entry of a key, e.g. after the underlying data changed."""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            self._entries.pop(key, None)
+
+    def invalidate_matching(self, predicate):
+        """Drop the entries of all keys accepted by `predicate`."""
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries),
+                    'max_size': self.max_size,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations}
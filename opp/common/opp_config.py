@@ -63,3 +63,15 @@ class OppConfig(object):
             return self.cfg.get(self.def_sec, item)
         except configparser.Error:
             return None
+
+    def getint(self, item, default=None):
+        try:
+            return self.cfg.getint(self.def_sec, item)
+        except (configparser.Error, ValueError):
+            return default
+
+    def getboolean(self, item, default=None):
+        try:
+            return self.cfg.getboolean(self.def_sec, item)
+        except (configparser.Error, ValueError):
+            return default
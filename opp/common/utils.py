@@ -15,14 +15,22 @@
 
 import base64
 import bcrypt
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import logging
+import math
 import shlex
 import subprocess
+import threading
+import time
 
 from opp.common import opp_config
 
 
+_PASSWORD_POOL = None
+_PASSWORD_POOL_LOCK = threading.Lock()
+
+
 def execute(cmd, propagate=True):
     args = shlex.split(cmd)
     process = subprocess.Popen(args,
@@ -73,3 +81,163 @@ def getLogger(name, config=None):
         logger.setLevel(log_level)
 
     return logger
+
+
+def get_exp_delta(config, logger):
+    """
+    Parse the `exp_delta` config option, the lifetime of issued JWTs.
+
+    :param config: OppConfig instance
+    :param logger: logger receiving warnings about invalid values
+
+    :returns: lifetime in seconds, 300 if the option is missing or invalid
+    """
+    try:
+        if config['exp_delta']:
+            exp_delta = int(config['exp_delta'])
+            if exp_delta < 0 or exp_delta > pow(2, 31):
+                logger.warning("Invalid value specified for 'exp_delta' "
+                               "config option. Defaulting to 300 seconds.")
+                exp_delta = 300
+        else:
+            logger.warning("Config value for 'exp_delta' not "
+                           "specified. Defaulting to 300 seconds.")
+            exp_delta = 300
+    except Exception:
+        logger.warning("Unable to parse value for 'exp_delta' "
+                       "config option. Defaulting to 300 seconds.")
+        exp_delta = 300
+    return exp_delta
+
+
+class PoolSaturated(Exception):
+    """Raised when a `PasswordPool` has no room for another check."""
+
+    def __init__(self, retry_after):
+        super(PoolSaturated, self).__init__(
+            "Too many password checks in progress")
+        self.retry_after = retry_after
+
+
+class PasswordPool(object):
+    """
+    Bounded pool of worker threads checking passwords, so that a burst of
+    logins cannot tie up every thread serving requests. bcrypt runs without
+    holding Python's global interpreter lock. Checks beyond the workers wait
+    in a queue of limited depth, further ones are rejected right away.
+    """
+
+    def __init__(self, size, queue_size):
+        """
+        :param size: number of workers
+        :param queue_size: maximum number of checks waiting for a worker
+        """
+        self.size = max(size, 1)
+        self.queue_size = max(queue_size, 0)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.size, thread_name_prefix='opp-password')
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.checks = 0
+        self.rejections = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.hash_time = 0.0
+        self.max_hash_time = 0.0
+
+    def _retry_after(self):
+        # Seconds until the queue drained at the average check rate
+        average = self.hash_time / self.checks if self.checks else 1.0
+        return max(1, int(math.ceil(average * self.pending / self.size)))
+
+    def _check(self, password, hashed, submitted):
+        start = time.monotonic()
+        try:
+            return checkpw(password, hashed)
+        finally:
+            end = time.monotonic()
+            with self._lock:
+                self.pending -= 1
+                self.checks += 1
+                self.wait_time += start - submitted
+                self.max_wait = max(self.max_wait, start - submitted)
+                self.hash_time += end - start
+                self.max_hash_time = max(self.max_hash_time, end - start)
+
+    def submit(self, password, hashed):
+        """
+        Queue a password check, see `checkpw`.
+
+        :raises PoolSaturated: if `queue_size` checks are waiting already
+
+        :returns: concurrent.futures.Future of the check result
+        """
+        with self._lock:
+            if self.pending >= self.size + self.queue_size:
+                self.rejections += 1
+                raise PoolSaturated(self._retry_after())
+            self.pending += 1
+        try:
+            return self._executor.submit(self._check, password, hashed,
+                                         time.monotonic())
+        except Exception:
+            with self._lock:
+                self.pending -= 1
+            raise
+
+    def checkpw(self, password, hashed):
+        """Check a password in the pool and wait for the result."""
+        return self.submit(password, hashed).result()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def stats(self):
+        with self._lock:
+            return {'size': self.size,
+                    'queue_size': self.queue_size,
+                    'pending': self.pending,
+                    'checks': self.checks,
+                    'rejections': self.rejections,
+                    'wait_time': round(self.wait_time, 6),
+                    'max_wait': round(self.max_wait, 6),
+                    'hash_time': round(self.hash_time, 6),
+                    'max_hash_time': round(self.max_hash_time, 6)}
+
+
+def get_password_pool(conf=None):
+    """
+    Return the process wide password checking pool, creating it on first
+    use with the `auth_workers` and `auth_queue_size` options.
+
+    :param conf: OppConfig instance
+
+    :returns: PasswordPool
+    """
+    global _PASSWORD_POOL
+    if _PASSWORD_POOL is None:
+        with _PASSWORD_POOL_LOCK:
+            if _PASSWORD_POOL is None:
+                conf = conf or opp_config.OppConfig()
+                _PASSWORD_POOL = PasswordPool(
+                    conf.getint('auth_workers', 2),
+                    conf.getint('auth_queue_size', 16))
+    return _PASSWORD_POOL
+
+
+def get_password_pool_stats():
+    """
+    :returns: statistics of the password checking pool, None if it was not
+    created yet
+    """
+    pool = _PASSWORD_POOL
+    return pool.stats() if pool is not None else None
+
+
+def shutdown_password_pool():
+    """Stop the workers of the password checking pool, if it was started."""
+    global _PASSWORD_POOL
+    with _PASSWORD_POOL_LOCK:
+        if _PASSWORD_POOL is not None:
+            _PASSWORD_POOL.shutdown()
+            _PASSWORD_POOL = None
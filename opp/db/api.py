@@ -13,16 +13,107 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import hmac
+import random
 import sys
+import threading
+import time
 
-from sqlalchemy import create_engine, event, exc
+from sqlalchemy import (DateTime, bindparam, create_engine, event, exc, func,
+                        literal, or_, select)
 from sqlalchemy.engine import Engine
-from sqlalchemy.orm import scoped_session, sessionmaker, subqueryload
+from sqlalchemy.orm import (Session, defer, joinedload, scoped_session,
+                            sessionmaker, subqueryload)
+from sqlalchemy.pool import QueuePool
 
-from opp.common import opp_config
+from opp.common import aescipher, cache, opp_config
 from opp.db import models
 
 
+# Number of rows sent to the database per executemany() call by the bulk
+# functions below.
+BULK_BATCH_SIZE = 1000
+
+# Maximum number of ids in a single IN (...) clause, stays below the
+# default bound parameter limit of older SQLite versions.
+IN_CLAUSE_SIZE = 500
+
+# Process wide registries of engines and scoped session factories, keyed
+# by the `db_connect` string and the engine role. Engines own the
+# connection pools, so they must outlive individual requests.
+_ENGINES = {}
+_SESSIONS = {}
+_REGISTRY_LOCK = threading.Lock()
+
+# Retry count and initial backoff in seconds of `run_write`, per engine
+_WRITE_RETRY = {}
+
+# Engine roles. SQLite databases get a separate reader engine, other
+# databases serve reads from the primary engine. The replica engine
+# connects to `db_connect_replica` when it is configured.
+ROLE_WRITE = 'write'
+ROLE_READ = 'read'
+ROLE_REPLICA = 'replica'
+
+# Configuration and read-your-writes window in seconds of the replica of
+# each primary engine, for the engines whose database has a replica
+_REPLICAS = {}
+
+# Users looked up by the JWT identity of recent requests, keyed by the
+# database URL and user id, see `user_get_cached`
+_IDENTITIES = None
+
+# Session info key of the users to drop from the identity cache once the
+# session's transaction commits
+_STALE_IDENTITIES = 'opp_stale_identities'
+
+# Accepted values of the SQLite profile options which are interpolated
+# into PRAGMA statements
+SQLITE_JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL')
+SQLITE_SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool which keeps checkout statistics for sizing workers."""
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.monotonic() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    def stats(self):
+        with self._stats_lock:
+            return {'pool_size': self.size(),
+                    'checked_in': self.checkedin(),
+                    'checked_out': self.checkedout(),
+                    'overflow': max(self.overflow(), 0),
+                    'checkouts': self.checkouts,
+                    'timeouts': self.timeouts,
+                    'wait_time': round(self.wait_time, 6),
+                    'max_wait': round(self.max_wait, 6)}
+
+
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
     if 'sqlite' in str(type(dbapi_connection)):
@@ -31,16 +122,519 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
         cursor.close()
 
 
-def get_scoped_session(conf=None):
+def _is_sqlite_memory(db_connect):
+    return db_connect in ('sqlite://', 'sqlite:///:memory:')
+
+
+def _is_split_sqlite(conf, db_connect):
+    """Whether writes go through a single serialized SQLite connection."""
+    return (db_connect.startswith('sqlite') and
+            not _is_sqlite_memory(db_connect) and
+            conf.getboolean('sqlite_single_writer', True))
+
+
+def _sqlite_choice(conf, option, default, choices):
+    value = (conf[option] or default).upper()
+    if value not in choices:
+        sys.exit("Error: invalid %s value '%s', expected one of: %s" %
+                 (option, value, ", ".join(choices)))
+    return value
+
+
+def _sqlite_pragmas(conf, db_connect):
+    """
+    Build the PRAGMA statements of the SQLite profile from the
+    configuration options.
+
+    :returns: list of PRAGMA statements
+    """
+    pragmas = ["PRAGMA busy_timeout=%d" %
+               conf.getint('sqlite_busy_timeout', 5000),
+               "PRAGMA synchronous=%s" %
+               _sqlite_choice(conf, 'sqlite_synchronous', 'NORMAL',
+                              SQLITE_SYNCHRONOUS),
+               "PRAGMA cache_size=%d" %
+               conf.getint('sqlite_cache_size', -16000)]
+    if not _is_sqlite_memory(db_connect):
+        pragmas += ["PRAGMA journal_mode=%s" %
+                    _sqlite_choice(conf, 'sqlite_journal_mode', 'WAL',
+                                   SQLITE_JOURNAL_MODES),
+                    "PRAGMA mmap_size=%d" %
+                    conf.getint('sqlite_mmap_size', 268435456)]
+    return pragmas
+
+
+def _setup_sqlite(engine, pragmas, begin=None, query_only=False):
+    """
+    Apply the SQLite profile to every new connection of an engine.
+
+    :param pragmas: PRAGMA statements to run on connect
+    :param begin: statement starting transactions, e.g. "BEGIN IMMEDIATE"
+    to take the write lock up front. The driver's own implicit transaction
+    handling is disabled in that case.
+    :param query_only: reject writes on the connections
+    """
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        if query_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+        if begin:
+            dbapi_connection.isolation_level = None
+
+    if begin:
+        @event.listens_for(engine, "begin")
+        def do_begin(conn):
+            conn.execute(begin)
+
+
+def _engine_options(conf, db_connect, role=ROLE_WRITE):
+    """
+    Build the `create_engine` keyword arguments from the pool related
+    configuration options.
+
+    :param conf: OppConfig instance
+    :param db_connect: database connection string
+    :param role: ROLE_WRITE or ROLE_READ
+
+    :returns: dictionary of keyword arguments
+    """
+    options = {'pool_recycle': conf.getint('db_pool_recycle', -1),
+               'pool_pre_ping': conf.getboolean('db_pool_pre_ping', False)}
+    if _is_sqlite_memory(db_connect):
+        # In-memory databases only exist within a single connection
+        return options
+
+    options.update({'poolclass': InstrumentedQueuePool,
+                    'pool_size': conf.getint('db_pool_size', 5),
+                    'max_overflow': conf.getint('db_max_overflow', 10),
+                    'pool_timeout': conf.getint('db_pool_timeout', 30)})
+    if db_connect.startswith('sqlite'):
+        # Pooled SQLite connections are handed out to different threads
+        options['connect_args'] = {'check_same_thread': False}
+    if role == ROLE_WRITE and _is_split_sqlite(conf, db_connect):
+        # SQLite allows a single writer at a time, writers of this process
+        # queue for the one connection instead of failing on the lock
+        options.update({'pool_size': 1, 'max_overflow': 0})
+    return options
+
+
+def _create_engine(conf, db_connect, role):
+    try:
+        engine = create_engine(db_connect,
+                               **_engine_options(conf, db_connect, role))
+    except exc.NoSuchModuleError as e:
+        sys.exit("Error: %s" % str(e))
+    _WRITE_RETRY[engine] = (conf.getint('db_write_retries', 5),
+                            conf.getint('db_write_backoff_ms', 50) / 1000.0)
+    if role != ROLE_REPLICA and conf['db_connect_replica']:
+        _REPLICAS[engine] = (conf, conf.getint('db_replica_window', 5))
+    if db_connect.startswith('sqlite'):
+        pragmas = _sqlite_pragmas(conf, db_connect)
+        if role == ROLE_REPLICA:
+            _setup_sqlite(engine, pragmas, begin="BEGIN", query_only=True)
+        elif not _is_split_sqlite(conf, db_connect):
+            _setup_sqlite(engine, pragmas)
+        elif role == ROLE_WRITE:
+            _setup_sqlite(engine, pragmas, begin="BEGIN IMMEDIATE")
+        else:
+            # Reads of a request see a single consistent snapshot
+            _setup_sqlite(engine, pragmas, begin="BEGIN", query_only=True)
+    return engine
+
+
+def _target(conf, readonly, replica):
+    """
+    Pick the database and engine role serving a request.
+
+    :returns: tuple of `db_connect` string and role
+    """
+    if replica and conf['db_connect_replica']:
+        return conf['db_connect_replica'], ROLE_REPLICA
+    db_connect = conf['db_connect']
+    if readonly and db_connect and _is_split_sqlite(conf, db_connect):
+        return db_connect, ROLE_READ
+    return db_connect, ROLE_WRITE
+
+
+def get_engine(conf=None, readonly=False, replica=False):
+    """
+    Return the process wide engine for the configured database, creating
+    it on first use. Pool options are taken from the configuration which
+    first creates the engine.
+
+    :param conf: OppConfig instance
+    :param readonly: return the engine serving read only requests, which
+    is the primary engine unless the database is SQLite
+    :param replica: return the engine of the `db_connect_replica` database,
+    or the read only engine if no replica is configured
+
+    :returns: SQLAlchemy engine or None if `db_connect` is not configured
+    """
     conf = conf or opp_config.OppConfig(conf)
-    if conf['db_connect']:
+    if not conf['db_connect']:
+        return None
+
+    db_connect, role = _target(conf, readonly or replica, replica)
+    engine = _ENGINES.get((db_connect, role))
+    if engine is None:
+        with _REGISTRY_LOCK:
+            engine = _ENGINES.get((db_connect, role))
+            if engine is None:
+                engine = _create_engine(conf, db_connect, role)
+                _ENGINES[(db_connect, role)] = engine
+    return engine
+
+
+def get_scoped_session(conf=None, readonly=False, replica=False):
+    """
+    Return the process wide scoped session registry for the configured
+    database. Callers must call `remove()` on it once they are done with
+    the current thread's session, e.g. at the end of a request.
+
+    :param conf: OppConfig instance
+    :param readonly: return the registry for read only requests
+    :param replica: return the registry of the replica database, see
+    `get_engine`
+
+    :returns: scoped_session or None if `db_connect` is not configured
+    """
+    conf = conf or opp_config.OppConfig(conf)
+    engine = get_engine(conf, readonly, replica)
+    if engine is None:
+        return None
+
+    key = _target(conf, readonly or replica, replica)
+    session = _SESSIONS.get(key)
+    if session is None:
+        with _REGISTRY_LOCK:
+            session = _SESSIONS.get(key)
+            if session is None:
+                session_factory = sessionmaker(engine, autocommit=True)
+                session = scoped_session(session_factory)
+                _SESSIONS[key] = session
+    return session
+
+
+def _write_signature(conf, user_id, written_at):
+    message = "%d:%s" % (user_id, written_at)
+    return hmac.new(conf['secret_key'].encode('utf-8'),
+                    message.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def record_write(session, user):
+    """
+    Note that a user just wrote to the primary database. The returned write
+    token is handed to the client, whose reads then skip the replica for
+    the read-your-writes window, whichever server process serves them.
+
+    :param session: session of the write
+    :param user: user owning the written data
+
+    :returns: signed write token, None if the database has no replica
+    """
+    replica = _REPLICAS.get(session.bind)
+    if replica is None or user is None:
+        return None
+    written_at = "%.6f" % time.time()
+    return "%d:%s:%s" % (user.id, written_at,
+                         _write_signature(replica[0], user.id, written_at))
+
+
+def _written_within(conf, user, write_token, window):
+    try:
+        user_id, written_at, signature = write_token.split(":")
+        age = time.time() - float(written_at)
+    except ValueError:
+        return False
+    # Tokens of other users, forged ones and future ones are ignored
+    return (user_id == str(user.id) and 0 <= age < window and
+            hmac.compare_digest(signature, _write_signature(
+                conf, user.id, written_at)))
+
+
+def get_read_session(session, user, write_token=None):
+    """
+    Pick the session registry serving the reads of a user: the replica of
+    the session's database, unless the user wrote within the replica's
+    read-your-writes window (`db_replica_window` seconds) and could miss
+    the write on a lagging replica.
+
+    :param session: read only session registry of the primary database
+    :param user: user reading
+    :param write_token: token returned by `record_write` for the user's
+    last write, as sent back by the client
+
+    :returns: scoped_session, `session` itself if the reads stay on the
+    primary database
+    """
+    replica = _REPLICAS.get(session.bind)
+    if replica is None or user is None:
+        return session
+    conf, window = replica
+    if write_token and _written_within(conf, user, write_token, window):
+        return session
+    return get_scoped_session(conf, replica=True)
+
+
+def is_locked_error(error):
+    """Whether a database error was caused by another writer's lock."""
+    message = str(error.orig).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def run_write(session, work, retries=None, backoff=None):
+    """
+    Run `work` in a write transaction. The transaction is started, and
+    the write lock taken, before `work` is called, so that it is retried
+    with exponential backoff while another process holds the SQLite
+    database lock.
+
+    :param session: SQLAlchemy session
+    :param work: callable performing the writes
+    :param retries: number of retries, the `db_write_retries` option of the
+    session's engine by default
+    :param backoff: initial delay between retries in seconds, the
+    `db_write_backoff_ms` option of the session's engine by default
+
+    :returns: return value of `work`
+    """
+    options = _WRITE_RETRY.get(session.bind, (5, 0.05))
+    if retries is None:
+        retries = options[0]
+    if backoff is None:
+        backoff = options[1]
+
+    attempt = 0
+    while True:
         try:
-            engine = create_engine(conf['db_connect'])
-            session_factory = sessionmaker(engine, autocommit=True)
-            return scoped_session(session_factory)
-        except exc.NoSuchModuleError as e:
-            sys.exit("Error: %s" % str(e))
-        sys.exit("Error: database connection string not configured.")
+            transaction = session.begin()
+            session.connection()
+        except exc.OperationalError as e:
+            session.rollback()
+            if not is_locked_error(e) or attempt >= retries:
+                raise
+            time.sleep(backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt += 1
+            continue
+        with transaction:
+            return work()
+
+
+def _chunks(ids, size=IN_CLAUSE_SIZE):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def get_pool_stats():
+    """
+    Collect connection pool statistics for every engine in the registry.
+
+    :returns: list of dictionaries, one per engine
+    """
+    stats = []
+    for (_, role), engine in list(_ENGINES.items()):
+        entry = {'driver': engine.url.drivername,
+                 'role': role,
+                 'pool': type(engine.pool).__name__}
+        if isinstance(engine.pool, InstrumentedQueuePool):
+            entry.update(engine.pool.stats())
+        stats.append(entry)
+    return stats
+
+
+def dispose_engines():
+    """
+    Close all pooled connections and empty the registries. Should be called
+    in child processes after forking so that connections are not shared.
+    """
+    with _REGISTRY_LOCK:
+        for session in _SESSIONS.values():
+            session.remove()
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _SESSIONS.clear()
+        _ENGINES.clear()
+        _WRITE_RETRY.clear()
+        _REPLICAS.clear()
+        if _IDENTITIES is not None:
+            _IDENTITIES.clear()
+
+
+def _insert_ids(session, table, batch):
+    """
+    Insert rows and return their generated ids, in the order of the rows,
+    from the statements themselves rather than by querying afterwards, so
+    that concurrent inserts for the same user cannot get mixed in.
+
+    On PostgreSQL the ids are taken from the table's sequence before the
+    insert, so that every row carries its own id and no ordering of
+    RETURNING is relied upon. On MySQL a multi-row insert gets consecutive
+    ids from LAST_INSERT_ID() on, but only with `innodb_autoinc_lock_mode`
+    0 or 1. The default mode 2 of MySQL 8 may interleave the ids of
+    concurrent inserts, so there the rows are inserted one by one.
+
+    :returns: list of ids
+    """
+    dialect = session.get_bind().dialect
+    if dialect.name == 'postgresql':
+        ids = [row[0] for row in session.execute(
+            select([table.c.id.default.next_value()]).select_from(
+                func.generate_series(1, len(batch))))]
+        session.execute(table.insert(), [dict(row, id=row_id)
+                                         for row, row_id in zip(batch, ids)])
+        return ids
+    if dialect.name == 'sqlite':
+        # Each row gets the highest rowid plus one, and the transaction
+        # holds the database write lock from the insert on, so the rows are
+        # the highest ids of the table until it ends
+        session.execute(table.insert(), batch)
+        last_id = session.execute(select([func.max(table.c.id)])).scalar()
+        return list(range(last_id - len(batch) + 1, last_id + 1))
+    if dialect.name == 'mysql':
+        lock_mode, increment = session.execute(
+            "SELECT @@innodb_autoinc_lock_mode, "
+            "@@auto_increment_increment").first()
+        if lock_mode <= 1:
+            # A single statement, drivers may split an executemany() into
+            # several, each with ids of its own
+            first_id = session.execute(
+                table.insert().values(batch)).lastrowid
+            return [first_id + i * increment for i in range(len(batch))]
+    return [session.execute(table.insert(), row).inserted_primary_key[0]
+            for row in batch]
+
+
+def _create_bulk(session, user, model, rows, batch_size):
+    if not (session and user and rows):
+        return []
+
+    table = model.__table__
+    ids = []
+    for start in range(0, len(rows), batch_size):
+        batch = [dict(row, user_id=user.id)
+                 for row in rows[start:start + batch_size]]
+        ids.extend(_insert_ids(session, table, batch))
+    return ids
+
+
+def _update_bulk(session, user, model, rows, batch_size):
+    if not (session and user and rows):
+        return []
+
+    table = model.__table__
+    stmt = table.update().where(
+        table.c.id == bindparam('_id')).where(
+        table.c.user_id == bindparam('_user_id'))
+
+    matched = 0
+    for start in range(0, len(rows), batch_size):
+        batch = []
+        for row in rows[start:start + batch_size]:
+            params = {key: value for key, value in row.items() if key != 'id'}
+            params.update({'_id': row['id'], '_user_id': user.id})
+            batch.append(params)
+        result = session.execute(stmt, batch)
+        matched += result.rowcount
+
+    ids = [row['id'] for row in rows]
+    dialect = session.get_bind().dialect
+    if matched == len(ids) and dialect.supports_sane_multi_rowcount:
+        return []
+
+    found = set()
+    for start in range(0, len(ids), batch_size):
+        query = session.query(model.id).filter(
+            model.user_id == user.id).filter(
+            model.id.in_(ids[start:start + batch_size]))
+        found.update(row.id for row in query)
+    return [row_id for row_id in ids if row_id not in found]
+
+
+def get_identity_cache(conf=None):
+    """
+    Return the process wide identity cache, creating it on first use with
+    the `identity_cache_size` and `identity_cache_ttl` options.
+
+    :param conf: OppConfig instance
+
+    :returns: TTLCache
+    """
+    global _IDENTITIES
+    if _IDENTITIES is None:
+        with _REGISTRY_LOCK:
+            if _IDENTITIES is None:
+                conf = conf or opp_config.OppConfig()
+                _IDENTITIES = cache.TTLCache(
+                    conf.getint('identity_cache_size', 1024),
+                    conf.getint('identity_cache_ttl', 60))
+    return _IDENTITIES
+
+
+def get_identity_cache_stats():
+    """
+    :returns: statistics of the identity cache, None if it was not created
+    yet
+    """
+    identities = _IDENTITIES
+    return identities.stats() if identities is not None else None
+
+
+def _identity_key(session, user_id):
+    return str(session.bind.url), user_id
+
+
+def _invalidate_identity(session, user):
+    session.info.setdefault(_STALE_IDENTITIES, set()).add(
+        _identity_key(session, user.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _drop_stale_identities(session):
+    for key in session.info.pop(_STALE_IDENTITIES, ()):
+        if _IDENTITIES is not None:
+            _IDENTITIES.invalidate(key)
+        # The passphrase may have changed as well
+        aescipher.invalidate_ciphers(key[1])
+
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_identities(session):
+    session.info.pop(_STALE_IDENTITIES, None)
+
+
+def user_get_cached(session, id, version=None):
+    """
+    Look up the user authenticated by a request, from the identity cache
+    if possible. Cached users are shared between requests and detached from
+    any session, so they must not be modified. Changes of a user through
+    `user_update` or `user_delete` drop its entry once committed, changes
+    by other processes are picked up when the entry expires or when a
+    token carries a newer user version.
+
+    :param session: SQLAlchemy session used on cache misses
+    :param id: user id
+    :param version: minimum acceptable user version, e.g. from the JWT
+
+    :returns: User or None if no such user exists
+    """
+    identities = get_identity_cache()
+    key = _identity_key(session, id)
+    user = identities.get(key, version and (lambda u: u.version >= version))
+    if user is not None:
+        return user
+
+    generation = identities.generation
+    user = user_get_by_id(session, id)
+    if user is not None:
+        # Keep the user from being expired by the commits of the session
+        session.expunge(user)
+        identities.put(key, user, generation)
+    return user
 
 
 def user_create(session, user):
@@ -50,6 +644,7 @@ def user_create(session, user):
 
 def user_update(session, user):
     if session and user:
+        _invalidate_identity(session, user)
         session.merge(user)
 
 
@@ -70,10 +665,24 @@ def user_get_by_username(session, username):
 
 
 def user_delete(session, user):
+    """
+    Delete a user. The user's categories and items are removed by the
+    database through ON DELETE CASCADE foreign keys.
+    """
     if session and user:
+        _invalidate_identity(session, user)
         session.delete(user)
 
 
+def user_has_data(session, user):
+    if session and user:
+        for model in (models.Category, models.Item):
+            query = session.query(model).filter(model.user_id == user.id)
+            if session.query(query.exists()).scalar():
+                return True
+    return False
+
+
 def user_delete_by_username(session, username):
     user = user_get_by_username(session, username)
     user_delete(session, user)
@@ -92,46 +701,159 @@ def category_update(session, categories):
             session.merge(category)
 
 
-def category_getall(session, user, filter_ids=None):
+def category_create_bulk(session, user, rows, batch_size=BULK_BATCH_SIZE):
+    """
+    Insert categories with batched executemany() statements. Must be called
+    in a transaction.
+
+    :param session: SQLAlchemy session
+    :param user: owner of the new categories
+    :param rows: list of dictionaries with the (encrypted) category columns
+    :param batch_size: number of rows per executemany() call
+
+    :returns: list of generated category ids, in the same order as `rows`
+    """
+    return _create_bulk(session, user, models.Category, rows, batch_size)
+
+
+def category_update_bulk(session, user, rows, batch_size=BULK_BATCH_SIZE):
+    """
+    Update categories with batched executemany() UPDATE statements scoped by
+    the owner. Must be called in a transaction.
+
+    :param session: SQLAlchemy session
+    :param user: owner of the categories
+    :param rows: list of dictionaries with the category `id` and the
+    (encrypted) columns to update
+    :param batch_size: number of rows per executemany() call
+
+    :returns: list of ids which do not exist or belong to another user
+    """
+    return _update_bulk(session, user, models.Category, rows, batch_size)
+
+
+def category_getall(session, user, filter_ids=None, with_items=False,
+                    since=None):
+    """
+    Fetch the user's categories ordered by sort_id.
+
+    :param session: SQLAlchemy session
+    :param user: owner of the categories
+    :param filter_ids: if specified, only fetch categories with these ids
+    :param with_items: also load the items of the categories, with one
+    additional query
+    :param since: if specified, only fetch categories created or updated at
+    or after this time
+
+    :returns: list of categories
+    """
     if session and user:
-        session.add(user)
+        query = session.query(models.Category).filter(
+            models.Category.user_id == user.id).order_by(
+            models.Category.sort_id)
         if filter_ids:
-            query = session.query(models.Category).filter(
-                models.Category.user_id == user.id).filter(
-                models.Category.id.in_(filter_ids)).order_by(
-                models.Category.sort_id).options(
-                subqueryload(models.Category.items))
-        else:
-            query = session.query(models.Category).filter(
-                models.Category.user_id == user.id).order_by(
-                models.Category.sort_id).options(
-                subqueryload(models.Category.items))
+            query = query.filter(models.Category.id.in_(filter_ids))
+        if since:
+            query = query.filter(models.Category.updated_at >= since)
+        if with_items:
+            query = query.options(subqueryload(models.Category.items))
         return query.all()
 
 
+def _delete_loaded(session, rows, delete):
+    """
+    Delete loaded rows through a set based `*_delete_by_id` function, so
+    that their tombstones are recorded, one call per owner.
+
+    :param delete: function taking the session, the owner and the row ids
+    """
+    ids = OrderedDict()
+    for row in rows:
+        ids.setdefault(row.user_id, []).append(row.id)
+    for user_id, row_ids in ids.items():
+        delete(session, session.query(models.User).get(user_id), row_ids)
+    for row in rows:
+        if row in session:
+            session.expunge(row)
+
+
 def category_delete(session, categories, cascade):
     if session:
-        if cascade:
-            for category in categories:
-                for item in category.items:
-                    session.delete(item)
-                session.delete(category)
-        else:
-            for category in categories:
-                for item in category.items:
-                    item.category_id = None
-                    session.add(item)
-                session.delete(category)
+        _delete_loaded(session, categories,
+                       lambda session, user, ids: category_delete_by_id(
+                           session, user, ids, cascade))
+
+
+def _record_deletions(session, user, kind, query, model):
+    """
+    Insert a tombstone for every row matched by `query` with a single
+    INSERT ... SELECT statement. Must run before the rows are deleted.
+    """
+    select = query.with_entities(
+        literal(user.id), literal(kind), model.id,
+        literal(datetime.now(), DateTime)).statement
+    session.execute(models.Tombstone.__table__.insert().from_select(
+        ['user_id', 'kind', 'record_id', 'deleted_at'], select))
+
+
+def _category_delete(session, user, query, item_query, cascade):
+    if cascade:
+        _record_deletions(session, user, models.Tombstone.ITEM,
+                          item_query, models.Item)
+        items = item_query.delete(synchronize_session=False)
+    else:
+        items = item_query.update({models.Item.category_id: None},
+                                  synchronize_session=False)
+    _record_deletions(session, user, models.Tombstone.CATEGORY,
+                      query, models.Category)
+    return query.delete(synchronize_session=False), items
 
 
 def category_delete_by_id(session, user, filter_ids, cascade):
-    categories = category_getall(session, user, filter_ids)
-    category_delete(session, categories, cascade)
+    """
+    Delete categories with set based statements, without loading them.
+
+    :param session: SQLAlchemy session
+    :param user: owner of the categories
+    :param filter_ids: ids of the categories to delete
+    :param cascade: delete the items in the categories if True, otherwise
+    only clear their category
+
+    :returns: tuple of deleted categories count and deleted or updated
+    items count
+    """
+    categories = items = 0
+    if session and user and filter_ids:
+        for chunk in _chunks(filter_ids):
+            query = session.query(models.Category).filter(
+                models.Category.user_id == user.id).filter(
+                models.Category.id.in_(chunk))
+            item_query = session.query(models.Item).filter(
+                models.Item.user_id == user.id).filter(
+                models.Item.category_id.in_(chunk))
+            deleted = _category_delete(session, user, query,
+                                       item_query, cascade)
+            categories += deleted[0]
+            items += deleted[1]
+    return categories, items
 
 
 def category_delete_all(session, user, cascade):
-    categories = category_getall(session, user)
-    category_delete(session, categories, cascade)
+    """
+    Delete all of the user's categories with set based statements.
+
+    :returns: tuple of deleted categories count and deleted or updated
+    items count
+    """
+    if session and user:
+        query = session.query(models.Category).filter(
+            models.Category.user_id == user.id)
+        item_query = session.query(models.Item).filter(
+            models.Item.user_id == user.id).filter(
+            models.Item.category_id.isnot(None))
+        return _category_delete(session, user, query, item_query,
+                                cascade)
+    return 0, 0
 
 
 def item_create(session, items):
@@ -141,37 +863,236 @@ def item_create(session, items):
         return items
 
 
+def item_create_bulk(session, user, rows, batch_size=BULK_BATCH_SIZE):
+    """
+    Insert items with batched executemany() statements instead of building
+    and flushing one ORM object per row. Must be called in a transaction.
+
+    :param session: SQLAlchemy session
+    :param user: owner of the new items
+    :param rows: list of dictionaries with the (encrypted) item columns, all
+    with the same set of keys
+    :param batch_size: number of rows per executemany() call
+
+    :returns: list of generated item ids, in the same order as `rows`
+    """
+    return _create_bulk(session, user, models.Item, rows, batch_size)
+
+
 def item_update(session, items):
     if session:
         for item in items:
             session.merge(item)
 
 
-def item_getall(session, user, filter_ids=None):
+def item_update_bulk(session, user, rows, batch_size=BULK_BATCH_SIZE):
+    """
+    Update items with batched executemany() UPDATE statements scoped by the
+    owner, without loading the rows first. Must be called in a transaction,
+    which the caller should roll back if any rows did not match.
+
+    :param session: SQLAlchemy session
+    :param user: owner of the items
+    :param rows: list of dictionaries with the item `id` and the (encrypted)
+    columns to update, all with the same set of keys
+    :param batch_size: number of rows per executemany() call
+
+    :returns: list of ids which do not exist or belong to another user
+    """
+    return _update_bulk(session, user, models.Item, rows, batch_size)
+
+
+def _keyset(query, model, after):
+    """
+    Restrict an ordered query to the rows past a (sort_id, id) position.
+
+    The redundant `sort_id >= value` term lets the database turn the
+    predicate into a range scan of the (user_id, sort_id) index.
+    """
+    sort_id, last_id = after
+    return query.filter(model.sort_id >= sort_id).filter(
+        or_(model.sort_id > sort_id, model.id > last_id))
+
+
+def item_getall(session, user, filter_ids=None, limit=None, after=None,
+                since=None, with_category=True, fields=None):
+    """
+    Fetch the user's items ordered by (sort_id, id).
+
+    :param session: SQLAlchemy session
+    :param user: owner of the items
+    :param filter_ids: if specified, only fetch items with these ids
+    :param limit: maximum number of items to return
+    :param after: (sort_id, id) tuple of the last item of the previous
+    page, only items following it are returned
+    :param since: if specified, only fetch items created or updated at or
+    after this time
+    :param with_category: also load the category of each item, joined into
+    the same query
+    :param fields: if specified, only load the encrypted columns needed to
+    extract these fields, see `Item.deferred_columns`
+
+    :returns: list of items
+    """
     if session and user:
-        session.add(user)
+        query = session.query(
+            models.Item).filter(
+            models.Item.user_id == user.id).order_by(
+            models.Item.sort_id, models.Item.id)
+        if fields is not None:
+            query = query.options(*[
+                defer(getattr(models.Item, column))
+                for column in models.Item.deferred_columns(fields)])
         if filter_ids:
-            query = session.query(
-                models.Item).order_by(
-                models.Item.sort_id).filter(
-                models.Item.id.in_(filter_ids)).filter(
-                models.Item.user_id == user.id).outerjoin(
-                models.Category).options(
-                subqueryload(models.Item.category))
+            query = query.filter(models.Item.id.in_(filter_ids))
+        if since:
+            query = query.filter(models.Item.updated_at >= since)
+        if after:
+            query = _keyset(query, models.Item, after)
+        if limit:
+            query = query.limit(limit)
+        if with_category:
+            query = query.options(joinedload(models.Item.category))
+        return query.all()
 
-        else:
-            query = session.query(
-                models.Item).order_by(
-                models.Item.sort_id).filter(
-                models.Item.user_id == user.id).outerjoin(
-                models.Category).options(
-                subqueryload(models.Item.category))
+
+def item_getall_legacy(session, user, limit):
+    """
+    Fetch the user's items which are not stored in the current record
+    format yet, with their fields encrypted one by one or with a version 1
+    record holding all of them.
+
+    :param session: SQLAlchemy session
+    :param user: owner of the items
+    :param limit: maximum number of items to return
+
+    :returns: list of items ordered by id
+    """
+    if session and user:
+        query = session.query(
+            models.Item).filter(
+            models.Item.user_id == user.id).filter(
+            models.Item.details.is_(None)).order_by(
+            models.Item.id).limit(limit)
         return query.all()
 
 
+def _rewrite_bulk(session, user, model, records, rows, *conditions):
+    """
+    Store rows re-encrypted from records read earlier, keeping their update
+    time so that syncing clients do not fetch them again. Records updated
+    since they were read, or no longer matching `conditions`, are left
+    alone, since their new contents are not part of the rows.
+
+    :returns: number of rewritten records
+    """
+    if not (session and user and records):
+        return 0
+
+    table = model.__table__
+    stmt = table.update().where(
+        table.c.id == bindparam('_id')).where(
+        table.c.user_id == bindparam('_user_id')).where(
+        table.c.updated_at == bindparam('_updated_at'))
+    for condition in conditions:
+        stmt = stmt.where(condition)
+    batch = []
+    for record, row in zip(records, rows):
+        params = dict(row, updated_at=record.updated_at)
+        params.update({'_id': record.id, '_user_id': user.id,
+                       '_updated_at': record.updated_at})
+        batch.append(params)
+    return session.execute(stmt, batch).rowcount
+
+
+def item_upgrade_bulk(session, user, items, rows):
+    """
+    Store items converted to the current record format by
+    `Item.upgrade_many`, see `_rewrite_bulk`.
+
+    :param session: SQLAlchemy session
+    :param user: owner of the items
+    :param items: Item models the rows were converted from
+    :param rows: list of dictionaries of the new encrypted item columns
+
+    :returns: number of converted items
+    """
+    return _rewrite_bulk(session, user, models.Item, items, rows,
+                         models.Item.__table__.c.details.is_(None))
+
+
+def _getall_stale_key(session, user, model, version, limit, after):
+    if session and user:
+        query = session.query(model).filter(
+            model.user_id == user.id).filter(
+            model.key_version < version).filter(
+            model.id > after).order_by(model.id).limit(limit)
+        return query.all()
+
+
+def _count_stale_key(session, user, model, version):
+    return session.query(func.count(model.id)).filter(
+        model.user_id == user.id).filter(
+        model.key_version < version).scalar()
+
+
+def item_getall_stale_key(session, user, version, limit, after=0):
+    """
+    Fetch the user's items encrypted with a data key older than `version`,
+    e.g. while the data key is rotated.
+
+    :param session: SQLAlchemy session
+    :param user: owner of the items
+    :param version: current version of the user's data key
+    :param limit: maximum number of items to return
+    :param after: only fetch items with a greater id
+
+    :returns: list of items ordered by id
+    """
+    return _getall_stale_key(session, user, models.Item, version, limit,
+                             after)
+
+
+def item_recrypt_bulk(session, user, items, rows):
+    """
+    Store items re-encrypted with the current data key by
+    `Item.upgrade_many`, see `_rewrite_bulk`.
+
+    :returns: number of re-encrypted items
+    """
+    return _rewrite_bulk(session, user, models.Item, items, rows)
+
+
+def category_getall_stale_key(session, user, version, limit, after=0):
+    """
+    Fetch the user's categories encrypted with a data key older than
+    `version`, see `item_getall_stale_key`.
+    """
+    return _getall_stale_key(session, user, models.Category, version, limit,
+                             after)
+
+
+def category_recrypt_bulk(session, user, categories, rows):
+    """
+    Store categories re-encrypted with the current data key by
+    `Category.upgrade_many`, see `_rewrite_bulk`.
+
+    :returns: number of re-encrypted categories
+    """
+    return _rewrite_bulk(session, user, models.Category, categories, rows)
+
+
+def user_count_stale_key(session, user, version):
+    """
+    :returns: number of the user's categories and items encrypted with a
+    data key older than `version`
+    """
+    return (_count_stale_key(session, user, models.Category, version) +
+            _count_stale_key(session, user, models.Item, version))
+
+
 def item_getall_orphan(session, user):
     if session and user:
-        session.add(user)
         query = session.query(
             models.Item).order_by(
             models.Item.sort_id).filter(
@@ -182,16 +1103,108 @@ def item_getall_orphan(session, user):
 
 def item_delete(session, items):
     if session:
-        for item in items:
-            session.delete(item)
+        _delete_loaded(session, items, item_delete_by_id)
 
 
 def item_delete_by_id(session, user, filter_ids):
-    if filter_ids:
-        items = item_getall(session, user, filter_ids)
-        item_delete(session, items)
+    """
+    Delete items with set based statements, without loading them.
+
+    :param session: SQLAlchemy session
+    :param user: owner of the items
+    :param filter_ids: ids of the items to delete
+
+    :returns: number of deleted items
+    """
+    deleted = 0
+    if session and user and filter_ids:
+        for chunk in _chunks(filter_ids):
+            query = session.query(models.Item).filter(
+                models.Item.user_id == user.id).filter(
+                models.Item.id.in_(chunk))
+            _record_deletions(session, user, models.Tombstone.ITEM,
+                              query, models.Item)
+            deleted += query.delete(synchronize_session=False)
+    return deleted
 
 
 def item_delete_all(session, user):
-    items = item_getall(session, user)
-    item_delete(session, items)
+    """
+    Delete all of the user's items with a single statement.
+
+    :returns: number of deleted items
+    """
+    if session and user:
+        query = session.query(models.Item).filter(
+            models.Item.user_id == user.id)
+        _record_deletions(session, user, models.Tombstone.ITEM,
+                          query, models.Item)
+        return query.delete(synchronize_session=False)
+    return 0
+
+
+def tombstone_getall(session, user, since):
+    """
+    Fetch the records of the user's items and categories deleted at or
+    after `since`.
+
+    :returns: list of (kind, record id) tuples
+    """
+    if session and user:
+        query = session.query(
+            models.Tombstone.kind, models.Tombstone.record_id).filter(
+            models.Tombstone.user_id == user.id).filter(
+            models.Tombstone.deleted_at >= since).order_by(
+            models.Tombstone.id)
+        return query.all()
+    return []
+
+
+def tombstone_delete_before(session, before):
+    """
+    Prune the deletion records of all users older than `before`.
+
+    :returns: number of deleted records
+    """
+    if session:
+        return session.query(models.Tombstone).filter(
+            models.Tombstone.deleted_at < before).delete(
+            synchronize_session=False)
+    return 0
+
+
+def user_stats(session, user):
+    """
+    Aggregate the size of a user's vault without loading or decrypting any
+    of the rows.
+
+    :param session: SQLAlchemy session
+    :param user: owner of the data
+
+    :returns: tuple of a list of (category id, item count) tuples ordered
+    by sort_id, the number of items without a category and the time of the
+    last change, None if the user never stored anything
+    """
+    if not (session and user):
+        return [], 0, None
+
+    counts = dict(session.query(
+        models.Item.category_id, func.count(models.Item.id)).filter(
+        models.Item.user_id == user.id).group_by(
+        models.Item.category_id))
+    categories = session.query(models.Category.id).filter(
+        models.Category.user_id == user.id).order_by(
+        models.Category.sort_id, models.Category.id)
+    category_counts = [(row.id, counts.get(row.id, 0)) for row in categories]
+
+    # Deletions count as changes too
+    last_changes = session.query(
+        session.query(func.max(models.Item.updated_at)).filter(
+            models.Item.user_id == user.id).as_scalar(),
+        session.query(func.max(models.Category.updated_at)).filter(
+            models.Category.user_id == user.id).as_scalar(),
+        session.query(func.max(models.Tombstone.deleted_at)).filter(
+            models.Tombstone.user_id == user.id).as_scalar()).one()
+    last_changes = [change for change in last_changes if change is not None]
+    return (category_counts, counts.get(None, 0),
+            max(last_changes) if last_changes else None)
@@ -0,0 +1,276 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""asyncio variants of the `opp.db.api` functions.
+
+SQLAlchemy and the database drivers block, so the functions run in a
+dedicated thread pool sized after the connection pool, leaving the event
+loop free to serve other requests meanwhile. A worker thread is only taken
+for the duration of a single call. Every call uses the scoped session of its
+worker thread and removes it before returning, so ORM objects come back
+detached with their loaded attributes.
+
+Readers run in a read transaction of the read only session, or of the
+replica session with `replica=True`, see `api.get_read_session`. Writers run
+through `api.run_write`, so they are retried while the database is locked.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+
+from opp.common import opp_config
+from opp.db import api
+
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_executor(conf=None):
+    """
+    Return the process wide executor running the blocking database work,
+    creating it on first use. Its size is set by the `async_db_workers`
+    option and defaults to the number of connections the pool can open.
+
+    :param conf: OppConfig instance
+
+    :returns: ThreadPoolExecutor
+    """
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        with _EXECUTOR_LOCK:
+            if _EXECUTOR is None:
+                conf = conf or opp_config.OppConfig()
+                workers = conf.getint('async_db_workers') or (
+                    conf.getint('db_pool_size', 5) +
+                    conf.getint('db_max_overflow', 10))
+                _EXECUTOR = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix='opp-db')
+    return _EXECUTOR
+
+
+def shutdown_executor():
+    """Wait for the running database work and stop the executor."""
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is not None:
+            _EXECUTOR.shutdown()
+            _EXECUTOR = None
+
+
+def _in_session(work, readonly, conf):
+    session = api.get_scoped_session(conf, readonly=readonly)
+    try:
+        return work(session)
+    finally:
+        session.remove()
+
+
+async def run(work, readonly=False, conf=None):
+    """
+    Call `work(session)` in the database executor.
+
+    :param work: callable taking the session of the worker thread
+    :param readonly: use the session serving read only requests
+    :param conf: OppConfig instance
+
+    :returns: return value of `work`
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(conf),
+        functools.partial(_in_session, work, readonly, conf))
+
+
+def _read(work, replica, user, write_token, conf):
+    primary = api.get_scoped_session(conf, readonly=True)
+    session = primary
+    if replica:
+        session = api.get_read_session(primary, user, write_token)
+    try:
+        with session.begin():
+            result = work(session)
+            # Detach the rows before the commit expires them
+            session.expunge_all()
+        return result
+    finally:
+        session.remove()
+        if session is not primary:
+            primary.remove()
+
+
+async def _run_read(work, replica=False, user=None, write_token=None,
+                    conf=None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(conf),
+        functools.partial(_read, work, replica, user, write_token, conf))
+
+
+async def _run_write(work, conf=None):
+    return await run(
+        lambda session: api.run_write(session, lambda: work(session)),
+        conf=conf)
+
+
+async def user_get_by_username(username, conf=None):
+    """
+    :param username: name of the user
+    :param conf: OppConfig instance
+
+    :returns: User or None if no such user exists
+    """
+    return await _run_read(
+        lambda session: api.user_get_by_username(session, username),
+        conf=conf)
+
+
+async def user_get_cached(id, version=None, conf=None):
+    """
+    Look up the user authenticated by a request, see `api.user_get_cached`.
+
+    :param id: user id
+    :param version: minimum acceptable user version, e.g. from the JWT
+    :param conf: OppConfig instance
+
+    :returns: User or None if no such user exists
+    """
+    return await _run_read(
+        lambda session: api.user_get_cached(session, id, version),
+        conf=conf)
+
+
+async def category_getall(user, filter_ids=None, with_items=False,
+                          since=None, replica=False, write_token=None,
+                          conf=None):
+    """
+    See `api.category_getall`.
+
+    :param replica: read from the replica unless `write_token` shows a
+    write of the user just before
+    :param write_token: token of the user's last write
+    :param conf: OppConfig instance
+
+    :returns: list of Category
+    """
+    return await _run_read(
+        lambda session: api.category_getall(
+            session, user, filter_ids, with_items=with_items, since=since),
+        replica, user, write_token, conf)
+
+
+async def item_getall(user, filter_ids=None, limit=None, after=None,
+                      since=None, with_category=True, fields=None,
+                      replica=False, write_token=None, conf=None):
+    """
+    See `api.item_getall`.
+
+    :param replica: read from the replica unless `write_token` shows a
+    write of the user just before
+    :param write_token: token of the user's last write
+    :param conf: OppConfig instance
+
+    :returns: list of Item
+    """
+    return await _run_read(
+        lambda session: api.item_getall(
+            session, user, filter_ids, limit=limit, after=after, since=since,
+            with_category=with_category, fields=fields),
+        replica, user, write_token, conf)
+
+
+async def tombstone_getall(user, since, replica=False, write_token=None,
+                           conf=None):
+    """
+    See `api.tombstone_getall`.
+
+    :param replica: read from the replica unless `write_token` shows a
+    write of the user just before
+    :param write_token: token of the user's last write
+    :param conf: OppConfig instance
+
+    :returns: list of (kind, record id) tuples
+    """
+    return await _run_read(
+        lambda session: api.tombstone_getall(session, user, since),
+        replica, user, write_token, conf)
+
+
+async def category_create_bulk(user, rows, conf=None):
+    """
+    See `api.category_create_bulk`.
+
+    :returns: list of the ids of the new categories, in the order of `rows`
+    """
+    return await _run_write(
+        lambda session: api.category_create_bulk(session, user, rows),
+        conf)
+
+
+async def category_update_bulk(user, rows, conf=None):
+    """
+    See `api.category_update_bulk`.
+
+    :returns: list of the ids of `rows` not matching a category of the user
+    """
+    return await _run_write(
+        lambda session: api.category_update_bulk(session, user, rows),
+        conf)
+
+
+async def category_delete_by_id(user, filter_ids, cascade, conf=None):
+    """
+    See `api.category_delete_by_id`.
+
+    :returns: tuple of the number of deleted categories and the number of
+    deleted or updated items
+    """
+    return await _run_write(
+        lambda session: api.category_delete_by_id(session, user, filter_ids,
+                                                  cascade),
+        conf)
+
+
+async def item_create_bulk(user, rows, conf=None):
+    """
+    See `api.item_create_bulk`.
+
+    :returns: list of the ids of the new items, in the order of `rows`
+    """
+    return await _run_write(
+        lambda session: api.item_create_bulk(session, user, rows), conf)
+
+
+async def item_update_bulk(user, rows, conf=None):
+    """
+    See `api.item_update_bulk`.
+
+    :returns: list of the ids of `rows` not matching an item of the user
+    """
+    return await _run_write(
+        lambda session: api.item_update_bulk(session, user, rows), conf)
+
+
+async def item_delete_by_id(user, filter_ids, conf=None):
+    """
+    See `api.item_delete_by_id`.
+
+    :returns: number of deleted items
+    """
+    return await _run_write(
+        lambda session: api.item_delete_by_id(session, user, filter_ids),
+        conf)
@@ -0,0 +1,382 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In place schema upgrades for databases created by older versions.
+
+Every step compares the live schema with `opp.db.models` and only changes
+what differs, so running the upgrade repeatedly is harmless.
+"""
+
+from sqlalchemy import (Column, Index, Integer, LargeBinary, MetaData, Table,
+                        and_, bindparam, func, inspect, or_, select)
+from sqlalchemy.schema import (AddConstraint, CreateColumn, CreateIndex,
+                               CreateTable, DropConstraint)
+from sqlalchemy.sql import sqltypes
+
+from opp.db import models
+
+
+def _is_sqlite(engine):
+    return engine.dialect.name == 'sqlite'
+
+
+def _ondelete(value):
+    value = (value or "NO ACTION").upper()
+    return "NO ACTION" if value == "RESTRICT" else value
+
+
+def _live_foreign_keys(engine, table_name):
+    """
+    Fetch the foreign keys of a table from the database.
+
+    :returns: dictionary of (constraint name, ON DELETE action) tuples keyed
+    by constrained column name
+    """
+    fks = {}
+    if _is_sqlite(engine):
+        # The SQLite inspector does not report ON DELETE actions
+        rows = engine.execute("PRAGMA foreign_key_list(%s)" % table_name)
+        for row in rows:
+            fks[row['from']] = (None, _ondelete(row['on_delete']))
+    else:
+        for fk in inspect(engine).get_foreign_keys(table_name):
+            column = fk['constrained_columns'][0]
+            ondelete = fk.get('options', {}).get('ondelete')
+            fks[column] = (fk['name'], _ondelete(ondelete))
+    return fks
+
+
+def _outdated_foreign_keys(engine, table):
+    """
+    Compare the foreign keys of a model table with the live ones.
+
+    :returns: list of (model constraint, live constraint name) tuples for
+    the foreign keys whose ON DELETE action differs
+    """
+    live = _live_foreign_keys(engine, table.name)
+    outdated = []
+    for constraint in table.foreign_key_constraints:
+        column = constraint.column_keys[0]
+        if column not in live:
+            continue
+        name, ondelete = live[column]
+        if ondelete != _ondelete(constraint.ondelete):
+            outdated.append((constraint, name))
+    return outdated
+
+
+def _create_ddl(engine, element):
+    if isinstance(element, Index):
+        return CreateIndex(element).compile(dialect=engine.dialect)
+    return CreateTable(element).compile(dialect=engine.dialect)
+
+
+def _rebuild_sqlite_table(engine, table):
+    """
+    Recreate a SQLite table from its model definition and copy the data
+    over, following the procedure from the SQLite ALTER TABLE documentation.
+    SQLite cannot alter constraints of existing tables.
+    """
+    # The referenced tables are needed to render the foreign keys
+    metadata = MetaData()
+    for other in models.Base.metadata.sorted_tables:
+        if other is not table:
+            other.tometadata(metadata)
+    tmp_table = table.tometadata(metadata, name='_new_%s' % table.name)
+    for index in list(tmp_table.indexes):
+        tmp_table.indexes.remove(index)
+    live = set(c['name'] for c in inspect(engine).get_columns(table.name))
+    columns = ", ".join(c.name for c in table.columns if c.name in live)
+
+    raw = engine.raw_connection()
+    try:
+        dbapi_connection = raw.connection
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=OFF")
+        try:
+            cursor.execute("BEGIN")
+            for statement in (
+                    str(_create_ddl(engine, tmp_table)),
+                    "INSERT INTO %s (%s) SELECT %s FROM %s" % (
+                        tmp_table.name, columns, columns, table.name),
+                    "DROP TABLE %s" % table.name,
+                    "ALTER TABLE %s RENAME TO %s" % (tmp_table.name,
+                                                     table.name)):
+                cursor.execute(statement)
+            for index in table.indexes:
+                cursor.execute(str(_create_ddl(engine, index)))
+            cursor.execute("PRAGMA foreign_key_check")
+            if cursor.fetchall():
+                raise RuntimeError("Foreign key violations in table '%s'" %
+                                   table.name)
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.execute("PRAGMA foreign_keys=ON")
+            cursor.close()
+            dbapi_connection.isolation_level = isolation_level
+    finally:
+        raw.close()
+
+
+def upgrade_columns(engine):
+    """
+    Add the model columns which are missing from existing tables. New
+    columns either allow NULL or have a server default filling in the
+    existing rows.
+
+    :returns: list of added "table.column" names
+    """
+    added = []
+    inspector = inspect(engine)
+    for table in models.Base.metadata.sorted_tables:
+        live = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in live:
+                continue
+            ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            engine.execute("ALTER TABLE %s ADD COLUMN %s" % (table.name, ddl))
+            added.append("%s.%s" % (table.name, column.name))
+    return added
+
+
+def upgrade_foreign_keys(engine):
+    """
+    Bring the ON DELETE actions of existing foreign keys in line with the
+    models, so that deleting a user cascades to all of its data.
+
+    :returns: list of upgraded table names
+    """
+    upgraded = []
+    for table in models.Base.metadata.sorted_tables:
+        outdated = _outdated_foreign_keys(engine, table)
+        if not outdated:
+            continue
+        if _is_sqlite(engine):
+            _rebuild_sqlite_table(engine, table)
+        else:
+            with engine.begin() as conn:
+                for constraint, name in outdated:
+                    # Reuse the live constraint name for the new definition
+                    constraint.name = name
+                    try:
+                        if name:
+                            conn.execute(DropConstraint(constraint))
+                        conn.execute(AddConstraint(constraint))
+                    finally:
+                        constraint.name = None
+        upgraded.append(table.name)
+    return upgraded
+
+
+def _create_index_online(engine, index):
+    """
+    Create an index while letting the application keep writing to the
+    table, where the database supports it.
+    """
+    ddl = str(_create_ddl(engine, index))
+    if engine.dialect.name == 'postgresql':
+        # CONCURRENTLY cannot run inside a transaction block
+        ddl = ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+        conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    else:
+        if engine.dialect.name == 'mysql':
+            ddl += " ALGORITHM=INPLACE LOCK=NONE"
+        conn = engine.connect()
+    try:
+        conn.execute(ddl)
+    finally:
+        conn.close()
+
+
+def upgrade_indexes(engine):
+    """
+    Create the model indexes which are missing from the database.
+
+    :returns: list of created index names
+    """
+    created = []
+    inspector = inspect(engine)
+    for table in models.Base.metadata.sorted_tables:
+        live = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in live:
+                _create_index_online(engine, index)
+                created.append(index.name)
+    if created and _is_sqlite(engine):
+        # Refresh the statistics used by the query planner
+        engine.execute("ANALYZE")
+    return created
+
+
+def _decode_sqlite_column(engine, column, batch_size):
+    """
+    Replace the base64 text values of a SQLite column with the bytes they
+    encode, one short transaction per batch. SQLite keeps BLOB values in
+    columns declared as text, so the declared type is left alone.
+
+    :returns: number of converted values
+    """
+    table = column.table
+    # Selecting through the Ciphertext type decodes the values
+    query = select([table.c.id, column]).where(
+        func.typeof(column) == 'text').limit(batch_size)
+    converted = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(query).fetchall()
+            for row_id, value in rows:
+                conn.execute(table.update().where(
+                    table.c.id == row_id).values({column.name: value}))
+        converted += len(rows)
+        if len(rows) < batch_size:
+            return converted
+
+
+# Suffix of the binary columns MySQL values are decoded into before they
+# replace the base64 text columns
+SHADOW_SUFFIX = "_bin"
+
+
+def _shadow_table(table, names):
+    """
+    :returns: Table reading the text columns `names` of `table` through the
+    Ciphertext type, along with their binary shadow columns
+    """
+    return Table(table.name, MetaData(),
+                 Column('id', Integer, primary_key=True),
+                 *([Column(name, models.Ciphertext) for name in names] +
+                   [Column(name + SHADOW_SUFFIX, LargeBinary)
+                    for name in names]))
+
+
+def _fill_shadow_columns(engine, table, names, batch_size):
+    """
+    Copy the decoded values of base64 text columns to their shadow columns,
+    one short transaction per batch of rows. Rows whose shadow columns are
+    already filled are skipped, so that an interrupted run resumes where it
+    stopped.
+    """
+    shadow = _shadow_table(table, names)
+    pending = or_(*[and_(shadow.c[name + SHADOW_SUFFIX].is_(None),
+                         shadow.c[name].isnot(None)) for name in names])
+    query = select([shadow.c.id] + [shadow.c[name] for name in names]).where(
+        and_(shadow.c.id > bindparam('last_id'), pending)).order_by(
+            shadow.c.id).limit(batch_size)
+    update = shadow.update().where(shadow.c.id == bindparam('row_id')).values(
+        dict((name + SHADOW_SUFFIX, bindparam(name + SHADOW_SUFFIX))
+             for name in names))
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(query, last_id=last_id).fetchall()
+            if rows:
+                conn.execute(update, [dict(
+                    [('row_id', row['id'])] +
+                    [(name + SHADOW_SUFFIX, row[name]) for name in names])
+                    for row in rows])
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1]['id']
+
+
+def _swap_shadow_columns(engine, table, columns):
+    """
+    Replace text columns with their filled shadow columns, in a single
+    statement so that the table never holds a mix of both.
+    """
+    engine.execute("ALTER TABLE %s %s" % (table.name, ", ".join(
+        "DROP COLUMN %s, CHANGE COLUMN %s%s %s %s%s" % (
+            column.name, column.name, SHADOW_SUFFIX, column.name,
+            column.type.compile(dialect=engine.dialect),
+            "" if column.nullable else " NOT NULL")
+        for column in columns)))
+
+
+def _decode_mysql_columns(engine, table, columns, live, batch_size):
+    """
+    Convert base64 text columns of a MySQL table to binary columns. The
+    values are decoded into shadow columns first, the text columns are only
+    replaced once every row is converted, so an interrupted run leaves them
+    in place for the next run to finish.
+    """
+    names = [column.name for column in columns]
+    for name in names:
+        if name + SHADOW_SUFFIX not in live:
+            engine.execute("ALTER TABLE %s ADD COLUMN %s%s %s" % (
+                table.name, name, SHADOW_SUFFIX,
+                LargeBinary().compile(dialect=engine.dialect)))
+    _fill_shadow_columns(engine, table, names, batch_size)
+    _swap_shadow_columns(engine, table, columns)
+
+
+def upgrade_ciphertext_columns(engine, batch_size=1000):
+    """
+    Convert the columns of encrypted values from base64 text to the raw
+    bytes stored by `models.Ciphertext`.
+
+    :returns: list of converted "table.column" names
+    """
+    converted = []
+    inspector = inspect(engine)
+    for table in models.Base.metadata.sorted_tables:
+        columns = [column for column in table.columns
+                   if isinstance(column.type, models.Ciphertext)]
+        if not columns:
+            continue
+        if _is_sqlite(engine):
+            for column in columns:
+                if _decode_sqlite_column(engine, column, batch_size):
+                    converted.append("%s.%s" % (table.name, column.name))
+            continue
+
+        live = dict((c['name'], c['type'])
+                    for c in inspector.get_columns(table.name))
+        columns = [column for column in columns
+                   if not isinstance(live[column.name], sqltypes._Binary)]
+        if not columns:
+            continue
+        names = [column.name for column in columns]
+        if engine.dialect.name == 'postgresql':
+            engine.execute("ALTER TABLE %s %s" % (table.name, ", ".join(
+                "ALTER COLUMN %s TYPE BYTEA USING decode(%s, 'base64')" %
+                (name, name) for name in names)))
+        else:
+            _decode_mysql_columns(engine, table, columns, live, batch_size)
+        converted.extend("%s.%s" % (table.name, name) for name in names)
+    return converted
+
+
+def upgrade(engine):
+    """
+    Run all upgrade steps against the database.
+
+    :returns: list of human readable descriptions of the applied changes
+    """
+    changes = []
+    models.Base.metadata.create_all(engine)
+    for column in upgrade_columns(engine):
+        changes.append("Added column '%s'" % column)
+    for table in upgrade_foreign_keys(engine):
+        changes.append("Updated foreign keys of table '%s'" % table)
+    for column in upgrade_ciphertext_columns(engine):
+        changes.append("Converted column '%s' to binary" % column)
+    for index in upgrade_indexes(engine):
+        changes.append("Created index '%s'" % index)
+    return changes
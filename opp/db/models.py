@@ -13,17 +13,70 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
 from datetime import datetime
+import json
 
-from sqlalchemy import (Column, DateTime, ForeignKey,
-                        Index, Integer, Sequence, String)
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer,
+                        LargeBinary, Sequence, String)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
+
+from opp.common import aescipher
 
 
 Base = declarative_base()
 
 
+class Ciphertext(TypeDecorator):
+    """
+    Raw IV and ciphertext bytes of an encrypted value.
+
+    Older versions stored the base64 encoding of these bytes in text
+    columns. Such values, left in place by SQLite until `opp-db upgrade`
+    converts them, are decoded when read.
+    """
+
+    impl = LargeBinary
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            if isinstance(value, str):
+                return base64.b64decode(value)
+            if value is not None:
+                return bytes(value)
+            return value
+        return process
+
+
+def _decrypt_many(cipher, rows, values):
+    """
+    Decrypt values of rows which may be encrypted with different versions
+    of the user's data key, with one batch per version. Large batches are
+    decrypted in parallel shards, see `aescipher.DecryptPool`.
+
+    :param cipher: cipher returned by `aescipher.get_data_cipher`
+    :param rows: Item or Category models
+    :param values: function returning the list of encrypted values of a row
+
+    :returns: list of the lists of decrypted values of each row
+    """
+    versions = {}
+    for index, row in enumerate(rows):
+        versions.setdefault(row.key_version, []).append(index)
+    decrypted = [None] * len(rows)
+    for version, indexes in versions.items():
+        encs = [values(rows[index]) for index in indexes]
+        plain = iter(aescipher.get_decrypt_pool().decrypt_many(
+            aescipher.get_version_cipher(cipher, version),
+            [enc for row_encs in encs for enc in row_encs], len(indexes),
+            binary=True))
+        for index, row_encs in zip(indexes, encs):
+            decrypted[index] = [next(plain) for enc in row_encs]
+    return decrypted
+
+
 class User(Base):
 
     __tablename__ = 'users'
@@ -33,94 +86,359 @@ class User(Base):
     username = Column(String(255), nullable=False, unique=True)
     password = Column(String(255), nullable=False)
     phrase_check = Column(String(255), nullable=False)
+    # Key derivation function of the passphrase and its base64 salt, see
+    # `aescipher.KDFS`. Users without one derive with a single SHA-256
+    kdf = Column(String(32), nullable=True, default=None)
+    kdf_salt = Column(String(64), nullable=True, default=None)
+    # Random key encrypting the user's data, wrapped by the passphrase
+    data_key = Column(String(255), nullable=True, default=None)
+    # Version of the data key, incremented by every rotation, and the key
+    # replacing it while a rotation is in progress
+    key_version = Column(Integer, nullable=False, default=1,
+                         server_default='1')
+    next_data_key = Column(String(255), nullable=True, default=None)
     created_at = Column(DateTime, default=lambda: datetime.now(),
                         nullable=False)
     updated_at = Column(DateTime, default=lambda: datetime.now(),
                         nullable=False, onupdate=lambda: datetime.now())
+    # Incremented by every update, so that copies of the user cached by
+    # other requests can tell they are outdated
+    version = Column(Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
 
 class Item(Base):
 
     __tablename__ = 'items'
     __table_args__ = (Index('category_id_idx', 'category_id'),
+                      Index('items_user_id_sort_id_idx', 'user_id', 'sort_id'),
+                      Index('items_user_id_category_id_idx',
+                            'user_id', 'category_id'),
+                      Index('items_user_id_updated_at_idx',
+                            'user_id', 'updated_at'),
                       {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'})
 
     id = Column(Integer, Sequence('item_id_seq'), primary_key=True)
     category_id = Column(Integer, Sequence('category_id_seq'),
-                         ForeignKey('categories.id'), default=None)
+                         ForeignKey('categories.id', ondelete='SET NULL'),
+                         default=None)
     user_id = Column(Integer, Sequence('user_id_seq'),
-                     ForeignKey('users.id'), nullable=False)
-    name = Column(String(255), nullable=True, default=None)
-    url = Column(String(2000), nullable=True, default=None)
-    account = Column(String(255), nullable=True, default=None)
-    username = Column(String(255), nullable=True, default=None)
-    password = Column(String(255), nullable=True, default=None)
-    blob = Column(String(4096), nullable=True, default=None)
+                     ForeignKey('users.id', ondelete='CASCADE'),
+                     nullable=False)
+    name = Column(Ciphertext, nullable=True, default=None)
+    url = Column(Ciphertext, nullable=True, default=None)
+    account = Column(Ciphertext, nullable=True, default=None)
+    username = Column(Ciphertext, nullable=True, default=None)
+    password = Column(Ciphertext, nullable=True, default=None)
+    blob = Column(Ciphertext, nullable=True, default=None)
+    # All of the above encrypted as records, see `encrypt_many`. Items
+    # written before the record format have their fields in the columns
+    # above and no record.
+    record = Column(Ciphertext, nullable=True, default=None)
+    details = Column(Ciphertext, nullable=True, default=None)
+    # Version of the user's data key the columns are encrypted with
+    key_version = Column(Integer, nullable=False, default=1,
+                         server_default='1')
     sort_id = Column(Integer, default=0)
     created_at = Column(DateTime, default=lambda: datetime.now(),
                         nullable=False)
     updated_at = Column(DateTime, default=lambda: datetime.now(),
                         nullable=False, onupdate=lambda: datetime.now())
 
-    category = relationship('Category')
-    user = relationship('User')
-
-    def extract(self, cipher, with_category=True):
-        item = {'id': self.id,
-                'name': cipher.decrypt(self.name),
-                'url': cipher.decrypt(self.url),
-                'account': cipher.decrypt(self.account),
-                'username': cipher.decrypt(self.username),
-                'password': cipher.decrypt(self.password),
-                'blob': cipher.decrypt(self.blob),
-                'sort_id': self.sort_id}
+    # Relationships must be loaded explicitly by the queries in `opp.db.api`
+    # instead of lazily with one query per row
+    category = relationship('Category', lazy='raise_on_sql')
+    user = relationship('User', lazy='raise_on_sql')
+
+    # Fields which are stored encrypted
+    SECRET_FIELDS = ('name', 'url', 'account', 'username', 'password', 'blob')
+
+    # Fields shown by list views, kept in `record`, while the others are
+    # kept in `details` and only loaded when asked for
+    SUMMARY_FIELDS = ('name', 'url')
+    DETAIL_FIELDS = ('account', 'username', 'password', 'blob')
+
+    # Format of the decrypted records: the version character followed by
+    # the JSON array of the field values. Version 1 records hold all of the
+    # SECRET_FIELDS and come without details, version 2 records hold the
+    # SUMMARY_FIELDS and version 2 details the DETAIL_FIELDS.
+    RECORD_VERSION = 2
+
+    @classmethod
+    def _encode_record(cls, item, fields):
+        values = [item[field] for field in fields]
+        for value in values:
+            if not isinstance(value, str):
+                raise TypeError("Item fields must be strings")
+        return chr(cls.RECORD_VERSION) + json.dumps(
+            values, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def encrypt_many(cls, items, cipher):
+        """
+        Encrypt the secret fields of each item into a summary record and a
+        details record.
+
+        :param items: list of dictionaries of plain text item fields
+        :param cipher: encryption cipher
+
+        :returns: list of dictionaries of the encrypted item columns
+        """
+        records = []
+        for item in items:
+            records.append(cls._encode_record(item, cls.SUMMARY_FIELDS))
+            records.append(cls._encode_record(item, cls.DETAIL_FIELDS))
+
+        records = iter(cipher.encrypt_many(records, binary=True))
+        rows = []
+        for record in records:
+            row = dict.fromkeys(cls.SECRET_FIELDS)
+            row['record'] = record
+            row['details'] = next(records)
+            row['key_version'] = cipher.key_version
+            rows.append(row)
+        return rows
+
+    @classmethod
+    def _decode_record(cls, record, versions):
+        version = ord(record[0])
+        if version not in versions:
+            raise ValueError("Unsupported item record version: %d" % version)
+        return version, json.loads(record[1:])
+
+    @classmethod
+    def get_fields(cls, fields=None):
+        """
+        :param fields: names of the fields to extract, None for all
+
+        :returns: tuple of the fields in SECRET_FIELDS order
+        """
+        if fields is None:
+            return cls.SECRET_FIELDS
+        unknown = set(fields) - set(cls.SECRET_FIELDS)
+        if unknown:
+            raise ValueError("Unknown item fields: %s" %
+                             ", ".join(sorted(unknown)))
+        return tuple(field for field in cls.SECRET_FIELDS if field in fields)
+
+    @classmethod
+    def deferred_columns(cls, fields=None):
+        """
+        :param fields: names of the fields to extract, None for all
+
+        :returns: names of the encrypted columns not needed to extract the
+        fields, see `extract_many`
+        """
+        fields = cls.get_fields(fields)
+        columns = [field for field in cls.SECRET_FIELDS if field not in fields]
+        if not set(fields) & set(cls.DETAIL_FIELDS):
+            columns.append('details')
+        return columns
+
+    def _encrypted_columns(self, fields=SECRET_FIELDS):
+        if self.record is None:
+            return fields
+        # Details are deferred when none of their fields are needed
+        if (not set(fields) & set(self.DETAIL_FIELDS) or
+                self.details is None):
+            return ('record',)
+        return ('record', 'details')
+
+    @classmethod
+    def _decrypt_fields(cls, items, cipher, fields=SECRET_FIELDS):
+        """
+        Decrypt the secret fields of items stored in any format, with one
+        batch for all of them, see `_decrypt_many`. The details of items
+        stored as records are only decrypted if some of the fields are among
+        them.
+
+        :returns: list of dictionaries of the fields of each item
+        """
+        decrypted = []
+        for item, values in zip(items, _decrypt_many(
+                cipher, items, lambda item: [
+                    getattr(item, column)
+                    for column in item._encrypted_columns(fields)])):
+            columns = item._encrypted_columns(fields)
+            values = iter(values)
+            if 'record' not in columns:
+                decrypted.append(dict((field, next(values))
+                                      for field in columns))
+                continue
+            version, record = cls._decode_record(next(values), (1, 2))
+            if version == 1:
+                decrypted.append(dict(zip(cls.SECRET_FIELDS, record)))
+                continue
+            entry = dict(zip(cls.SUMMARY_FIELDS, record))
+            if 'details' in columns:
+                entry.update(zip(cls.DETAIL_FIELDS, cls._decode_record(
+                    next(values), (2,))[1]))
+            decrypted.append(entry)
+        return [dict((field, entry[field]) for field in fields)
+                for entry in decrypted]
+
+    def extract(self, cipher, with_category=True, fields=None):
+        return self.extract_many([self], cipher, with_category, fields)[0]
+
+    @classmethod
+    def extract_many(cls, items, cipher, with_category=True, fields=None):
+        """
+        Decrypt a list of items, with one `AESCipher.decrypt_many` call for
+        all of their fields and another one for the names of their
+        categories, per version of the data key, see `_decrypt_many`.
+
+        :param items: list of Item models
+        :param cipher: decryption cipher
+        :param with_category: whether to include the item's category or only
+        its id
+        :param fields: names of the fields to include, None for all. Columns
+        listed by `deferred_columns` need not be loaded.
+
+        :returns: list of item dictionaries
+        """
+        fields = cls._decrypt_fields(items, cipher, cls.get_fields(fields))
+        categories = {}
         if with_category:
-            if self.category:
-                item['category'] = self.category.extract(cipher)
+            # Categories are usually shared by many items
+            for item in items:
+                if item.category:
+                    categories[item.category.id] = item.category
+            categories = dict(zip(categories, Category.extract_many(
+                list(categories.values()), cipher)))
+
+        extracted = []
+        for item, values in zip(items, fields):
+            entry = {'id': item.id}
+            entry.update(values)
+            entry['sort_id'] = item.sort_id
+            if with_category:
+                if item.category:
+                    entry['category'] = dict(categories[item.category.id])
+                else:
+                    entry['category'] = {"id": item.category_id}
             else:
-                item['category'] = {"id": self.category_id}
-        else:
-            item['category_id'] = self.category_id
+                entry['category_id'] = item.category_id
+            extracted.append(entry)
+        return extracted
 
-        return item
+    @classmethod
+    def upgrade_many(cls, items, cipher):
+        """
+        Convert items to the current record format and data key, e.g.
+        items stored with separately encrypted fields, with a version 1
+        record or with a retired data key.
 
-    def recrypt(self, old_cipher, new_cipher):
-        self.name = new_cipher.encrypt(old_cipher.decrypt(self.name))
-        self.url = new_cipher.encrypt(old_cipher.decrypt(self.url))
-        self.account = new_cipher.encrypt(old_cipher.decrypt(self.account))
-        self.username = new_cipher.encrypt(old_cipher.decrypt(self.username))
-        self.password = new_cipher.encrypt(old_cipher.decrypt(self.password))
-        self.blob = new_cipher.encrypt(old_cipher.decrypt(self.blob))
+        :param items: list of Item models
+        :param cipher: cipher returned by `aescipher.get_data_cipher`
+
+        :returns: list of dictionaries of the new encrypted item columns
+        """
+        return cls.encrypt_many(cls._decrypt_fields(items, cipher), cipher)
 
 
 class Category(Base):
 
     __tablename__ = 'categories'
-    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+    __table_args__ = (Index('categories_user_id_sort_id_idx',
+                            'user_id', 'sort_id'),
+                      Index('categories_user_id_updated_at_idx',
+                            'user_id', 'updated_at'),
+                      {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'})
 
     id = Column(Integer, Sequence('category_id_seq'), primary_key=True)
-    name = Column(String(255), nullable=False)
+    name = Column(Ciphertext, nullable=False)
+    # Version of the user's data key the name is encrypted with
+    key_version = Column(Integer, nullable=False, default=1,
+                         server_default='1')
     user_id = Column(Integer, Sequence('user_id_seq'),
-                     ForeignKey('users.id'), nullable=False)
+                     ForeignKey('users.id', ondelete='CASCADE'),
+                     nullable=False)
     sort_id = Column(Integer, default=0)
     created_at = Column(DateTime, default=lambda: datetime.now(),
                         nullable=False)
     updated_at = Column(DateTime, default=lambda: datetime.now(),
                         nullable=False, onupdate=lambda: datetime.now())
 
-    items = relationship('Item', order_by=Item.id)
-    user = relationship('User')
+    items = relationship('Item', order_by=Item.id, passive_deletes=True,
+                         lazy='raise')
+    user = relationship('User', lazy='raise_on_sql')
+
+    @classmethod
+    def encrypt_many(cls, names, cipher):
+        """
+        :param names: list of plain text category names
+        :param cipher: encryption cipher
+
+        :returns: list of dictionaries of the encrypted category columns
+        """
+        return [{'name': name, 'key_version': cipher.key_version}
+                for name in cipher.encrypt_many(names, binary=True)]
 
     def extract(self, cipher, with_items=False):
-        category = {'id': self.id,
-                    'name': cipher.decrypt(self.name),
-                    'sort_id': self.sort_id}
+        return self.extract_many([self], cipher, with_items)[0]
+
+    @classmethod
+    def extract_many(cls, categories, cipher, with_items=False):
+        """
+        Decrypt a list of categories in batches, see `Item.extract_many`.
+
+        :param categories: list of Category models
+        :param cipher: decryption cipher
+        :param with_items: whether to include the items of each category
+
+        :returns: list of category dictionaries
+        """
+        names = _decrypt_many(cipher, categories,
+                              lambda category: [category.name])
+        extracted = []
+        for category, (name,) in zip(categories, names):
+            extracted.append({'id': category.id,
+                              'name': name,
+                              'sort_id': category.sort_id})
         if with_items:
-            items_array = []
-            for item in self.items:
-                items_array.append(item.extract(cipher, False))
-            category['items'] = items_array
-        return category
-
-    def recrypt(self, old_cipher, new_cipher):
-        self.name = new_cipher.encrypt(old_cipher.decrypt(self.name))
+            items = iter(Item.extract_many(
+                [item for category in categories for item in category.items],
+                cipher, False))
+            for category, entry in zip(categories, extracted):
+                entry['items'] = [next(items) for item in category.items]
+        return extracted
+
+    @classmethod
+    def upgrade_many(cls, categories, cipher):
+        """
+        Re-encrypt the names of categories with the current data key, see
+        `Item.upgrade_many`.
+
+        :param categories: list of Category models
+        :param cipher: cipher returned by `aescipher.get_data_cipher`
+
+        :returns: list of dictionaries of the new encrypted category columns
+        """
+        return cls.encrypt_many(
+            [name for (name,) in _decrypt_many(
+                cipher, categories, lambda category: [category.name])],
+            cipher)
+
+
+class Tombstone(Base):
+    """
+    Record of a deleted item or category, reported to syncing clients.
+    """
+
+    __tablename__ = 'tombstones'
+    __table_args__ = (Index('tombstones_user_id_deleted_at_idx',
+                            'user_id', 'deleted_at'),
+                      {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'})
+
+    # Values of the `kind` column
+    ITEM = 'item'
+    CATEGORY = 'category'
+
+    id = Column(Integer, Sequence('tombstone_id_seq'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'),
+                     nullable=False)
+    kind = Column(String(16), nullable=False)
+    record_id = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, default=lambda: datetime.now(),
+                        nullable=False)
@@ -19,10 +19,12 @@ import json
 
 from flask import Flask, g, request, _app_ctx_stack
 
-from opp.api.v1 import base_handler, categories, fetch_all, items
+from opp.api.v1 import base_handler, categories, fetch_all, items, metrics
+from opp.api.v1 import stats
 from opp.api.v1 import user as user_crud
 from opp.common import opp_config, utils
 from opp.db import api
+from opp.flask import flask_jwt
 from opp.flask.flask_jwt import JWT, jwt_required
 
 
@@ -35,21 +37,7 @@ CONF = opp_config.OppConfig()
 if CONF['secret_key'] == "default-insecure":
     LOG.warning("Config option 'secret_key' not specified."
                 " Using default insecure value!")
-try:
-    if CONF['exp_delta']:
-        exp_delta = int(CONF['exp_delta'])
-        if exp_delta < 0 or exp_delta > pow(2, 31):
-            LOG.warning("Invalid value specified for 'exp_delta' "
-                        "config option. Defaulting to 300 seconds.")
-            exp_delta = 300
-    else:
-        LOG.warning("Config value for 'exp_delta' not "
-                    "specified. Defaulting to 300 seconds.")
-        exp_delta = 300
-except Exception:
-    LOG.warning("Unable to parse value for 'exp_delta' "
-                "config option. Defaulting to 300 seconds.")
-    exp_delta = 300
+exp_delta = utils.get_exp_delta(CONF, LOG)
 
 # Flask app
 app = Flask(__name__)
@@ -67,7 +55,8 @@ def error_handler(error):
 @app.before_request
 def get_scoped_session():
     try:
-        g.session = api.get_scoped_session()
+        g.session = api.get_scoped_session(
+            readonly=request.method == 'GET')
     except Exception as e:
         g.session = None
         LOG.error(f'error calling get_scoped_session {e}')
@@ -81,12 +70,32 @@ def shutdown_session(exception=None):
 
 def authenticate(username, password):
     user = api.user_get_by_username(g.session, username)
-    if user and utils.checkpw(password, user.password):
+    if user and _checkpw(password, user.password):
         return user
 
 
+def _checkpw(password, hashed):
+    # bcrypt runs in the bounded password pool, so that bursts of logins
+    # are turned away instead of occupying every request thread
+    try:
+        return utils.get_password_pool().checkpw(password, hashed)
+    except utils.PoolSaturated as e:
+        raise base_handler.OppError(
+            "Too Many Requests", str(e), 429,
+            headers={'Retry-After': str(e.retry_after)})
+
+
 def identity(payload):
-    return api.user_get_by_id(g.session, payload['identity'])
+    return api.user_get_cached(g.session, payload['identity'],
+                               payload.get('ver'))
+
+
+def jwt_payload(identity, exp_delta=None):
+    # Tokens carry the user version, so that requests bearing a token
+    # issued after a change of the user bypass outdated cached copies
+    payload = flask_jwt._default_jwt_payload_handler(identity, exp_delta)
+    payload['ver'] = identity.version
+    return payload
 
 
 def _to_json(dictionary):
@@ -106,6 +115,7 @@ def _enforce_content_type():
 
 # JWT helper
 jwt = JWT(app, authenticate, identity)
+jwt.jwt_payload_handler(jwt_payload)
 
 
 @app.route("/v1/health")
@@ -113,6 +123,15 @@ def health_check():
     return _to_json({'status': "OpenPassPhrase service is running"})
 
 
+@app.route("/v1/metrics")
+@jwt_required()
+def handle_metrics():
+    user = _app_ctx_stack.top.current_identity
+    handler = metrics.ResponseHandler(request, user, g.session)
+    response = handler.respond()
+    return _to_json(response), 200, handler.headers
+
+
 @app.route("/v1/user",
            methods=['PUT', 'POST', 'DELETE'])
 def handle_user():
@@ -121,7 +140,7 @@ def handle_user():
         return err, 400
     handler = user_crud.ResponseHandler(request, None, g.session)
     response = handler.respond(require_phrase=False)
-    return _to_json(response)
+    return _to_json(response), 200, handler.headers
 
 
 @app.route("/v1/fetchall")
@@ -133,7 +152,16 @@ def handle_fetchall():
     user = _app_ctx_stack.top.current_identity
     handler = fetch_all.ResponseHandler(request, user, g.session)
     response = handler.respond()
-    return _to_json(response)
+    return _to_json(response), 200, handler.headers
+
+
+@app.route("/v1/stats")
+@jwt_required()
+def handle_stats():
+    user = _app_ctx_stack.top.current_identity
+    handler = stats.ResponseHandler(request, user, g.session)
+    response = handler.respond(require_phrase=False)
+    return _to_json(response), 200, handler.headers
 
 
 @app.route("/v1/categories",
@@ -147,7 +175,7 @@ def handle_categories():
     handler = categories.ResponseHandler(request, user, g.session)
     # Set require_phrase to True for all methods except DELETE
     response = handler.respond(request.method != 'DELETE')
-    return _to_json(response)
+    return _to_json(response), 200, handler.headers
 
 
 @app.route("/v1/items",
@@ -161,4 +189,16 @@ def handle_items():
     handler = items.ResponseHandler(request, user, g.session)
     # Set require_phrase to True for all methods except DELETE
     response = handler.respond(request.method != 'DELETE')
-    return _to_json(response)
+    return _to_json(response), 200, handler.headers
+
+
+@app.route("/v1/items/<int:item_id>")
+@jwt_required()
+def handle_item(item_id):
+    err = _enforce_content_type()
+    if err:
+        return err, 400
+    user = _app_ctx_stack.top.current_identity
+    handler = items.ResponseHandler(request, user, g.session)
+    response = handler.respond()
+    return _to_json(response), 200, handler.headers
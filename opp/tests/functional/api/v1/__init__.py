@@ -13,13 +13,18 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
 import json
 import os
 import tempfile
 import unittest
 
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
 from opp.flask.json_server import app
 from opp.common import utils
+from opp.db import api
 
 
 class BackendApiTest(unittest.TestCase):
@@ -31,8 +36,8 @@ class BackendApiTest(unittest.TestCase):
         cls.conf_filepath = os.path.join(cls.test_dir, 'opp.cfg')
         cls.db_filepath = os.path.join(cls.test_dir, 'test.sqlite')
         with open(cls.conf_filepath, 'w') as conf_file:
-            conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" %
-                            cls.db_filepath)
+            conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s\n"
+                            "metrics_enabled = true\n" % cls.db_filepath)
             conf_file.flush()
         os.environ['OPP_TOP_CONFIG'] = cls.conf_filepath
         # Create database and a user
@@ -56,6 +61,8 @@ class BackendApiTest(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        # Close pooled connections so SQLite removes its WAL files
+        api.dispose_engines()
         try:
             os.remove(cls.conf_filepath)
         except Exception:
@@ -94,3 +101,38 @@ class BackendApiTest(unittest.TestCase):
         resp = self.client.delete(path, headers=self.hdrs, data=data)
         self.assertEqual(resp.status_code, code)
         return json.loads(resp.data.decode())
+
+    @contextlib.contextmanager
+    def _count_statements(self):
+        """
+        Collect the SQL statements sent to any database, apart from the
+        explicit BEGIN of SQLite transactions.
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if not statement.startswith("BEGIN"):
+                statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(Engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+    def _check_budget(self, budget, method, path, data=None, code=200):
+        """
+        Perform a request and fail if it issues more than `budget` SQL
+        statements. Budgets must not depend on the amount of user data.
+        """
+        with self._count_statements() as statements:
+            if method == 'get':
+                response = self._get(path, code)
+            else:
+                response = getattr(self, '_' + method)(path, data, code)
+        self.assertLessEqual(len(statements), budget,
+                             "%s %s issued %d statements:\n%s" % (
+                                 method.upper(), path, len(statements),
+                                 "\n".join(statements)))
+        return response
@@ -0,0 +1,204 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import json
+import sqlite3
+import threading
+
+import mock
+from sqlalchemy import exc
+
+from opp.asgi import json_server
+from opp.common import utils
+from opp.db import api, async_api
+
+from . import BackendApiTest
+
+
+async def call_asgi(method, path, headers=None, data=None):
+    """
+    Drive the ASGI application with a single request.
+
+    :returns: tuple of status code, header dictionary and decoded body
+    """
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': method.upper(), 'path': path,
+             'query_string': query.encode(),
+             'headers': [(name.lower().encode(), value.encode())
+                         for name, value in (headers or {}).items()]}
+    messages = [{'type': 'http.request',
+                 'body': (data or "").encode(), 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await json_server.app(scope, receive, send)
+    start, body = sent
+    headers = {name.decode(): value.decode()
+               for name, value in start['headers']}
+    return start['status'], headers, json.loads(body['body'].decode())
+
+
+class TestCase(BackendApiTest):
+
+    """These tests run requests through the ASGI application, sharing the
+    database and the JWT of the Flask based tests.
+    Note: All tests share the same DB, so please beware of
+    unintended interaction when adding new tests"""
+    @classmethod
+    def tearDownClass(cls):
+        async_api.shutdown_executor()
+        super(TestCase, cls).tearDownClass()
+
+    def setUp(self):
+        self.hdrs = {'x-opp-phrase': "123456",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+
+    def _request(self, method, path, data=None, code=200, headers=None):
+        if data is not None:
+            data = json.dumps(data)
+        status, _, body = asyncio.run(call_asgi(
+            method, path, headers or self.hdrs, data))
+        self.assertEqual(status, code, body)
+        return body
+
+    def test_health(self):
+        data = self._request('get', '/v1/health')
+        self.assertEqual(data['status'], "OpenPassPhrase service is running")
+
+    def test_auth(self):
+        hdrs = {'Content-Type': "application/json"}
+        data = self._request('post', '/v1/auth',
+                             {'username': "u", 'password': "p"},
+                             headers=hdrs)
+        # Tokens of the ASGI application are accepted by the Flask one
+        self.hdrs['x-opp-jwt'] = data['access_token']
+        self._get('/v1/items')
+
+        data = self._request('post', '/v1/auth',
+                             {'username': "u", 'password': "x"}, 401,
+                             headers=hdrs)
+        self.assertEqual(data['description'], "Invalid credentials")
+
+    def test_auth_saturated(self):
+        hdrs = {'Content-Type': "application/json"}
+        credentials = json.dumps({'username': "u", 'password': "p"})
+        pool = utils.PasswordPool(1, 0)
+        self.addCleanup(pool.shutdown)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with mock.patch.object(utils, '_PASSWORD_POOL', pool):
+            with mock.patch.object(utils, 'checkpw',
+                                   side_effect=lambda *args: release.wait()):
+                future = pool.submit("p", "h")
+                status, headers, data = asyncio.run(call_asgi(
+                    'post', '/v1/auth', hdrs, credentials))
+                self.assertEqual(status, 429)
+                self.assertGreaterEqual(int(headers['retry-after']), 1)
+                release.set()
+                future.result()
+
+            self._request('post', '/v1/auth',
+                          {'username': "u", 'password': "p"}, headers=hdrs)
+            stats = self._request('get', '/v1/metrics')['password_pool']
+            self.assertEqual(stats['checks'], 2)
+            self.assertEqual(stats['rejections'], 1)
+
+    def test_errors(self):
+        self._request('get', '/v1/nowhere', code=404)
+        self._request('get', '/v1/user', code=405)
+        self._request('get', '/v1/items', code=401,
+                      headers={'x-opp-phrase': "123456"})
+        self._request('get', '/v1/metrics', code=401,
+                      headers={'x-opp-phrase': "123456"})
+        self.hdrs['x-opp-phrase'] = "654321"
+        data = self._request('get', '/v1/items', code=400)
+        self.assertEqual(data['error'], "Incorrect passphrase supplied!")
+        self.hdrs['Content-Type'] = "text/plain"
+        data = self._request('put', '/v1/items', {'items': []}, 400)
+        self.assertEqual(data['error'], "Invalid Content-Type")
+
+    def test_items(self):
+        data = self._request('put', '/v1/items',
+                             {'items': [{'name': "a1"}, {'name': "a2"}]})
+        ids = [item['id'] for item in data['items']]
+        data = self._request('get', '/v1/items?limit=1')
+        self.assertEqual(len(data['items']), 1)
+        self.assertIsNotNone(data['next'])
+        data = self._request('get', '/v1/items/%d?fields=name' % ids[1])
+        self.assertEqual(data['item']['name'], "a2")
+        self.assertNotIn('password', data['item'])
+        self._request('get', '/v1/items/abc', code=404)
+
+        async def concurrent_reads():
+            return await asyncio.gather(*[
+                call_asgi('get', '/v1/fetchall', self.hdrs)
+                for i in range(10)])
+        for status, _, body in asyncio.run(concurrent_reads()):
+            self.assertEqual(status, 200)
+            names = [item['name'] for item in body['items']]
+            self.assertIn("a1", names)
+            self.assertIn("a2", names)
+
+        self._request('delete', '/v1/items', {'ids': ids})
+        data = self._request('get', '/v1/items')
+        self.assertEqual([item for item in data['items']
+                          if item['id'] in ids], [])
+
+    def test_categories_sync(self):
+        data = self._request('get', '/v1/fetchall')
+        sync_token = data['sync_token']
+        data = self._request('put', '/v1/categories',
+                             {'category_names': ["c1", "c2"]})
+        ids = [category['id'] for category in data['categories']]
+        self._request('post', '/v1/categories',
+                      {'categories': [{'id': ids[0], 'name': "c3"}]})
+        data = self._request('put', '/v1/items',
+                             {'items': [{'name': "i1",
+                                         'category_id': ids[0]}]})
+        self.assertEqual(data['items'][0]['category']['name'], "c3")
+        item_id = data['items'][0]['id']
+
+        data = self._request('get', '/v1/categories')
+        names = dict((category['id'], category['name'])
+                     for category in data['categories'])
+        self.assertEqual(names[ids[0]], "c3")
+        self.assertEqual(names[ids[1]], "c2")
+
+        data = self._request('delete', '/v1/categories',
+                             {'ids': ids, 'cascade': True})
+        self.assertEqual(data['deleted'], 2)
+        self.assertEqual(data['items_deleted'], 1)
+
+        data = self._request('get', '/v1/fetchall?since=%s' % sync_token)
+        self.assertFalse(data['full'])
+        self.assertEqual(sorted(data['deleted']['categories']), sorted(ids))
+        self.assertEqual(data['deleted']['items'], [item_id])
+
+    def test_write_busy(self):
+        locked = exc.OperationalError(
+            "INSERT", {}, sqlite3.OperationalError("database is locked"))
+        with mock.patch.object(api, 'run_write', side_effect=locked):
+            status, headers, data = asyncio.run(call_asgi(
+                'put', '/v1/categories', self.hdrs,
+                json.dumps({'category_names': ["busy"]})))
+        self.assertEqual(status, 503, data)
+        self.assertEqual(headers['retry-after'], "1")
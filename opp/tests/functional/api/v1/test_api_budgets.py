@@ -0,0 +1,72 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from . import BackendApiTest
+
+
+class TestCase(BackendApiTest):
+
+    """These tests check the number of SQL statements each endpoint issues,
+    to catch N+1 query patterns. The user has enough data for a query per
+    row to exceed every budget.
+    Note: All tests share the same DB, so please beware of
+    unintended interaction when adding new tests"""
+    def setUp(self):
+        self.hdrs = {'x-opp-phrase': "123456",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        data = self._put('/v1/categories',
+                         {'category_names': ["b1", "b2", "b3"]})
+        self.cat_ids = [category['id'] for category in data['categories']]
+        items = [{"name": "b%d" % i,
+                  "category_id": self.cat_ids[i % 3]} for i in range(20)]
+        data = self._put('/v1/items', {'items': items})
+        self.item_ids = [item['id'] for item in data['items']]
+
+    def tearDown(self):
+        self._delete('/v1/categories', {'ids': self.cat_ids, 'cascade': True})
+
+    def test_read_budgets(self):
+        data = self._check_budget(2, 'get', '/v1/categories')
+        self.assertEqual(len(data['categories']), 3)
+        data = self._check_budget(2, 'get', '/v1/items')
+        self.assertEqual(len(data['items']), 20)
+        data = self._check_budget(2, 'get', '/v1/items?limit=5')
+        self.assertEqual(len(data['items']), 5)
+        data = self._check_budget(3, 'get', '/v1/fetchall')
+        self.assertEqual(len(data['items']), 20)
+        data = self._check_budget(4, 'get', '/v1/fetchall?since=%s' %
+                                  data['sync_token'])
+        self.assertEqual(data['full'], False)
+        data = self._check_budget(4, 'get', '/v1/stats')
+        self.assertEqual(data['total_items'], 20)
+
+    def test_write_budgets(self):
+        items = [{"name": "n%d" % i,
+                  "category_id": self.cat_ids[i % 3]} for i in range(20)]
+        self._check_budget(5, 'put', '/v1/items', {'items': items})
+        items = [{"id": item_id, "name": "u",
+                  "category_id": self.cat_ids[0]}
+                 for item_id in self.item_ids]
+        self._check_budget(3, 'post', '/v1/items', {'items': items})
+        data = self._check_budget(4, 'put', '/v1/categories',
+                                  {'category_names': ["n1", "n2", "n3"]})
+        self.cat_ids += [category['id'] for category in data['categories']]
+        categories = [{"id": cat_id, "name": "u"} for cat_id in self.cat_ids]
+        self._check_budget(2, 'post', '/v1/categories',
+                           {'categories': categories})
+        self._check_budget(3, 'delete', '/v1/items', {'ids': self.item_ids})
+        self._check_budget(4, 'delete', '/v1/categories',
+                           {'ids': self.cat_ids[:1], 'cascade': False})
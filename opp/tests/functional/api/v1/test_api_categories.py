@@ -142,6 +142,11 @@ class TestCase(BackendApiTest):
         data = self._post(path, data, 400)
         self.assertEqual(data['error'], "Invalid category name in list!")
 
+        # Try to POST with an unknown category id
+        data = {'categories': [{'id': cat_id + 100, 'name': "c2"}]}
+        data = self._post(path, data, 400)
+        self.assertEqual(data['error'], "Invalid category id in list!")
+
         # Try to delete with missing cascade value
         data = {'notcascade': False, 'ids': [2]}
         data = self._delete(path, data, 400)
@@ -245,6 +250,8 @@ class TestCase(BackendApiTest):
         data = {'cascade': True, 'ids': [c1['id']]}
         data = self._delete(cat_path, data)
         self.assertEqual(data['result'], "success")
+        self.assertEqual(data['deleted'], 1)
+        self.assertEqual(data['items_deleted'], 2)
 
         # Verify updated category list (expect 1)
         data = self._get(cat_path)
@@ -268,6 +275,8 @@ class TestCase(BackendApiTest):
         data = {'cascade': False, 'ids': [c2['id']]}
         data = self._delete(cat_path, data)
         self.assertEqual(data['result'], "success")
+        self.assertEqual(data['deleted'], 1)
+        self.assertEqual(data['items_updated'], 2)
 
         # Verify empty category list
         data = self._get(cat_path)
@@ -288,6 +297,7 @@ class TestCase(BackendApiTest):
         data = {'ids': [i3['id'], i4['id']]}
         data = self._delete(item_path, data)
         self.assertEqual(data['result'], "success")
+        self.assertEqual(data['deleted'], 2)
 
         data = self._get(item_path)
         self.assertEqual(data['result'], "success")
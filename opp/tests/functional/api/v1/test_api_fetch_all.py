@@ -13,6 +13,13 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from datetime import datetime, timedelta
+import mock
+
+from opp.api.v1 import base_handler as bh
+from opp.api.v1 import fetch_all
+from opp.common import aescipher
+
 from . import BackendApiTest
 
 
@@ -87,7 +94,108 @@ class TestCase(BackendApiTest):
         self.assertEqual(i5['category_id'], None)
         self.assertEqual(i6['category_id'], None)
 
+        # Fetch items in pages, categories come with the first page only
+        data = self._get(path + "?limit=4")
+        self.assertEqual(len(data['categories']), 2)
+        self.assertEqual([i['name'] for i in data['items']],
+                         ["i1", "i2", "i3", "i4"])
+        data = self._get(path + "?limit=4&after=%s" % data['next'])
+        self.assertEqual(data['categories'], [])
+        self.assertEqual([i['name'] for i in data['items']], ["i5", "i6"])
+        self.assertNotIn('next', data)
+
         # Attempt to retrieve data with the wrong passphrase
         self.hdrs['x-opp-phrase'] = "123457"
         data = self._get(path, 400)
         self.assertEqual(data['error'], "Incorrect passphrase supplied!")
+
+    def test_fetch_all_parallel(self):
+        self.hdrs = {'x-opp-phrase': "123456",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        names = ["p%d" % i for i in range(7)]
+        data = self._put('/v1/items', {'items': [{"name": name}
+                                                 for name in names]})
+        ids = [item['id'] for item in data['items']]
+        expected = self._get('/v1/fetchall')['items']
+
+        pool = aescipher.DecryptPool('thread', 3, 5)
+        try:
+            with mock.patch.object(aescipher, '_POOL', pool):
+                # Below the threshold items are decrypted inline
+                data = self._get('/v1/fetchall?limit=4')
+                self.assertEqual(pool.stats()['requests'], 0)
+
+                # Shards are reassembled in order
+                self.assertEqual(self._get('/v1/fetchall')['items'],
+                                 expected)
+                stats = self._get('/v1/metrics')['decrypt_pool']
+                self.assertEqual(stats['requests'], 1)
+                self.assertEqual(stats['rows'], len(expected))
+                self.assertEqual(stats['size'], 3)
+                self.assertGreater(stats['time'], 0)
+        finally:
+            pool.shutdown()
+        self._delete('/v1/items', {'ids': ids})
+
+    @mock.patch.object(fetch_all, 'SYNC_OVERLAP', timedelta(0))
+    def test_fetch_all_sync(self):
+        self.hdrs = {'x-opp-phrase': "123456",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        path = '/v1/fetchall'
+        cpath = '/v1/categories'
+        ipath = '/v1/items'
+
+        # Add a category and 3 items, then start syncing
+        data = self._put(cpath, {'category_names': ["sync"]})
+        cat_id = data['categories'][0]['id']
+        data = self._put(ipath, {'items': [{"name": "s1"}, {"name": "s2"},
+                                           {"name": "s3",
+                                            "category_id": cat_id}]})
+        s1, s2, s3 = [item['id'] for item in data['items']]
+        token = self._get(path)['sync_token']
+
+        # Nothing changed
+        data = self._get(path + "?since=%s" % token)
+        self.assertEqual(data['full'], False)
+        self.assertEqual(data['categories'], [])
+        self.assertEqual(data['items'], [])
+        self.assertEqual(data['deleted'], {'categories': [], 'items': []})
+        token = data['sync_token']
+
+        # Update, delete and add items, delete the category
+        self._post(ipath, {'items': [{'id': s1, 'name': "new s1"}]})
+        self._delete(ipath, {'ids': [s2]})
+        data = self._put(ipath, {'items': [{"name": "s4"}]})
+        s4 = data['items'][0]['id']
+        self._delete(cpath, {'ids': [cat_id], 'cascade': False})
+
+        # Only the changes are returned
+        data = self._get(path + "?since=%s" % token)
+        self.assertEqual(data['categories'], [])
+        self.assertEqual(sorted([(i['id'], i['name'], i['category_id'])
+                                 for i in data['items']]),
+                         [(s1, "new s1", None), (s3, "s3", None),
+                          (s4, "s4", None)])
+        self.assertEqual(data['deleted'], {'categories': [cat_id],
+                                           'items': [s2]})
+
+        # Tokens older than the deletion records fall back to a full fetch
+        token = bh.encode_sync_token(datetime.now() - timedelta(days=31))
+        data = self._get(path + "?since=%s" % token)
+        self.assertEqual(data['full'], True)
+        ids = [item['id'] for item in data['items']]
+        self.assertTrue(set([s1, s3, s4]).issubset(ids))
+        self.assertNotIn(s2, ids)
+        self.assertIn('sync_token', data)
+
+        # Invalid parameters
+        data = self._get(path + "?since=abc", 400)
+        self.assertEqual(data['error'], "Invalid sync token!")
+        data = self._get(path + "?since=%s&limit=1" % token, 400)
+        self.assertEqual(data['error'],
+                         "Sync token cannot be combined with pagination!")
+
+        # Clean up
+        self._delete(ipath, {'ids': [s1, s3, s4]})
@@ -13,6 +13,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import mock
+
+from opp.common import utils
+
 from . import BackendApiTest
 
 
@@ -27,3 +31,33 @@ class TestCase(BackendApiTest):
         resp = self._get('/v1/health')
         self.assertEqual(resp['status'],
                          "OpenPassPhrase service is running")
+
+    def test_metrics(self):
+        # Authentication is required
+        self._get('/v1/metrics', 401)
+
+        self.hdrs = {'x-opp-jwt': self.jwt}
+        resp = self._get('/v1/metrics')
+        self.assertIn('db_pools', resp)
+        for pool in resp['db_pools']:
+            self.assertNotIn('url', pool)
+
+    def test_metrics_existing_pools(self):
+        # Pools which were not created yet are neither reported nor created
+        self.hdrs = {'x-opp-jwt': self.jwt}
+        with mock.patch.object(utils, '_PASSWORD_POOL', None):
+            resp = self._get('/v1/metrics')
+            self.assertNotIn('password_pool', resp)
+            self.assertIsNone(utils._PASSWORD_POOL)
+
+    def test_metrics_disabled(self):
+        self.hdrs = {'x-opp-jwt': self.jwt}
+        with open(self.conf_filepath) as conf_file:
+            conf = conf_file.read()
+        self.addCleanup(self._write_conf, conf)
+        self._write_conf(conf.replace("metrics_enabled = true", ""))
+        self._get('/v1/metrics', 404)
+
+    def _write_conf(self, conf):
+        with open(self.conf_filepath, 'w') as conf_file:
+            conf_file.write(conf)
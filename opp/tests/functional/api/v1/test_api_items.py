@@ -127,6 +127,14 @@ class TestCase(BackendApiTest):
         data = self._post(path, data, 400)
         self.assertEqual(data['error'], "Invalid item data in list!")
 
+        # Try to POST with an unknown item id, nothing should be updated
+        data = {'items': [{'id': item_id, 'name': "i5"},
+                          {'id': item_id + 100, 'name': "i6"}]}
+        data = self._post(path, data, 400)
+        self.assertEqual(data['error'], "Invalid item id in list!")
+        data = self._get(path)
+        self.assertEqual(data['items'][0]['name'], "i4")
+
         #  Attempt to retrieve items with the wrong passphrase
         self.hdrs['x-opp-phrase'] = "123457"
         data = self._get(path, 400)
@@ -143,6 +151,49 @@ class TestCase(BackendApiTest):
         self.assertEqual(data['result'], "success")
         self.assertEqual(data['items'], [])
 
+    def test_items_create_with_categories(self):
+        self.hdrs = {'x-opp-phrase': "123456",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        path = '/v1/items'
+
+        # Add a category to put items in
+        data = {'category_names': ["cat1"]}
+        data = self._put('/v1/categories', data)
+        cat_id = data['categories'][0]['id']
+
+        # Add items, ids and categories are returned in request order
+        data = {'items':
+                [{"name": "i1", "category_id": cat_id},
+                 {"name": "i2"},
+                 {"name": "i3", "category_id": cat_id}]}
+        data = self._put(path, data)
+        self.assertEqual(data['result'], "success")
+        item1, item2, item3 = data['items']
+        self.assertEqual(item1['category'], {'id': cat_id, 'name': "cat1",
+                                             'sort_id': 0})
+        self.assertEqual(item2['category'], {'id': None})
+        self.assertEqual(item3['category']['id'], cat_id)
+
+        # Check the returned ids match the stored items
+        data = self._get(path)
+        names = {item['id']: item['name'] for item in data['items']}
+        self.assertEqual(names, {item1['id']: "i1", item2['id']: "i2",
+                                 item3['id']: "i3"})
+
+        # Unknown category ids are rejected
+        data = {'items': [{"name": "i4", "category_id": cat_id + 100}]}
+        data = self._put(path, data, 400)
+        self.assertEqual(data['error'], "Invalid category id in list!")
+
+        # Clean up
+        data = {'ids': [cat_id], 'cascade': True}
+        data = self._delete('/v1/categories', data)
+        self.assertEqual(data['result'], "success")
+        data = {'ids': [item2['id']]}
+        data = self._delete(path, data)
+        self.assertEqual(data['result'], "success")
+
     def test_items_create_auto_password(self):
         self.hdrs = {'x-opp-phrase': "123456",
                      'x-opp-jwt': self.jwt,
@@ -244,3 +295,83 @@ class TestCase(BackendApiTest):
         data = {'ids': [item['id'] for item in data['items']]}
         data = self._delete(path, data)
         self.assertEqual(data['result'], "success")
+
+    def test_items_pages(self):
+        self.hdrs = {'x-opp-phrase': "123456",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        path = '/v1/items'
+
+        # Add 5 items
+        data = {'items': [{"name": "p%d" % i} for i in range(5)]}
+        data = self._put(path, data)
+        ids = [item['id'] for item in data['items']]
+
+        # Fetch them 2 at a time, the last page has no cursor
+        data = self._get(path + "?limit=2")
+        self.assertEqual([i['name'] for i in data['items']], ["p0", "p1"])
+        data = self._get(path + "?limit=2&after=%s" % data['next'])
+        self.assertEqual([i['name'] for i in data['items']], ["p2", "p3"])
+        data = self._get(path + "?limit=2&after=%s" % data['next'])
+        self.assertEqual([i['name'] for i in data['items']], ["p4"])
+        self.assertNotIn('next', data)
+
+        # Exactly one full page
+        data = self._get(path + "?limit=5")
+        self.assertEqual(len(data['items']), 5)
+        self.assertNotIn('next', data)
+
+        # Invalid parameters
+        data = self._get(path + "?limit=0", 400)
+        self.assertEqual(data['error'], "Invalid pagination limit!")
+        data = self._get(path + "?limit=abc", 400)
+        self.assertEqual(data['error'], "Invalid pagination limit!")
+        data = self._get(path + "?limit=2&after=abc", 400)
+        self.assertEqual(data['error'], "Invalid pagination cursor!")
+        data = self._get(path + "?after=MDox", 400)
+        self.assertEqual(data['error'], "Pagination cursor requires a limit!")
+
+        # Clean up
+        data = self._delete(path, {'ids': ids})
+        self.assertEqual(data['deleted'], 5)
+
+    def test_items_fields(self):
+        self.hdrs = {'x-opp-phrase': "123456",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+        path = '/v1/items'
+        data = {'items': [{"name": "f%d" % i, "url": "u%d" % i,
+                           "password": "p%d" % i, "blob": "b" * 4096}
+                          for i in range(2)]}
+        data = self._put(path, data)
+        ids = [item['id'] for item in data['items']]
+
+        # List views only get the requested fields
+        data = self._get(path + "?fields=name,url")
+        self.assertEqual(
+            [item for item in data['items'] if item['id'] in ids],
+            [{'id': ids[i], 'name': "f%d" % i, 'url': "u%d" % i,
+              'sort_id': 0, 'category': {'id': None}} for i in range(2)])
+        data = self._get('/v1/fetchall?fields=name')
+        self.assertEqual(sorted(data['items'][0]), ['category_id', 'id',
+                                                    'name', 'sort_id'])
+
+        # Secrets are fetched one item at a time
+        data = self._get(path + "/%d?fields=password" % ids[1])
+        self.assertEqual(data['item']['password'], "p1")
+        self.assertNotIn('blob', data['item'])
+        data = self._get(path + "/%d" % ids[0])
+        self.assertEqual(data['item']['blob'], "b" * 4096)
+        self.assertEqual(data['item']['name'], "f0")
+
+        # Invalid parameters
+        data = self._get(path + "?fields=name,secret", 400)
+        self.assertEqual(data['error'], "Invalid fields parameter!")
+        data = self._get(path + "?fields=", 400)
+        self.assertEqual(data['error'], "Invalid fields parameter!")
+        data = self._get(path + "/%d" % (ids[1] + 1000), 404)
+        self.assertEqual(data['error'], "Item not found!")
+
+        # Clean up
+        data = self._delete(path, {'ids': ids})
+        self.assertEqual(data['deleted'], 2)
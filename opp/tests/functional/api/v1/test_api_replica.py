@@ -0,0 +1,162 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import json
+import os
+import sqlite3
+
+import mock
+
+from opp.api.v1 import base_handler
+from opp.db import api, async_api
+
+from . import BackendApiTest
+from . import test_api_asgi
+
+
+class TestCase(BackendApiTest):
+
+    """These tests route reads to a second SQLite database standing in for
+    a read replica. It is only brought up to date by `_replicate`, which
+    makes replication lag easy to observe.
+    Note: All tests share the same DB, so please beware of
+    unintended interaction when adding new tests"""
+    @classmethod
+    def setUpClass(cls):
+        super(TestCase, cls).setUpClass()
+        cls.replica_filepath = os.path.join(cls.test_dir, 'replica.sqlite')
+        cls._replicate()
+        with open(cls.conf_filepath, 'a') as conf_file:
+            conf_file.write("\ndb_connect_replica = sqlite:///%s\n"
+                            "db_replica_window = 60\n" % cls.replica_filepath)
+        # Engines pick up the configuration when they are created
+        api.dispose_engines()
+
+    @classmethod
+    def tearDownClass(cls):
+        api.dispose_engines()
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(cls.replica_filepath + suffix)
+            except Exception:
+                pass
+        super(TestCase, cls).tearDownClass()
+
+    @classmethod
+    def _replicate(cls):
+        primary = sqlite3.connect(cls.db_filepath)
+        replica = sqlite3.connect(cls.replica_filepath)
+        try:
+            primary.backup(replica)
+        finally:
+            replica.close()
+            primary.close()
+
+    def setUp(self):
+        self.hdrs = {'x-opp-phrase': "123456",
+                     'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+
+    def _names(self, write_token=None):
+        hdrs = dict(self.hdrs)
+        if write_token:
+            hdrs[base_handler.WRITE_TOKEN_HEADER] = write_token
+        resp = self.client.get('/v1/items', headers=hdrs)
+        self.assertEqual(resp.status_code, 200)
+        return [item['name'] for item in
+                json.loads(resp.data.decode())['items']]
+
+    def _write(self, method, data):
+        resp = getattr(self.client, method)(
+            '/v1/items', headers=self.hdrs, data=json.dumps(data))
+        self.assertEqual(resp.status_code, 200)
+        return (json.loads(resp.data.decode()),
+                resp.headers[base_handler.WRITE_TOKEN_HEADER])
+
+    def test_read_your_writes(self):
+        data, write_token = self._write('put', {'items': [{'name': "r1"}]})
+        ids = [item['id'] for item in data['items']]
+
+        # Reads sending back the write token go to the primary
+        self.assertIn("r1", self._names(write_token))
+
+        # Other reads go to the replica, which lags behind
+        self.assertNotIn("r1", self._names())
+        self._replicate()
+        self.assertIn("r1", self._names())
+
+        data, write_token = self._write('delete', {'ids': ids})
+        self.assertNotIn("r1", self._names(write_token))
+
+    def test_read_your_writes_across_processes(self):
+        data, write_token = self._write('put', {'items': [{'name': "r2"}]})
+        ids = [item['id'] for item in data['items']]
+
+        # Another server process starts with registries of its own and
+        # only knows of the write through the token
+        api.dispose_engines()
+        hdrs = dict(self.hdrs)
+        hdrs[base_handler.WRITE_TOKEN_HEADER] = write_token
+        try:
+            status, _, body = asyncio.run(test_api_asgi.call_asgi(
+                'GET', '/v1/items', hdrs))
+            self.assertEqual(status, 200, body)
+            self.assertIn("r2", [item['name'] for item in body['items']])
+
+            status, _, body = asyncio.run(test_api_asgi.call_asgi(
+                'GET', '/v1/items', self.hdrs))
+            self.assertEqual(status, 200, body)
+            self.assertNotIn("r2", [item['name'] for item in body['items']])
+        finally:
+            async_api.shutdown_executor()
+            api.dispose_engines()
+
+        self._write('delete', {'ids': ids})
+        self._replicate()
+
+    def test_write_token_checks(self):
+        data, write_token = self._write('put', {'items': [{'name': "r3"}]})
+        ids = [item['id'] for item in data['items']]
+        user_id, written_at, signature = write_token.split(":")
+
+        # Forged, foreign, expired and malformed tokens are ignored
+        tokens = [":".join([user_id, written_at, "0" * len(signature)]),
+                  ":".join([str(int(user_id) + 1), written_at, signature]),
+                  ":".join([user_id, str(float(written_at) - 61),
+                            signature]),
+                  "garbage"]
+        for token in tokens:
+            self.assertNotIn("r3", self._names(token))
+
+        with mock.patch('time.time', return_value=float(written_at) + 61):
+            self.assertNotIn("r3", self._names(write_token))
+        self.assertIn("r3", self._names(write_token))
+
+        self._write('delete', {'ids': ids})
+        self._replicate()
+
+    def test_replica_is_read_only(self):
+        self._get('/v1/items')
+        roles = [pool['role'] for pool in self._get('/v1/metrics')['db_pools']]
+        self.assertIn(api.ROLE_REPLICA, roles)
+
+        replica = api.get_scoped_session(replica=True)
+        try:
+            with self.assertRaises(Exception):
+                with replica.begin():
+                    replica.execute("DELETE FROM items")
+        finally:
+            replica.remove()
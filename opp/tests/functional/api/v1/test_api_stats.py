@@ -0,0 +1,87 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import contextlib
+from datetime import datetime
+
+import mock
+
+from opp.common import aescipher
+
+from . import BackendApiTest
+
+
+class TestCase(BackendApiTest):
+
+    """These tests exercise the top level request/response functionality of
+    the backend API.
+    Note: All tests share the same DB, so please beware of
+    unintended interaction when adding new tests"""
+    def setUp(self):
+        self.hdrs = {'x-opp-jwt': self.jwt,
+                     'Content-Type': "application/json"}
+
+    def test_stats_empty(self):
+        data = self._get('/v1/stats')
+        self.assertEqual(data['categories'], [])
+        self.assertEqual(data['orphans'], 0)
+        self.assertEqual(data['total_items'], 0)
+
+    def test_stats(self):
+        # Passphrase is only needed to create the data
+        self.hdrs['x-opp-phrase'] = "123456"
+        data = self._put('/v1/categories',
+                         {'category_names': ["s1", "s2"]})
+        cat_ids = [category['id'] for category in data['categories']]
+        items = [{'name': "a", 'category_id': cat_ids[0]},
+                 {'name': "b", 'category_id': cat_ids[0]},
+                 {'name': "c"}]
+        self._put('/v1/items', {'items': items})
+        del self.hdrs['x-opp-phrase']
+
+        # Nothing is decrypted, no cipher is even built
+        with contextlib.ExitStack() as stack:
+            mocks = [stack.enter_context(mock.patch.object(owner, name))
+                     for owner, name in [
+                         (aescipher.AESCipher, 'decrypt'),
+                         (aescipher.AESCipher, 'decrypt_many'),
+                         (aescipher.DecryptPool, 'decrypt_many'),
+                         (aescipher, 'get_verified_cipher'),
+                         (aescipher, 'get_data_cipher')]]
+            with self._count_statements() as statements:
+                data = self._get('/v1/stats')
+        for patched in mocks:
+            patched.assert_not_called()
+        self.assertLessEqual(len(statements), 4)
+        self.assertEqual(data['categories'],
+                         [{'id': cat_ids[0], 'items': 2},
+                          {'id': cat_ids[1], 'items': 0}])
+        self.assertEqual(data['orphans'], 1)
+        self.assertEqual(data['total_categories'], 2)
+        self.assertEqual(data['total_items'], 3)
+        last_modified = datetime.fromisoformat(data['last_modified'])
+        self.assertLess(abs((datetime.now() - last_modified).total_seconds()),
+                        60)
+
+        # Deleting is a change as well
+        self.hdrs['x-opp-phrase'] = "123456"
+        self._delete('/v1/categories', {'ids': cat_ids, 'cascade': True})
+        data = self._get('/v1/stats')
+        self.assertEqual(data['categories'], [])
+        self.assertEqual(data['total_items'], 1)
+        self.assertGreaterEqual(
+            datetime.fromisoformat(data['last_modified']), last_modified)
+        ids = [item['id'] for item in self._get('/v1/items')['items']]
+        self._delete('/v1/items', {'ids': ids})
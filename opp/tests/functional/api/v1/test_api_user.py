@@ -13,6 +13,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import json
+import threading
+
+import mock
+
+from opp.common import utils
+from opp.db import api
+
 from . import BackendApiTest
 
 
@@ -158,3 +166,62 @@ class TestCase(BackendApiTest):
         data = {"username": "test_user1", "password": "test_password2"}
         data = self._delete(path, data, 400)
         self.assertEqual(data['error'], "Incorrect password supplied!")
+
+    def _user_lookups(self, path):
+        with self._count_statements() as statements:
+            self._get(path)
+        return len([statement for statement in statements
+                    if "FROM users" in statement])
+
+    def test_identity_cache(self):
+        self.hdrs = {'Content-Type': "application/json"}
+        self._put('/v1/user', {"username": "cached", "password": "p1",
+                               "phrase": "123456"})
+        resp = self.client.post('/v1/auth', headers=self.hdrs,
+                                data=json.dumps({'username': "cached",
+                                                 'password': "p1"}))
+        self.hdrs['x-opp-jwt'] = json.loads(resp.data.decode())['access_token']
+
+        # Only the first request looks up the user
+        self._get('/v1/stats')
+        hits = api.get_identity_cache().stats()['hits']
+        self.assertEqual(self._user_lookups('/v1/stats'), 0)
+        self.assertEqual(api.get_identity_cache().stats()['hits'], hits + 1)
+
+        # Updating the user drops the cached copy
+        self._post('/v1/user', {"username": "cached", "password": "p1",
+                                "new_username": "cached2",
+                                "new_password": "p2"})
+        self.assertEqual(self._user_lookups('/v1/stats'), 1)
+        self.assertEqual(self._user_lookups('/v1/stats'), 0)
+
+        # Deleted users are no longer authenticated
+        self._delete('/v1/user', {"username": "cached2", "password": "p2"})
+        data = self._get('/v1/stats', 401)
+        self.assertEqual(data['description'], "User does not exist")
+
+    def test_auth_saturated(self):
+        self.hdrs = {'Content-Type': "application/json"}
+        credentials = json.dumps({'username': "u", 'password': "p"})
+        pool = utils.PasswordPool(1, 0)
+        self.addCleanup(pool.shutdown)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with mock.patch.object(utils, '_PASSWORD_POOL', pool):
+            with mock.patch.object(utils, 'checkpw',
+                                   side_effect=lambda *args: release.wait()):
+                future = pool.submit("p", "h")
+                resp = self.client.post('/v1/auth', headers=self.hdrs,
+                                        data=credentials)
+                self.assertEqual(resp.status_code, 429)
+                self.assertGreaterEqual(int(resp.headers['Retry-After']), 1)
+                release.set()
+                future.result()
+
+            resp = self.client.post('/v1/auth', headers=self.hdrs,
+                                    data=credentials)
+            self.assertEqual(resp.status_code, 200)
+            self.hdrs['x-opp-jwt'] = self.jwt
+            stats = self._get('/v1/metrics')['password_pool']
+            self.assertEqual(stats['checks'], 2)
+            self.assertEqual(stats['rejections'], 1)
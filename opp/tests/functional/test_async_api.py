@@ -0,0 +1,179 @@
+# Copyright 2017 OpenPassPhrase
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+from datetime import datetime, timedelta
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import inspect
+
+from opp.db import api, async_api, models
+from opp.common import opp_config, utils
+
+
+class TestCase(unittest.TestCase):
+
+    """These tests await the `async_api` functions directly.
+    Note: All tests share the same DB, so please beware of
+    unintended interaction when adding new tests"""
+    @classmethod
+    def setUpClass(cls):
+        cls.test_dir = tempfile.mkdtemp(prefix='opp_')
+        cls.conf_filepath = os.path.join(cls.test_dir, 'opp.cfg')
+        cls.db_filepath = os.path.join(cls.test_dir, 'test.sqlite')
+        cls.connection = ("[DEFAULT]\ndb_connect = sqlite:///%s" %
+                          cls.db_filepath)
+        with open(cls.conf_filepath, 'w') as conf_file:
+            conf_file.write(cls.connection)
+            conf_file.flush()
+        utils.execute("opp-db --config_file %s init" % cls.conf_filepath)
+        utils.execute("opp-db --config_file %s add-user -uu -pp "
+                      "--phrase=123456" % cls.conf_filepath)
+
+    @classmethod
+    def tearDownClass(cls):
+        async_api.shutdown_executor()
+        # Close pooled connections so SQLite removes its WAL files
+        api.dispose_engines()
+        try:
+            os.remove(cls.conf_filepath)
+        except Exception:
+            pass
+        try:
+            os.remove(cls.db_filepath)
+        except Exception:
+            pass
+        try:
+            os.rmdir(cls.test_dir)
+        except Exception:
+            pass
+
+    def setUp(self):
+        self.conf = opp_config.OppConfig(self.conf_filepath)
+        self.u = self._run(async_api.user_get_by_username("u",
+                                                          conf=self.conf))
+
+    def _run(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_user_get(self):
+        self.assertEqual(self.u.username, "u")
+        self.assertIsNone(self._run(async_api.user_get_by_username(
+            "nobody", conf=self.conf)))
+
+        user = self._run(async_api.user_get_cached(self.u.id,
+                                                   conf=self.conf))
+        self.assertEqual(user.id, self.u.id)
+        self.assertIsNone(self._run(async_api.user_get_cached(
+            self.u.id + 1000, conf=self.conf)))
+
+    def test_categories(self):
+        since = datetime.now() - timedelta(seconds=1)
+        ids = self._run(async_api.category_create_bulk(
+            self.u, [{'name': b"cat1"}, {'name': b"cat2"}], conf=self.conf))
+        self.assertEqual(len(ids), 2)
+
+        # Rows come back detached, with their attributes loaded
+        categories = self._run(async_api.category_getall(
+            self.u, ids, conf=self.conf))
+        self.assertEqual([c.name for c in categories], [b"cat1", b"cat2"])
+        self.assertTrue(all(inspect(c).detached for c in categories))
+
+        missing = self._run(async_api.category_update_bulk(
+            self.u, [{'id': ids[0], 'name': b"new"},
+                     {'id': ids[1] + 1000, 'name': b"none"}],
+            conf=self.conf))
+        self.assertEqual(missing, [ids[1] + 1000])
+        categories = self._run(async_api.category_getall(
+            self.u, ids, replica=True, conf=self.conf))
+        self.assertEqual([c.name for c in categories], [b"new", b"cat2"])
+
+        categories = self._run(async_api.category_getall(
+            self.u, ids, with_items=True, conf=self.conf))
+        self.assertEqual(categories[0].items, [])
+
+        deleted = self._run(async_api.category_delete_by_id(
+            self.u, ids, True, conf=self.conf))
+        self.assertEqual(deleted, (2, 0))
+        self.assertEqual(self._run(async_api.category_getall(
+            self.u, ids, conf=self.conf)), [])
+
+        tombstones = self._run(async_api.tombstone_getall(
+            self.u, since, conf=self.conf))
+        for category_id in ids:
+            self.assertIn((models.Tombstone.CATEGORY, category_id),
+                          tombstones)
+
+    def test_items(self):
+        since = datetime.now() - timedelta(seconds=1)
+        cat_ids = self._run(async_api.category_create_bulk(
+            self.u, [{'name': b"cat"}], conf=self.conf))
+        ids = self._run(async_api.item_create_bulk(
+            self.u, [{'blob': b"item%d" % i, 'category_id': cat_ids[0]}
+                     for i in range(3)], conf=self.conf))
+        self.assertEqual(len(ids), 3)
+
+        # Categories are joined into the query and loaded along
+        items = self._run(async_api.item_getall(self.u, ids,
+                                                conf=self.conf))
+        self.assertEqual([item.blob for item in items],
+                         [b"item0", b"item1", b"item2"])
+        self.assertEqual(items[0].category.name, b"cat")
+
+        # Pages
+        page = self._run(async_api.item_getall(
+            self.u, ids, limit=2, conf=self.conf))
+        self.assertEqual([item.id for item in page], ids[:2])
+        page = self._run(async_api.item_getall(
+            self.u, ids, limit=2, after=(page[-1].sort_id, page[-1].id),
+            with_category=False, conf=self.conf))
+        self.assertEqual([item.id for item in page], ids[2:])
+
+        missing = self._run(async_api.item_update_bulk(
+            self.u, [{'id': ids[0], 'blob': b"new"}], conf=self.conf))
+        self.assertEqual(missing, [])
+        items = self._run(async_api.item_getall(
+            self.u, ids[:1], replica=True, conf=self.conf))
+        self.assertEqual(items[0].blob, b"new")
+
+        deleted = self._run(async_api.item_delete_by_id(
+            self.u, ids[:2], conf=self.conf))
+        self.assertEqual(deleted, 2)
+        tombstones = self._run(async_api.tombstone_getall(
+            self.u, since, conf=self.conf))
+        self.assertIn((models.Tombstone.ITEM, ids[0]), tombstones)
+        self.assertIn((models.Tombstone.ITEM, ids[1]), tombstones)
+        self.assertNotIn((models.Tombstone.ITEM, ids[2]), tombstones)
+
+        # Clean up
+        deleted = self._run(async_api.category_delete_by_id(
+            self.u, cat_ids, True, conf=self.conf))
+        self.assertEqual(deleted, (1, 1))
+        self.assertEqual(self._run(async_api.item_getall(
+            self.u, conf=self.conf)), [])
+
+    def test_concurrent_reads(self):
+        async def read_all():
+            return await asyncio.gather(
+                async_api.category_getall(self.u, conf=self.conf),
+                async_api.item_getall(self.u, conf=self.conf),
+                async_api.user_get_by_username("u", conf=self.conf))
+
+        categories, items, user = self._run(read_all())
+        self.assertEqual(categories, [])
+        self.assertEqual(items, [])
+        self.assertEqual(user.id, self.u.id)
@@ -13,6 +13,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from datetime import datetime
 import os
 import tempfile
 import unittest
@@ -43,6 +44,8 @@ class TestCase(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        # Close pooled connections so SQLite removes its WAL files
+        api.dispose_engines()
         try:
             os.remove(cls.conf_filepath)
         except Exception:
@@ -69,28 +72,29 @@ class TestCase(unittest.TestCase):
         with self.s.begin():
             categories = api.category_getall(self.s, self.u)
             self.assertEqual(categories, [])
-            category = models.Category(name="name", user=self.u)
+            category = models.Category(name=b"name", user=self.u)
             api.category_create(self.s, [category])
 
         # Retrieve and verify inserted category
         with self.s.begin():
             categories = api.category_getall(self.s, self.u)
             self.assertEqual(len(categories), 1)
-            self.assertEqual(categories[0].name, "name")
+            self.assertEqual(categories[0].name, b"name")
 
         # Update the category
         with self.s.begin():
-            category.name = 'new name'
+            category.name = b'new name'
             api.category_update(self.s, [category])
 
         # Check the updated category
         with self.s.begin():
             categories = api.category_getall(self.s, self.u)
             self.assertEqual(len(categories), 1)
-            self.assertEqual(categories[0].name, "new name")
+            self.assertEqual(categories[0].name, b"new name")
 
         # Clean up
         with self.s.begin():
+            categories = api.category_getall(self.s, self.u, with_items=True)
             api.category_delete(self.s, categories, True)
 
         # Verify clean up successful
@@ -101,9 +105,9 @@ class TestCase(unittest.TestCase):
     def test_categories_get_filter(self):
         # Insert several categories
         with self.s.begin():
-            categories = [models.Category(name="name0", user=self.u),
-                          models.Category(name="name1", user=self.u),
-                          models.Category(name="name2", user=self.u)]
+            categories = [models.Category(name=b"name0", user=self.u),
+                          models.Category(name=b"name1", user=self.u),
+                          models.Category(name=b"name2", user=self.u)]
             api.category_create(self.s, categories)
 
         # Retrieve first and last categories only
@@ -111,12 +115,12 @@ class TestCase(unittest.TestCase):
             ids = [1, 3]
             categories = api.category_getall(self.s, self.u, filter_ids=ids)
             self.assertEqual(len(categories), 2)
-            self.assertEqual(categories[0].name, "name0")
-            self.assertEqual(categories[1].name, "name2")
+            self.assertEqual(categories[0].name, b"name0")
+            self.assertEqual(categories[1].name, b"name2")
 
         # Clean up
         with self.s.begin():
-            categories = api.category_getall(self.s, self.u)
+            categories = api.category_getall(self.s, self.u, with_items=True)
             api.category_delete(self.s, categories, True)
 
         # Verify clean up successful
@@ -127,9 +131,9 @@ class TestCase(unittest.TestCase):
     def test_categories_delete_by_id(self):
         # Insert several categories
         with self.s.begin():
-            categories = [models.Category(name="name3", user=self.u),
-                          models.Category(name="name4", user=self.u),
-                          models.Category(name="name5", user=self.u)]
+            categories = [models.Category(name=b"name3", user=self.u),
+                          models.Category(name=b"name4", user=self.u),
+                          models.Category(name=b"name5", user=self.u)]
             api.category_create(self.s, categories)
 
         # Delete first and last categories only
@@ -141,11 +145,11 @@ class TestCase(unittest.TestCase):
         with self.s.begin():
             categories = api.category_getall(self.s, self.u)
             self.assertEqual(len(categories), 1)
-            self.assertEqual(categories[0].name, "name4")
+            self.assertEqual(categories[0].name, b"name4")
 
         # Clean up
         with self.s.begin():
-            categories = api.category_getall(self.s, self.u)
+            categories = api.category_getall(self.s, self.u, with_items=True)
             api.category_delete(self.s, categories, True)
 
         # Verify clean up successful
@@ -156,23 +160,23 @@ class TestCase(unittest.TestCase):
     def test_categories_delete_cascade(self):
         # Create two categories
         with self.s.begin():
-            categories = [models.Category(name="cat1", user=self.u),
-                          models.Category(name="cat2", user=self.u)]
+            categories = [models.Category(name=b"cat1", user=self.u),
+                          models.Category(name=b"cat2", user=self.u)]
             api.category_create(self.s, categories)
 
         # Verify created categories
         with self.s.begin():
             categories = api.category_getall(self.s, self.u)
             self.assertEqual(len(categories), 2)
-            self.assertEqual(categories[0].name, "cat1")
-            self.assertEqual(categories[1].name, "cat2")
+            self.assertEqual(categories[0].name, b"cat1")
+            self.assertEqual(categories[1].name, b"cat2")
 
         # Create 4 items
         with self.s.begin():
-            items = [models.Item(blob="item1", category_id=1, user=self.u),
-                     models.Item(blob="item2", category_id=1, user=self.u),
-                     models.Item(blob="item3", category_id=2, user=self.u),
-                     models.Item(blob="item4", category_id=2, user=self.u)]
+            items = [models.Item(blob=b"item1", category_id=1, user=self.u),
+                     models.Item(blob=b"item2", category_id=1, user=self.u),
+                     models.Item(blob=b"item3", category_id=2, user=self.u),
+                     models.Item(blob=b"item4", category_id=2, user=self.u)]
             api.item_create(self.s, items)
 
         # Verify created items
@@ -181,37 +185,46 @@ class TestCase(unittest.TestCase):
             self.assertEqual(len(items), 4)
 
             i1, i2, i3, i4 = items
+            deleted_ids = [i1.id, i2.id]
 
-            self.assertEqual(i1.blob, "item1")
+            self.assertEqual(i1.blob, b"item1")
             self.assertEqual(i1.category_id, 1)
             self.assertIsNotNone(i1.category)
             self.assertEqual(i1.category.id, 1)
 
-            self.assertEqual(i2.blob, "item2")
+            self.assertEqual(i2.blob, b"item2")
             self.assertEqual(i2.category_id, 1)
             self.assertIsNotNone(i2.category)
             self.assertEqual(i1.category.id, 1)
 
-            self.assertEqual(i3.blob, "item3")
+            self.assertEqual(i3.blob, b"item3")
             self.assertEqual(i3.category_id, 2)
             self.assertIsNotNone(i3.category)
             self.assertEqual(i3.category.id, 2)
 
-            self.assertEqual(i4.blob, "item4")
+            self.assertEqual(i4.blob, b"item4")
             self.assertEqual(i4.category_id, 2)
             self.assertIsNotNone(i4.category)
             self.assertEqual(i4.category.id, 2)
 
         # Delete category 1 with cascade
+        since = datetime.now()
         with self.s.begin():
-            categories = api.category_getall(self.s, self.u)
+            categories = api.category_getall(self.s, self.u, with_items=True)
             api.category_delete(self.s, categories[:1], cascade=True)
 
+        # Tombstones were recorded for the category and its items
+        with self.s.begin():
+            self.assertEqual(api.tombstone_getall(self.s, self.u, since),
+                             [(models.Tombstone.ITEM, deleted_ids[0]),
+                              (models.Tombstone.ITEM, deleted_ids[1]),
+                              (models.Tombstone.CATEGORY, 1)])
+
         # Verify only 1 category remains
         with self.s.begin():
             categories = api.category_getall(self.s, self.u)
             self.assertEqual(len(categories), 1)
-            self.assertEqual(categories[0].name, "cat2")
+            self.assertEqual(categories[0].name, b"cat2")
 
         # Verify items 1 & 2 were deleted through cascade action
         # and that items 3 & 4 remain unchanged
@@ -219,19 +232,26 @@ class TestCase(unittest.TestCase):
             items = api.item_getall(self.s, self.u)
             self.assertEqual(len(items), 2)
             i3, i4 = items
-            self.assertEqual(i3.blob, "item3")
+            self.assertEqual(i3.blob, b"item3")
             self.assertEqual(i3.category_id, 2)
             self.assertIsNotNone(i3.category)
             self.assertEqual(i3.category.id, 2)
-            self.assertEqual(i4.blob, "item4")
+            self.assertEqual(i4.blob, b"item4")
             self.assertEqual(i4.category_id, 2)
             self.assertIsNotNone(i4.category)
             self.assertEqual(i4.category.id, 2)
 
         # Delete category 2 without cascade
+        since = datetime.now()
         with self.s.begin():
+            categories = api.category_getall(self.s, self.u, with_items=True)
             api.category_delete(self.s, categories, cascade=False)
 
+        # Only the category got a tombstone, its items were kept
+        with self.s.begin():
+            self.assertEqual(api.tombstone_getall(self.s, self.u, since),
+                             [(models.Tombstone.CATEGORY, 2)])
+
         # Verify categories list is now empty
         with self.s.begin():
             categories = api.category_getall(self.s, self.u)
@@ -242,16 +262,16 @@ class TestCase(unittest.TestCase):
             items = api.item_getall(self.s, self.u)
             self.assertEqual(len(items), 2)
             i3, i4 = items
-            self.assertEqual(i3.blob, "item3")
+            self.assertEqual(i3.blob, b"item3")
             self.assertEqual(i3.category_id, None)
             self.assertIsNone(i3.category)
-            self.assertEqual(i4.blob, "item4")
+            self.assertEqual(i4.blob, b"item4")
             self.assertEqual(i4.category_id, None)
             self.assertIsNone(i4.category)
 
         # Remove remaining category
         with self.s.begin():
-            categories = api.category_getall(self.s, self.u)
+            categories = api.category_getall(self.s, self.u, with_items=True)
             api.category_delete(self.s, categories, True)
 
         # Verify categories list is now empty
@@ -265,10 +285,10 @@ class TestCase(unittest.TestCase):
             items = api.item_getall(self.s, self.u)
             self.assertEqual(len(items), 2)
             i3, i4 = items
-            self.assertEqual(i3.blob, "item3")
+            self.assertEqual(i3.blob, b"item3")
             self.assertEqual(i3.category_id, None)
             self.assertIsNone(i3.category)
-            self.assertEqual(i4.blob, "item4")
+            self.assertEqual(i4.blob, b"item4")
             self.assertEqual(i4.category_id, None)
             self.assertIsNone(i4.category)
 
@@ -286,17 +306,17 @@ class TestCase(unittest.TestCase):
         with self.s.begin():
             categories = api.category_getall(self.s, self.u)
             self.assertEqual(categories, [])
-            category = models.Category(name="name", user=self.u)
+            category = models.Category(name=b"name", user=self.u)
             api.category_create(self.s, [category])
-            items = [models.Item(blob="item1", category_id=1, user=self.u),
-                     models.Item(blob="item2", category_id=1, user=self.u)]
+            items = [models.Item(blob=b"item1", category_id=1, user=self.u),
+                     models.Item(blob=b"item2", category_id=1, user=self.u)]
             api.item_create(self.s, items)
 
         # Retrieve and verify inserted category
         with self.s.begin():
-            categories = api.category_getall(self.s, self.u)
+            categories = api.category_getall(self.s, self.u, with_items=True)
             self.assertEqual(len(categories), 1)
-            self.assertEqual(categories[0].name, "name")
+            self.assertEqual(categories[0].name, b"name")
             self.assertEqual(len(categories[0].items), 2)
 
         # Add another user and retrieve it
@@ -312,6 +332,7 @@ class TestCase(unittest.TestCase):
 
         # Clean up
         with self.s.begin():
+            categories = api.category_getall(self.s, self.u, with_items=True)
             api.category_delete(self.s, categories, True)
 
         # Verify clean up successful
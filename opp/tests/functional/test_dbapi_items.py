@@ -13,12 +13,18 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
+from datetime import datetime
+import json
 import os
 import tempfile
 import unittest
 
+import mock
+from sqlalchemy.dialects import postgresql
+
 from opp.db import api, models
-from opp.common import opp_config, utils
+from opp.common import aescipher, opp_config, utils
 
 
 def with_session(function):
@@ -50,6 +56,8 @@ class TestCase(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        # Close pooled connections so SQLite removes its WAL files
+        api.dispose_engines()
         try:
             os.remove(cls.conf_filepath)
         except Exception:
@@ -76,30 +84,30 @@ class TestCase(unittest.TestCase):
         with self.s.begin():
             items = api.item_getall(self.s, self.u)
             self.assertEqual(items, [])
-            item = models.Item(blob="blob", category_id=None, user=self.u)
+            item = models.Item(blob=b"blob", category_id=None, user=self.u)
             api.item_create(self.s, [item])
 
         # Retrieve and verify inserted item
         with self.s.begin():
             items = api.item_getall(self.s, self.u)
             self.assertEqual(len(items), 1)
-            self.assertEqual(items[0].blob, "blob")
+            self.assertEqual(items[0].blob, b"blob")
 
         # Update the item
         with self.s.begin():
-            item.blob = "new blob"
+            item.blob = b"new blob"
             api.item_update(self.s, [item])
 
         # Check the updated item
         with self.s.begin():
             items = api.item_getall(self.s, self.u)
             self.assertEqual(len(items), 1)
-            self.assertEqual(items[0].blob, "new blob")
+            self.assertEqual(items[0].blob, b"new blob")
             self.assertEqual(items[0].category_id, None)
 
         # Update item with valid category
         with self.s.begin():
-            category = models.Category(name="blah", user=self.u)
+            category = models.Category(name=b"blah", user=self.u)
             api.category_create(self.s, [category])
             item.category_id = 1
             api.item_update(self.s, [item])
@@ -108,13 +116,13 @@ class TestCase(unittest.TestCase):
         with self.s.begin():
             items = api.item_getall(self.s, self.u)
             self.assertEqual(len(items), 1)
-            self.assertEqual(items[0].blob, "new blob")
+            self.assertEqual(items[0].blob, b"new blob")
             self.assertEqual(items[0].category_id, 1)
             self.assertIsNotNone(items[0].category)
 
         # Clean up
         with self.s.begin():
-            categories = api.category_getall(self.s, self.u)
+            categories = api.category_getall(self.s, self.u, with_items=True)
             api.category_delete(self.s, categories, True)
 
         # Verify clean up successful
@@ -127,9 +135,9 @@ class TestCase(unittest.TestCase):
     def test_items_get_filter(self):
         # Insert several items
         with self.s.begin():
-            items = [models.Item(blob="blob0", user=self.u),
-                     models.Item(blob="blob1", user=self.u),
-                     models.Item(blob="blob2", user=self.u)]
+            items = [models.Item(blob=b"blob0", user=self.u),
+                     models.Item(blob=b"blob1", user=self.u),
+                     models.Item(blob=b"blob2", user=self.u)]
             api.item_create(self.s, items)
 
         # Retrieve first and last items only
@@ -137,25 +145,29 @@ class TestCase(unittest.TestCase):
             ids = [1, 3]
             items = api.item_getall(self.s, self.u, filter_ids=ids)
             self.assertEqual(len(items), 2)
-            self.assertEqual(items[0].blob, "blob0")
-            self.assertEqual(items[1].blob, "blob2")
+            self.assertEqual(items[0].blob, b"blob0")
+            self.assertEqual(items[1].blob, b"blob2")
 
         # Clean up
+        since = datetime.now()
         with self.s.begin():
             items = api.item_getall(self.s, self.u)
+            ids = [item.id for item in items]
             api.item_delete(self.s, items)
 
-        # Verify clean up successful
+        # Verify clean up successful and recorded for syncing clients
         with self.s.begin():
             items = api.item_getall(self.s, self.u)
             self.assertEqual(len(items), 0)
+            self.assertEqual(api.tombstone_getall(self.s, self.u, since),
+                             [(models.Tombstone.ITEM, i) for i in ids])
 
     def test_items_delete_by_id(self):
         # Insert several items
         with self.s.begin():
-            items = [models.Item(blob="blob3", user=self.u),
-                     models.Item(blob="blob4", user=self.u),
-                     models.Item(blob="blob5", user=self.u)]
+            items = [models.Item(blob=b"blob3", user=self.u),
+                     models.Item(blob=b"blob4", user=self.u),
+                     models.Item(blob=b"blob5", user=self.u)]
             api.item_create(self.s, items)
 
         # Delete first and last items only
@@ -167,7 +179,7 @@ class TestCase(unittest.TestCase):
         with self.s.begin():
             items = api.item_getall(self.s, self.u)
             self.assertEqual(len(items), 1)
-            self.assertEqual(items[0].blob, "blob4")
+            self.assertEqual(items[0].blob, b"blob4")
 
         # Clean up
         with self.s.begin():
@@ -184,16 +196,16 @@ class TestCase(unittest.TestCase):
         with self.s.begin():
             items = api.item_getall(self.s, self.u)
             self.assertEqual(items, [])
-            items = [models.Item(blob="item1", user=self.u),
-                     models.Item(blob="item2", user=self.u)]
+            items = [models.Item(blob=b"item1", user=self.u),
+                     models.Item(blob=b"item2", user=self.u)]
             api.item_create(self.s, items)
 
         # Retrieve and verify inserted items
         with self.s.begin():
             items = api.item_getall(self.s, self.u)
             self.assertEqual(len(items), 2)
-            self.assertEqual(items[0].blob, "item1")
-            self.assertEqual(items[1].blob, "item2")
+            self.assertEqual(items[0].blob, b"item1")
+            self.assertEqual(items[1].blob, b"item2")
 
         # Add another user and retrieve it
         utils.execute("opp-db --config_file %s add-user -uu2 -pp "
@@ -215,3 +227,324 @@ class TestCase(unittest.TestCase):
         with self.s.begin():
             items = api.item_getall(self.s, self.u)
             self.assertEqual(len(items), 0)
+
+    def test_items_create_bulk(self):
+        # Insert more items than fit in a single batch
+        rows = [{'blob': b"bulk%d" % i} for i in range(5)]
+        with self.s.begin():
+            ids = api.item_create_bulk(self.s, self.u, rows, batch_size=2)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(ids, sorted(ids))
+
+        # Check generated ids map to the inserted rows
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u, filter_ids=ids)
+            blobs = {item.id: item.blob for item in items}
+            for item_id, row in zip(ids, rows):
+                self.assertEqual(blobs[item_id], row['blob'])
+
+        # Clean up
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u)
+            api.item_delete(self.s, items)
+
+        # Verify clean up successful
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u)
+            self.assertEqual(len(items), 0)
+
+    def test_items_create_bulk_interleaved(self):
+        # Another import for the same user commits between the batches of
+        # this one
+        insert_ids = api._insert_ids
+        other = []
+
+        def interleave(session, table, batch):
+            ids = insert_ids(session, table, batch)
+            if not other:
+                other.append(None)
+                other[:] = api.item_create_bulk(
+                    self.s, self.u, [{'blob': b"other%d" % i}
+                                     for i in range(3)])
+            return ids
+
+        rows = [{'blob': b"mine%d" % i} for i in range(4)]
+        with mock.patch.object(api, '_insert_ids', side_effect=interleave):
+            with self.s.begin():
+                ids = api.item_create_bulk(self.s, self.u, rows,
+                                           batch_size=2)
+        self.assertEqual(len(other), 3)
+        self.assertEqual(set(ids) & set(other), set())
+
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u, filter_ids=ids + other)
+            blobs = {item.id: item.blob for item in items}
+        self.assertEqual([blobs[item_id] for item_id in ids],
+                         [row['blob'] for row in rows])
+        self.assertEqual([blobs[item_id] for item_id in other],
+                         [b"other%d" % i for i in range(3)])
+
+        # Clean up
+        with self.s.begin():
+            api.item_delete_all(self.s, self.u)
+
+    def _mock_session(self, dialect, results):
+        session = mock.Mock()
+        session.get_bind.return_value.dialect.name = dialect
+        session.execute.side_effect = results
+        return session
+
+    def test_insert_ids_postgresql(self):
+        # The ids are drawn from the sequence and inserted with the rows
+        table = models.Item.__table__
+        rows = [{'blob': b"a"}, {'blob': b"b"}]
+        session = self._mock_session('postgresql', [[(7,), (9,)], None])
+        self.assertEqual(api._insert_ids(session, table, rows), [7, 9])
+        select, insert = session.execute.call_args_list
+        self.assertIn("nextval('item_id_seq')", str(select[0][0].compile(
+            dialect=postgresql.dialect())))
+        self.assertEqual(insert[0][1], [{'blob': b"a", 'id': 7},
+                                        {'blob': b"b", 'id': 9}])
+
+    def test_insert_ids_mysql(self):
+        table = models.Item.__table__
+        rows = [{'blob': b"a"}, {'blob': b"b"}, {'blob': b"c"}]
+
+        # Consecutive lock mode, one statement for the whole batch
+        session = self._mock_session('mysql', [
+            mock.Mock(first=mock.Mock(return_value=(1, 2))),
+            mock.Mock(lastrowid=11)])
+        self.assertEqual(api._insert_ids(session, table, rows), [11, 13, 15])
+        self.assertEqual(session.execute.call_count, 2)
+
+        # Interleaved lock mode, one statement per row
+        session = self._mock_session('mysql', [
+            mock.Mock(first=mock.Mock(return_value=(2, 1)))] + [
+            mock.Mock(inserted_primary_key=[row_id]) for row_id in (4, 8, 6)])
+        self.assertEqual(api._insert_ids(session, table, rows), [4, 8, 6])
+        self.assertEqual(session.execute.call_count, 4)
+
+    def test_items_update_bulk(self):
+        # Insert several items
+        with self.s.begin():
+            ids = api.item_create_bulk(self.s, self.u,
+                                       [{'blob': b"blob6"}, {'blob': b"blob7"}])
+
+        # Update both items in a single batch
+        rows = [{'id': ids[0], 'blob': b"new blob6"},
+                {'id': ids[1], 'blob': b"new blob7"}]
+        with self.s.begin():
+            missing = api.item_update_bulk(self.s, self.u, rows, batch_size=1)
+            self.assertEqual(missing, [])
+
+        # Check the updated items
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u)
+            self.assertEqual([item.blob for item in items],
+                             [b"new blob6", b"new blob7"])
+
+        # Unknown and foreign ids are reported
+        utils.execute("opp-db --config_file %s add-user -uu3 -pp "
+                      "--phrase=123456" % self.conf_filepath)
+        new_u = api.user_get_by_username(self.s, "u3")
+        rows = [{'id': ids[0], 'blob': b"blob8"},
+                {'id': ids[1] + 100, 'blob': b"blob9"}]
+        with self.s.begin():
+            missing = api.item_update_bulk(self.s, new_u, rows)
+            self.assertEqual(missing, [ids[0], ids[1] + 100])
+
+        # Clean up
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u)
+            api.item_delete(self.s, items)
+
+        # Verify clean up successful
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u)
+            self.assertEqual(len(items), 0)
+
+    def test_items_record_format(self):
+        cipher = aescipher.AESCipher("123456")
+        fields = [{field: "%s%d" % (field, i)
+                   for field in models.Item.SECRET_FIELDS}
+                  for i in range(4)]
+        legacy = dict(zip(models.Item.SECRET_FIELDS, cipher.encrypt_many(
+            [fields[0][field] for field in models.Item.SECRET_FIELDS],
+            binary=True)))
+        records = models.Item.encrypt_many(fields[1:3], cipher)
+        self.assertEqual(records[0]['name'], None)
+        # Version 1 records hold all fields, without details
+        version1 = {'record': cipher.encrypt_many([chr(1) + json.dumps(
+            [fields[3][field] for field in models.Item.SECRET_FIELDS])],
+            binary=True)[0]}
+        with self.s.begin():
+            ids = api.item_create_bulk(self.s, self.u, [legacy])
+            ids += api.item_create_bulk(self.s, self.u, records)
+            ids += api.item_create_bulk(self.s, self.u, [version1])
+
+        # All formats are read in one batch
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u, with_category=False)
+            extracted = models.Item.extract_many(items, cipher, False)
+            self.assertEqual(
+                [{field: item[field] for field in models.Item.SECRET_FIELDS}
+                 for item in extracted], fields)
+            legacy = api.item_getall_legacy(self.s, self.u, 10)
+            self.assertEqual([item.id for item in legacy],
+                             [ids[0], ids[3]])
+
+        # Projections only decrypt the records holding the fields
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u, with_category=False,
+                                    fields=['url', 'name'])
+            projected = models.Item.extract_many(items, cipher, False,
+                                                 ['url', 'name'])
+            # Deferred columns are left unloaded
+            self.assertNotIn('details', items[1].__dict__)
+            self.assertNotIn('blob', items[0].__dict__)
+            self.assertEqual(
+                projected, [{'id': ids[i], 'name': fields[i]['name'],
+                             'url': fields[i]['url'], 'sort_id': 0,
+                             'category_id': None} for i in range(4)])
+            items = api.item_getall(self.s, self.u, with_category=False,
+                                    fields=['password'])
+            self.assertEqual(
+                [item['password'] for item in models.Item.extract_many(
+                    items, cipher, False, ['password'])],
+                [entry['password'] for entry in fields])
+            self.assertRaises(ValueError, models.Item.deferred_columns,
+                              ['record'])
+
+        # Items updated after they were read are not upgraded
+        with self.s.begin():
+            legacy = api.item_getall_legacy(self.s, self.u, 10)
+            rows = models.Item.upgrade_many(legacy, cipher)
+            api.item_update_bulk(self.s, self.u, [
+                {'id': ids[0], 'name': cipher.encrypt_many(
+                    [fields[0]['name']], binary=True)[0]},
+                {'id': ids[3], 'name': None}])
+            self.assertEqual(
+                api.item_upgrade_bulk(self.s, self.u, legacy, rows), 0)
+        with self.s.begin():
+            legacy = api.item_getall_legacy(self.s, self.u, 10)
+            rows = models.Item.upgrade_many(legacy, cipher)
+            self.assertEqual(
+                api.item_upgrade_bulk(self.s, self.u, legacy, rows), 2)
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u, with_category=False)
+            self.assertEqual(models.Item.extract_many(items, cipher, False),
+                             extracted)
+
+        # Unknown record versions are rejected
+        record = cipher.encrypt_many([chr(3) + "[]"], binary=True)[0]
+        item = models.Item(id=1, record=record)
+        self.assertRaises(ValueError, item.extract, cipher, False)
+
+        with self.s.begin():
+            self.assertEqual(api.item_delete_all(self.s, self.u), 4)
+
+    def test_items_base64_text(self):
+        # Values written as base64 text by older versions are still read
+        cipher = aescipher.AESCipher("123456")
+        fields = {field: field for field in models.Item.SECRET_FIELDS}
+        row = models.Item.encrypt_many([fields], cipher)[0]
+        record = row['record']
+        with self.s.begin():
+            self.s.execute(
+                "INSERT INTO items (user_id, sort_id, record, details, "
+                "created_at, updated_at) VALUES (:user_id, 0, :record, "
+                ":details, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)",
+                {'user_id': self.u.id,
+                 'record': base64.b64encode(record).decode(),
+                 'details': base64.b64encode(row['details']).decode()})
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u, with_category=False)
+            self.assertEqual(items[0].record, record)
+            extracted = models.Item.extract_many(items, cipher, False)
+            self.assertEqual(extracted[0]['password'], "password")
+            self.assertEqual(api.item_delete_all(self.s, self.u), 1)
+
+    def test_items_delete_chunked(self):
+        # Insert more items than fit in a single IN clause
+        count = api.IN_CLAUSE_SIZE + 10
+        with self.s.begin():
+            ids = api.item_create_bulk(self.s, self.u,
+                                       [{'blob': b"blob"}] * count)
+
+        # Delete all but the last item, plus some unknown ids
+        with self.s.begin():
+            deleted = api.item_delete_by_id(self.s, self.u,
+                                            ids[:-1] + [ids[-1] + 1])
+            self.assertEqual(deleted, count - 1)
+
+        # Delete the rest
+        with self.s.begin():
+            self.assertEqual(api.item_delete_all(self.s, self.u), 1)
+
+        # Verify clean up successful
+        with self.s.begin():
+            items = api.item_getall(self.s, self.u)
+            self.assertEqual(len(items), 0)
+
+    def test_items_keyset_pages(self):
+        # Insert items with colliding sort ids
+        rows = [{'blob': b"page%d" % i, 'sort_id': i // 2} for i in range(5)]
+        with self.s.begin():
+            ids = api.item_create_bulk(self.s, self.u, rows)
+
+        # Walk the pages, each continuing after the last item of the previous
+        pages = []
+        after = None
+        with self.s.begin():
+            while True:
+                items = api.item_getall(self.s, self.u, limit=2, after=after)
+                if not items:
+                    break
+                pages.append([item.id for item in items])
+                after = (items[-1].sort_id, items[-1].id)
+        self.assertEqual(pages, [ids[0:2], ids[2:4], ids[4:]])
+
+        # Clean up
+        with self.s.begin():
+            api.item_delete_all(self.s, self.u)
+
+    def _query_plan(self, query):
+        engine = self.s.get_bind()
+        statement = query.statement.compile(
+            dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+        rows = engine.execute("EXPLAIN QUERY PLAN %s" % statement)
+        return " ".join(row[-1] for row in rows)
+
+    def test_query_plans(self):
+        # Per-user item and category listings are served by an index scan
+        # in sort order, without a separate sort step
+        query = self.s.query(models.Item).order_by(
+            models.Item.sort_id).filter(
+            models.Item.user_id == self.u.id)
+        plan = self._query_plan(query)
+        self.assertIn("USING INDEX items_user_id_sort_id_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+        query = self.s.query(models.Category).filter(
+            models.Category.user_id == self.u.id).order_by(
+            models.Category.sort_id)
+        plan = self._query_plan(query)
+        self.assertIn("USING INDEX categories_user_id_sort_id_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+        # Later pages are a range scan of the same index
+        query = self.s.query(models.Item).filter(
+            models.Item.user_id == self.u.id).order_by(
+            models.Item.sort_id, models.Item.id)
+        query = api._keyset(query, models.Item, (3, 10)).limit(100)
+        plan = self._query_plan(query)
+        self.assertIn("USING INDEX items_user_id_sort_id_idx "
+                      "(user_id=? AND sort_id>?)", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+        # Items of a set of categories are located by user and category
+        query = self.s.query(models.Item).filter(
+            models.Item.user_id == self.u.id).filter(
+            models.Item.category_id.in_([1, 2]))
+        plan = self._query_plan(query)
+        self.assertIn("USING INDEX items_user_id_category_id_idx", plan)
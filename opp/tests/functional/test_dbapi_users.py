@@ -13,12 +13,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import mock
 import os
 import tempfile
 import unittest
 
+from sqlalchemy import exc
+
 from opp.db import api, models
-from opp.common import opp_config, utils
+from opp.common import aescipher, opp_config, utils
 
 
 def with_session(function):
@@ -48,6 +51,8 @@ class TestCase(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        # Close pooled connections so SQLite removes its WAL files
+        api.dispose_engines()
         try:
             os.remove(cls.conf_filepath)
         except Exception:
@@ -92,3 +97,103 @@ class TestCase(unittest.TestCase):
         api.user_delete_by_username(self.s, user.username)
         user = api.user_get_by_id(self.s, user.id)
         self.assertIsNone(user)
+
+    def test_user_caches(self):
+        cipher = aescipher.AESCipher("123456")
+        with self.s.begin():
+            user = models.User(username="cached", password="pass",
+                               phrase_check=cipher.encrypt("OK"))
+            api.user_create(self.s, user)
+        user = api.user_get_by_username(self.s, "cached")
+        self.s.expunge(user)
+
+        # Cached users survive the commits of the session
+        cached = api.user_get_cached(self.s, user.id)
+        self.assertIs(api.user_get_cached(self.s, user.id), cached)
+        with self.s.begin():
+            api.category_getall(self.s, cached)
+        self.assertEqual(cached.username, "cached")
+        self.assertIsNotNone(aescipher.get_verified_cipher(cached, "123456"))
+
+        # Changing the passphrase drops the user from both caches
+        with self.s.begin():
+            user = api.user_get_by_id(self.s, user.id)
+            user.phrase_check = aescipher.AESCipher("abcdef").encrypt("OK")
+            api.user_update(self.s, user)
+        updated = api.user_get_cached(self.s, user.id)
+        self.assertIsNot(updated, cached)
+        self.assertEqual(updated.version, cached.version + 1)
+        self.assertIsNone(aescipher.get_verified_cipher(updated, "123456"))
+        self.assertIsNotNone(aescipher.get_verified_cipher(updated, "abcdef"))
+        self.assertEqual(aescipher.get_cipher_cache().stats()['size'], 1)
+
+        # Tokens of newer versions bypass outdated copies
+        self.assertIs(api.user_get_cached(self.s, user.id, cached.version),
+                      updated)
+
+        with self.s.begin():
+            api.user_delete_by_username(self.s, "cached")
+        self.assertIsNone(api.user_get_cached(self.s, user.id))
+
+    def test_session_registry(self):
+        # The same registry and engine are reused for the same database
+        conf = opp_config.OppConfig(self.conf_filepath)
+        self.assertIs(api.get_scoped_session(conf), self.s)
+        self.assertIs(api.get_engine(conf), self.s.bind)
+
+        # Pool statistics are collected for checkouts
+        with self.s.begin():
+            api.user_get_by_username(self.s, "nobody")
+        self.s.remove()
+        stats = [s for s in api.get_pool_stats()
+                 if s['checkouts'] and s['role'] == api.ROLE_WRITE]
+        self.assertTrue(stats)
+        self.assertEqual(stats[0]['pool'], "InstrumentedQueuePool")
+        # SQLite writes are serialized through a single connection
+        self.assertEqual(stats[0]['pool_size'], 1)
+
+    def test_sqlite_profile(self):
+        conf = opp_config.OppConfig(self.conf_filepath)
+        read_session = api.get_scoped_session(conf, readonly=True)
+        self.assertIsNot(read_session, self.s)
+        self.assertEqual(read_session.bind.pool.size(), 5)
+
+        # The profile is applied to the connections of both engines
+        for engine in (self.s.bind, read_session.bind):
+            with engine.connect() as conn:
+                self.assertEqual(
+                    conn.execute("PRAGMA journal_mode").scalar(), "wal")
+                self.assertEqual(
+                    conn.execute("PRAGMA busy_timeout").scalar(), 5000)
+                self.assertEqual(
+                    conn.execute("PRAGMA foreign_keys").scalar(), 1)
+
+        # Readers cannot write
+        with read_session.begin():
+            self.assertRaises(exc.OperationalError,
+                              read_session.execute,
+                              "DELETE FROM items WHERE id = 0")
+        read_session.remove()
+
+    def test_run_write_retries(self):
+        locked = exc.OperationalError("BEGIN IMMEDIATE", {},
+                                      Exception("database is locked"))
+        session = mock.MagicMock()
+        session.connection.side_effect = [locked, locked, None]
+        work = mock.Mock(return_value="done")
+        self.assertEqual(api.run_write(session, work, retries=2, backoff=0),
+                         "done")
+        self.assertEqual(session.rollback.call_count, 2)
+        work.assert_called_once_with()
+
+        # Giving up after the last retry
+        session.connection.side_effect = [locked, locked]
+        self.assertRaises(exc.OperationalError, api.run_write, session,
+                          work, retries=1, backoff=0)
+
+        # Other errors are not retried
+        session.connection.side_effect = [
+            exc.OperationalError("BEGIN IMMEDIATE", {},
+                                 Exception("disk I/O error"))]
+        self.assertRaises(exc.OperationalError, api.run_write, session,
+                          work, retries=5, backoff=0)
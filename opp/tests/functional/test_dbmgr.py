@@ -13,12 +13,17 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from datetime import datetime, timedelta
 import os
+import sqlite3
 import tempfile
 import unittest
 
+import mock
+from sqlalchemy import create_engine, event, inspect
+
 from opp.common import aescipher, opp_config, utils
-from opp.db import api, models
+from opp.db import api, migrations, models
 
 
 class TestCase(unittest.TestCase):
@@ -37,6 +42,8 @@ class TestCase(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        # Close pooled connections so SQLite removes its WAL files
+        api.dispose_engines()
         os.remove(cls.conf_filepath)
         os.remove(cls.db_filepath)
         os.rmdir(cls.test_dir)
@@ -64,7 +71,7 @@ class TestCase(unittest.TestCase):
         self.assertNotEqual(out.rstrip().decode(), name, msg)
 
     def test_schema_creation(self):
-        for table in ['categories', 'items']:
+        for table in ['categories', 'items', 'tombstones']:
             self._assert_table_exists(table)
 
     def test_add_del_user(self):
@@ -165,46 +172,441 @@ class TestCase(unittest.TestCase):
         utils.execute("opp-db --config_file %s add-user -uu -pp "
                       "--phrase=123456" % self.conf_filepath)
 
+        # Add category and item the way users created before data keys and
+        # key derivation functions were introduced stored them, encrypted
+        # with the SHA-256 of the passphrase
         old = aescipher.AESCipher("123456")
-        new = aescipher.AESCipher("654321")
-
-        # Add category and item using old passphrase
         session = api.get_scoped_session(config)
-        category = models.Category(name=old.encrypt("cat1"))
-        item = models.Item(
-            name=old.encrypt("item1"),
-            url=old.encrypt("url1"),
-            account=old.encrypt("account1"),
-            username=old.encrypt("username1"),
-            password=old.encrypt("password1"),
-            blob=old.encrypt("blob1"))
+        category = models.Category(
+            **models.Category.encrypt_many(["cat1"], old)[0])
+        fields = {field: "%s1" % field for field in models.Item.SECRET_FIELDS}
+        item = models.Item(**models.Item.encrypt_many([fields], old)[0])
         with session.begin():
             user = api.user_get_by_username(session, 'u')
+            user.data_key = None
+            user.kdf = user.kdf_salt = None
+            user.phrase_check = old.encrypt("OK")
+            api.user_update(session, user)
             category.user = user
             item.user = user
             api.category_create(session, [category])
             api.item_create(session, [item])
+        with session.begin():
+            item = api.item_getall(session, user)[0]
+            encrypted = (category.name, item.record)
+            version = user.version
+
+        # Update passphrase twice, first wrapping the legacy key as the
+        # data key, then only wrapping it again
+        for old_phrase, new_phrase in (("123456", "654321"),
+                                       ("654321", "abcdefg")):
+            utils.execute("opp-db --config_file %s update-phrase -uu -pp "
+                          "--old_phrase=%s --new_phrase=%s" %
+                          (self.conf_filepath, old_phrase, new_phrase))
+
+            # Data is left as is and readable with the new passphrase
+            session = api.get_scoped_session(config)
+            with session.begin():
+                user = api.user_get_by_username(session, 'u')
+                self.assertIsNotNone(user.data_key)
+                self.assertEqual(user.kdf, aescipher.KDF_SCRYPT)
+                # Servers reject their cached copies for new tokens
+                self.assertGreater(user.version, version)
+                version = user.version
+                self.assertIsNone(aescipher.check_phrase(user, old_phrase))
+                new = aescipher.get_data_cipher(
+                    user, aescipher.check_phrase(user, new_phrase))
+                category = api.category_getall(session, user)[0]
+                self.assertEqual(category.extract(new)['name'], "cat1")
+                item = api.item_getall(session, user)[0]
+                extracted = item.extract(new)
+                for field in models.Item.SECRET_FIELDS:
+                    self.assertEqual(extracted[field], fields[field])
+                self.assertEqual((category.name, item.record), encrypted)
 
-        # Update passphrase
+        # Cleanup
+        utils.execute("opp-db --config_file %s del-user -uu -pp"
+                      " --remove_data" % self.conf_filepath)
+        self._assert_user_does_not_exist('u')
+
+    def test_migrate_items(self):
+        config = opp_config.OppConfig(self.conf_filepath)
+        utils.execute("opp-db --config_file %s add-user -uu -pp "
+                      "--phrase=123456" % self.conf_filepath)
+
+        # Add items with separately encrypted fields
+        session = api.get_scoped_session(config)
+        with session.begin():
+            user = api.user_get_by_username(session, 'u')
+            cipher = aescipher.get_data_cipher(
+                user, aescipher.check_phrase(user, "123456"))
+            items = []
+            for i in range(5):
+                item = models.Item(user=user)
+                values = cipher.encrypt_many(
+                    ["%s%d" % (field, i) for field in
+                     models.Item.SECRET_FIELDS], binary=True)
+                for field, value in zip(models.Item.SECRET_FIELDS, values):
+                    setattr(item, field, value)
+                items.append(item)
+            api.item_create(session, items)
+        with session.begin():
+            expected = models.Item.extract_many(
+                api.item_getall(session, user), cipher)
+            updated = [item.updated_at for item in
+                       api.item_getall(session, user)]
+
+        utils.execute("opp-db --config_file %s migrate-items -uu -pp "
+                      "--phrase=123456 --batch_size 2" % self.conf_filepath)
+
+        session = api.get_scoped_session(config)
+        with session.begin():
+            user = api.user_get_by_username(session, 'u')
+            items = api.item_getall(session, user)
+            self.assertEqual(api.item_getall_legacy(session, user, 10), [])
+            for item in items:
+                self.assertIsNotNone(item.record)
+                self.assertIsNotNone(item.details)
+                self.assertIsNone(item.name)
+            self.assertEqual(models.Item.extract_many(items, cipher),
+                             expected)
+            self.assertEqual([item.updated_at for item in items], updated)
+
+        # Wrong passphrase
+        try:
+            utils.execute("opp-db --config_file %s migrate-items -uu -pp "
+                          "--phrase=654321" % self.conf_filepath)
+            self.assertFail("Expected incorrect passphrase message!")
+        except Exception as e:
+            self.assertIn("Error: incorrect passphrase", str(e))
+
+        # Cleanup
+        utils.execute("opp-db --config_file %s del-user -uu -pp"
+                      " --remove_data" % self.conf_filepath)
+        self._assert_user_does_not_exist('u')
+
+    def _get_vault(self, session, phrase):
+        # Reload the rows rewritten by opp-db
+        session.expunge_all()
+        with session.begin():
+            user = api.user_get_by_username(session, 'u')
+            cipher = aescipher.get_data_cipher(
+                user, aescipher.check_phrase(user, phrase))
+            categories = api.category_getall(session, user)
+            items = api.item_getall(session, user)
+            return (user, cipher,
+                    models.Category.extract_many(categories, cipher),
+                    models.Item.extract_many(items, cipher),
+                    [(record.key_version, record.updated_at)
+                     for record in categories + items])
+
+    def test_rotate_key(self):
+        conf_filepath = os.path.join(self.test_dir, 'rotate.cfg')
+        with open(conf_filepath, 'w') as conf_file:
+            conf_file.write(self.connection + "\nidentity_cache_ttl = 0")
+        config = opp_config.OppConfig(conf_filepath)
+        utils.execute("opp-db --config_file %s add-user -uu -pp "
+                      "--phrase=123456" % conf_filepath)
+
+        session = api.get_scoped_session(config)
+        with session.begin():
+            user = api.user_get_by_username(session, 'u')
+            cipher = aescipher.get_data_cipher(
+                user, aescipher.check_phrase(user, "123456"))
+            api.category_create_bulk(session, user, models.Category.encrypt_many(
+                ["cat%d" % i for i in range(3)], cipher))
+            rows = models.Item.encrypt_many(
+                [{field: "%s%d" % (field, i) for field in
+                  models.Item.SECRET_FIELDS} for i in range(5)], cipher)
+            for row in rows:
+                row['category_id'] = None
+            api.item_create_bulk(session, user, rows)
+        user, cipher, categories, items, versions = self._get_vault(
+            session, "123456")
+        data_key = user.data_key
+
+        utils.execute("opp-db --config_file %s rotate-key -uu -pp "
+                      "--phrase=123456 --batch_size 2" % conf_filepath)
+
+        user, new_cipher, new_categories, new_items, new_versions = (
+            self._get_vault(session, "123456"))
+        self.assertEqual(user.key_version, 2)
+        self.assertIsNone(user.next_data_key)
+        self.assertNotEqual(user.data_key, data_key)
+        self.assertNotEqual(new_cipher.key, cipher.key)
+        self.assertEqual(new_categories, categories)
+        self.assertEqual(new_items, items)
+        self.assertEqual(new_versions, [(2, updated_at)
+                                        for version, updated_at in versions])
+
+        # Interrupted rotation, during which an item was added with the
+        # next key and the passphrase changed
+        with session.begin():
+            user = api.user_get_by_username(session, 'u')
+            user.next_data_key = aescipher.new_data_key(
+                aescipher.check_phrase(user, "123456"))
+            api.user_update(session, user)
+        with session.begin():
+            user = api.user_get_by_username(session, 'u')
+            next_cipher = aescipher.get_data_cipher(
+                user, aescipher.check_phrase(user, "123456"))
+            row = models.Item.encrypt_many(
+                [dict.fromkeys(models.Item.SECRET_FIELDS, "new")],
+                next_cipher)[0]
+            row['category_id'] = None
+            api.item_create_bulk(session, user, [row])
         utils.execute("opp-db --config_file %s update-phrase -uu -pp "
                       "--old_phrase=123456 --new_phrase=654321" %
-                      self.conf_filepath)
+                      conf_filepath)
+        utils.execute("opp-db --config_file %s rotate-key -uu -pp "
+                      "--phrase=654321" % conf_filepath)
 
-        # Check data using new passphrase
+        user, new_cipher, new_categories, new_items, new_versions = (
+            self._get_vault(session, "654321"))
+        self.assertEqual(user.key_version, 3)
+        self.assertEqual(new_cipher.key, next_cipher.key)
+        self.assertEqual(new_categories, categories)
+        self.assertEqual(new_items[:-1], items)
+        self.assertEqual(new_items[-1]['name'], "new")
+        self.assertEqual(set(version for version, updated_at
+                             in new_versions), {3})
+
+        # Wrong passphrase
+        try:
+            utils.execute("opp-db --config_file %s rotate-key -uu -pp "
+                          "--phrase=123456" % conf_filepath)
+            self.assertFail("Expected incorrect passphrase message!")
+        except Exception as e:
+            self.assertIn("Error: incorrect passphrase", str(e))
+
+        # Cleanup
+        utils.execute("opp-db --config_file %s del-user -uu -pp"
+                      " --remove_data" % conf_filepath)
+        self._assert_user_does_not_exist('u')
+        os.remove(conf_filepath)
+
+    def test_del_user_with_data(self):
+        config = opp_config.OppConfig(self.conf_filepath)
+
+        # Add user with a category and an item
+        utils.execute("opp-db --config_file %s add-user -uu -pp "
+                      "--phrase=123456" % self.conf_filepath)
         session = api.get_scoped_session(config)
         with session.begin():
             user = api.user_get_by_username(session, 'u')
-            category = api.category_getall(session, user)[0]
-            self.assertEqual(new.decrypt(category.name), "cat1")
-            item = api.item_getall(session, user)[0]
-            self.assertEqual(new.decrypt(item.name), "item1")
-            self.assertEqual(new.decrypt(item.url), "url1")
-            self.assertEqual(new.decrypt(item.account), "account1")
-            self.assertEqual(new.decrypt(item.username), "username1")
-            self.assertEqual(new.decrypt(item.password), "password1")
-            self.assertEqual(new.decrypt(item.blob), "blob1")
+            category = models.Category(name=b"cat1", user=user)
+            api.category_create(session, [category])
+            item = models.Item(name=b"item1", user=user,
+                               category_id=category.id)
+            api.item_create(session, [item])
 
-        # Cleanup
+        # Deleting without --remove_data is refused
+        try:
+            utils.execute("opp-db --config_file %s del-user -uu -pp"
+                          % self.conf_filepath)
+            self.assertFail("Expected user has data message!")
+        except Exception as e:
+            self.assertIn("Error: user has categories or items", str(e))
+        self._assert_user_exists('u')
+
+        # Data is removed by the database along with the user
         utils.execute("opp-db --config_file %s del-user -uu -pp"
                       " --remove_data" % self.conf_filepath)
         self._assert_user_does_not_exist('u')
+        for table in ['categories', 'items']:
+            cmd = ("sqlite3 -noheader {0} \"SELECT count(*) FROM {1}\""
+                   ).format(self.db_filepath, table)
+            code, out, err = utils.execute(cmd)
+            self.assertEqual(out.rstrip().decode(), "0")
+
+    def test_prune_tombstones(self):
+        config = opp_config.OppConfig(self.conf_filepath)
+
+        # Add a user with an old and a recent deletion record
+        utils.execute("opp-db --config_file %s add-user -uu4 -pp "
+                      "--phrase=123456" % self.conf_filepath)
+        session = api.get_scoped_session(config)
+        with session.begin():
+            user = api.user_get_by_username(session, 'u4')
+            old = datetime.now() - timedelta(days=10)
+            session.add_all([models.Tombstone(user_id=user.id, kind='item',
+                                              record_id=1, deleted_at=old),
+                             models.Tombstone(user_id=user.id, kind='item',
+                                              record_id=2)])
+
+        # Only the old record is pruned
+        code, out, err = utils.execute("opp-db --config_file %s "
+                                       "prune-tombstones --days 7" %
+                                       self.conf_filepath)
+        self.assertIn("Pruned 1 deletion records.", out.decode())
+        with session.begin():
+            self.assertEqual(api.tombstone_getall(session, user, old),
+                             [('item', 2)])
+
+        # Clean up
+        utils.execute("opp-db --config_file %s del-user -uu4 -pp"
+                      " --remove_data" % self.conf_filepath)
+
+    def test_upgrade_foreign_keys(self):
+        # Create a database with the original schema, without cascades
+        db_filepath = os.path.join(self.test_dir, 'old.sqlite')
+        conf_filepath = os.path.join(self.test_dir, 'old.cfg')
+        with open(conf_filepath, 'w') as conf_file:
+            conf_file.write("[DEFAULT]\ndb_connect = sqlite:///%s" %
+                            db_filepath)
+        conn = sqlite3.connect(db_filepath)
+        conn.executescript("""
+            CREATE TABLE users (
+                id INTEGER NOT NULL, username VARCHAR(255) NOT NULL,
+                password VARCHAR(255) NOT NULL,
+                phrase_check VARCHAR(255) NOT NULL,
+                created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL,
+                PRIMARY KEY (id), UNIQUE (username));
+            CREATE TABLE categories (
+                id INTEGER NOT NULL, name VARCHAR(255) NOT NULL,
+                user_id INTEGER NOT NULL, sort_id INTEGER,
+                created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL,
+                PRIMARY KEY (id),
+                FOREIGN KEY(user_id) REFERENCES users (id));
+            CREATE TABLE items (
+                id INTEGER NOT NULL, category_id INTEGER,
+                user_id INTEGER NOT NULL, name VARCHAR(255),
+                url VARCHAR(2000), account VARCHAR(255),
+                username VARCHAR(255), password VARCHAR(255),
+                blob VARCHAR(4096), sort_id INTEGER,
+                created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL,
+                PRIMARY KEY (id),
+                FOREIGN KEY(category_id) REFERENCES categories (id),
+                FOREIGN KEY(user_id) REFERENCES users (id));
+            CREATE INDEX category_id_idx ON items (category_id);
+            INSERT INTO users VALUES (1, 'u', 'p', 'OK', '2017-01-01',
+                                      '2017-01-01');
+            INSERT INTO categories VALUES (1, 'Yw==', 1, 0, '2017-01-01',
+                                           '2017-01-01');
+            INSERT INTO items VALUES (1, 1, 1, 'bg==', 'dQ==', 'YQ==', 'dQ==',
+                                      'cA==', 'Yg==', 0, '2017-01-01',
+                                      '2017-01-01');
+            """)
+        conn.commit()
+
+        # Upgrade twice, the second run should be a no-op
+        outputs = []
+        for i in range(2):
+            code, out, err = utils.execute("opp-db --config_file %s --verbose"
+                                           " upgrade" % conf_filepath)
+            self.assertIn("Database schema is up to date.", out.decode())
+            outputs.append(out.decode())
+        self.assertIn("Converted column 'items.blob' to binary", outputs[0])
+        self.assertNotIn("Converted column", outputs[1])
+
+        # Missing indexes were added
+        rows = conn.execute("SELECT name FROM sqlite_master "
+                            "WHERE type='index'").fetchall()
+        for index in ['items_user_id_sort_id_idx',
+                      'items_user_id_category_id_idx',
+                      'categories_user_id_sort_id_idx']:
+            self.assertIn((index,), rows)
+        code, out, err = utils.execute("opp-db --config_file %s add-indexes"
+                                       % conf_filepath)
+        self.assertIn("Created 0 missing indexes.", out.decode())
+
+        # Missing columns were added with their defaults
+        self.assertEqual(conn.execute("SELECT version FROM users").fetchall(),
+                         [(1,)])
+
+        # Data survived and deleting the user cascades
+        conn.execute("PRAGMA foreign_keys=ON")
+        self.assertEqual(conn.execute("SELECT name, blob FROM items").fetchall(),
+                         [(b"n", b"b")])
+        self.assertEqual(conn.execute("SELECT name FROM categories").fetchall(),
+                         [(b"c",)])
+        conn.execute("DELETE FROM users")
+        conn.commit()
+        for table in ['categories', 'items']:
+            count = conn.execute("SELECT count(*) FROM %s" % table).fetchone()
+            self.assertEqual(count, (0,))
+        conn.close()
+        os.remove(conf_filepath)
+        os.remove(db_filepath)
+
+    def test_upgrade_ciphertext_interrupted(self):
+        # The MySQL conversion runs against SQLite here, with the final
+        # MySQL only ALTER replaced by its SQLite equivalent
+        db_filepath = os.path.join(self.test_dir, 'mysql.sqlite')
+        conn = sqlite3.connect(db_filepath)
+        conn.executescript("""
+            CREATE TABLE categories (
+                id INTEGER NOT NULL, name VARCHAR(255) NOT NULL,
+                user_id INTEGER NOT NULL, PRIMARY KEY (id));
+            INSERT INTO categories VALUES (1, 'YQ==', 1);
+            INSERT INTO categories VALUES (2, 'Yg==', 1);
+            INSERT INTO categories VALUES (3, 'Yw==', 1);
+            """)
+        conn.commit()
+        engine = create_engine("sqlite:///%s" % db_filepath)
+        table = models.Category.__table__
+
+        def convert():
+            live = dict((c['name'], c['type'])
+                        for c in inspect(engine).get_columns(table.name))
+            migrations._decode_mysql_columns(engine, table, [table.c.name],
+                                             live, 1)
+
+        def swap(engine, table, columns):
+            with engine.begin() as conn:
+                for column in columns:
+                    conn.execute("ALTER TABLE %s DROP COLUMN %s" %
+                                 (table.name, column.name))
+                    conn.execute("ALTER TABLE %s RENAME COLUMN %s_bin TO %s"
+                                 % (table.name, column.name, column.name))
+
+        updates = []
+
+        def interrupt(conn, cursor, statement, *args):
+            if statement.startswith("UPDATE"):
+                updates.append(statement)
+                if len(updates) == 2:
+                    raise RuntimeError("interrupted")
+
+        # The run is interrupted in the second batch
+        event.listen(engine, 'before_cursor_execute', interrupt)
+        try:
+            with mock.patch.object(migrations, '_swap_shadow_columns',
+                                   side_effect=swap) as swapped:
+                self.assertRaises(RuntimeError, convert)
+                self.assertFalse(swapped.called)
+        finally:
+            event.remove(engine, 'before_cursor_execute', interrupt)
+
+        # The text column is left alone, only the first batch was decoded
+        self.assertEqual(
+            conn.execute("SELECT name, name_bin FROM categories "
+                         "ORDER BY id").fetchall(),
+            [('YQ==', b"a"), ('Yg==', None), ('Yw==', None)])
+
+        # The next run decodes the remaining rows only
+        statements = []
+        event.listen(engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args:
+                     statements.append(statement))
+        with mock.patch.object(migrations, '_swap_shadow_columns',
+                               side_effect=swap) as swapped:
+            convert()
+            self.assertEqual(swapped.call_count, 1)
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith("UPDATE")]), 2)
+        self.assertEqual(
+            conn.execute("SELECT name FROM categories ORDER BY id").fetchall(),
+            [(b"a",), (b"b",), (b"c",)])
+        engine.dispose()
+        conn.close()
+        os.remove(db_filepath)
+
+    def test_swap_shadow_columns(self):
+        engine = mock.Mock(dialect=create_engine("sqlite://").dialect)
+        table = models.Item.__table__
+        migrations._swap_shadow_columns(engine, table,
+                                        [table.c.name, table.c.blob])
+        engine.execute.assert_called_once_with(
+            "ALTER TABLE items DROP COLUMN name, CHANGE COLUMN name_bin name "
+            "BLOB, DROP COLUMN blob, CHANGE COLUMN blob_bin blob BLOB")
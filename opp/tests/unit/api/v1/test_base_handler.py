@@ -24,6 +24,10 @@ from opp.common import aescipher as ac
 
 class TestBaseResponseHandler(unittest.TestCase):
 
+    def setUp(self):
+        # Mock users of different tests may produce the same cache keys
+        ac.get_cipher_cache().clear()
+
     def assertRaisesWithMsg(self, msg, func, *args, **kwargs):
         try:
             func(*args, **kwargs)
@@ -118,6 +122,9 @@ class TestBaseResponseHandler(unittest.TestCase):
     @mock.patch.object(ac.AESCipher, 'decrypt')
     def test_respond_bad_phrase(self, cipher, user):
         cipher.return_value = "NOTOK"
+        user.kdf = user.kdf_salt = None
+        user.next_data_key = None
+        user.key_version = 1
         headers = {'x-opp-phrase': "123"}
         handler = bh.BaseResponseHandler(MockRequest('', headers, None), user, None)
         self.assertRaisesWithMsg("Incorrect passphrase supplied!",
@@ -133,6 +140,10 @@ class TestBaseResponseHandler(unittest.TestCase):
     def test_respond_get(self, func, session, cipher, user):
         request = MockRequest('GET', {'x-opp-phrase': "123"}, None)
         cipher.return_value = "OK"
+        user.data_key = None
+        user.kdf = user.kdf_salt = None
+        user.next_data_key = None
+        user.key_version = 1
         handler = bh.BaseResponseHandler(request, user, session)
         handler.respond()
         self._check_called(func, "123")
@@ -144,6 +155,10 @@ class TestBaseResponseHandler(unittest.TestCase):
     def test_respond_put(self, func, session, cipher, user):
         request = MockRequest('PUT', {'x-opp-phrase': "123"}, None)
         cipher.return_value = "OK"
+        user.data_key = None
+        user.kdf = user.kdf_salt = None
+        user.next_data_key = None
+        user.key_version = 1
         handler = bh.BaseResponseHandler(request, user, session)
         handler.respond()
         self._check_called(func, "123")
@@ -155,6 +170,10 @@ class TestBaseResponseHandler(unittest.TestCase):
     def test_respond_post(self, func, session, cipher, user):
         request = MockRequest('POST', {'x-opp-phrase': "123"}, None)
         cipher.return_value = "OK"
+        user.data_key = None
+        user.kdf = user.kdf_salt = None
+        user.next_data_key = None
+        user.key_version = 1
         handler = bh.BaseResponseHandler(request, user, session)
         handler.respond()
         self._check_called(func, "123")
@@ -166,6 +185,10 @@ class TestBaseResponseHandler(unittest.TestCase):
     def test_respond_delete(self, func, session, cipher, user):
         request = MockRequest('DELETE', {'x-opp-phrase': "123"}, None)
         cipher.return_value = "OK"
+        user.data_key = None
+        user.kdf = user.kdf_salt = None
+        user.next_data_key = None
+        user.key_version = 1
         handler = bh.BaseResponseHandler(request, user, session)
         handler.respond()
         self._check_called(func)
@@ -176,6 +199,10 @@ class TestBaseResponseHandler(unittest.TestCase):
     def test_respond_bad_verb(self, session, cipher, user):
         request = MockRequest('BAD', {'x-opp-phrase': "123"}, None)
         cipher.return_value = "OK"
+        user.data_key = None
+        user.kdf = user.kdf_salt = None
+        user.next_data_key = None
+        user.key_version = 1
         handler = bh.BaseResponseHandler(request, user, session)
         self.assertRaisesWithMsg("Method not supported!",
                                  handler.respond, require_phrase=False)
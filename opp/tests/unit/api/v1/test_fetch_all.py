@@ -24,6 +24,10 @@ from opp.common import aescipher as ac
 
 class TestResponseHandler(unittest.TestCase):
 
+    def setUp(self):
+        # Mock users of different tests may produce the same cache keys
+        ac.get_cipher_cache().clear()
+
     def _check_called(self, func_name, *exp_args, **exp_kwargs):
         func_name.assert_called_once_with(*exp_args, **exp_kwargs)
 
@@ -34,6 +38,10 @@ class TestResponseHandler(unittest.TestCase):
     def test_respond_get(self, func, session, cipher, user):
         request = MockRequest('GET', {'x-opp-phrase': '123'}, None)
         cipher.return_value = "OK"
+        user.data_key = None
+        user.kdf = user.kdf_salt = None
+        user.next_data_key = None
+        user.key_version = 1
         handler = api.ResponseHandler(request, user, session)
         handler.respond()
         self._check_called(func, "123")
@@ -17,9 +17,13 @@
 
 from six.moves import configparser
 import os
+import threading
+import types
 import unittest
 
-from opp.common import aescipher, opp_config
+import mock
+
+from opp.common import aescipher, cache, opp_config, utils
 
 
 class TestUtils(unittest.TestCase):
@@ -45,6 +49,101 @@ class TestAESCipher(unittest.TestCase):
         decrypted = cipher.decrypt(encrypted)
         self.assertEqual(decrypted, u"Привет Мир!")
 
+    def test_decrypt_many(self):
+        cipher = aescipher.AESCipher("secret passphrase")
+        values = ["", "a", "x" * 15, "y" * 16, u"Привет Мир!" * 10]
+        encrypted = [cipher.encrypt(value) for value in values]
+        self.assertEqual(cipher.decrypt_many(encrypted), values)
+        self.assertEqual(cipher.decrypt_many([]), [])
+
+    def test_encrypt_many(self):
+        cipher = aescipher.AESCipher("secret passphrase")
+        values = ["x" * 33, "", u"Привет Мир!", "y" * 16, "a"]
+        encrypted = cipher.encrypt_many(values)
+        self.assertEqual([cipher.decrypt(enc) for enc in encrypted], values)
+        self.assertEqual(cipher.decrypt_many(encrypted), values)
+        # Every value gets its own IV
+        first, second = cipher.encrypt_many(["a", "a"])
+        self.assertNotEqual(first, second)
+        self.assertEqual(cipher.encrypt_many([]), [])
+
+    def test_decrypt_many_invalid(self):
+        cipher = aescipher.AESCipher("secret passphrase")
+        encrypted = cipher.encrypt("My Secret Message")
+        self.assertRaises(ValueError, cipher.decrypt_many,
+                          [encrypted, encrypted[:24]])
+
+
+class TestDecryptPool(unittest.TestCase):
+
+    def setUp(self):
+        self.cipher = aescipher.AESCipher("secret passphrase")
+        self.values = ["value %d" % i for i in range(10)]
+        self.encrypted = self.cipher.encrypt_many(self.values)
+
+    def _check_pool(self, kind):
+        pool = aescipher.DecryptPool(kind, 3, 4)
+        self.addCleanup(pool.shutdown)
+        self.assertEqual(pool.decrypt_many(self.cipher, self.encrypted[:3],
+                                           3), self.values[:3])
+        self.assertEqual(pool.stats()['requests'], 0)
+        self.assertEqual(pool.decrypt_many(self.cipher, self.encrypted, 5),
+                         self.values)
+        stats = pool.stats()
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['rows'], 5)
+        self.assertEqual(stats['kind'], kind)
+
+    def test_thread_pool(self):
+        self._check_pool('thread')
+
+    def test_process_pool(self):
+        self._check_pool('process')
+
+    def test_disabled(self):
+        pool = aescipher.DecryptPool('thread', 1, 0)
+        self.assertEqual(pool.decrypt_many(self.cipher, self.encrypted, 10),
+                         self.values)
+        self.assertEqual(pool.stats()['requests'], 0)
+
+    def test_invalid_kind(self):
+        self.assertRaises(ValueError, aescipher.DecryptPool, 'fiber', 2, 0)
+
+
+class TestPasswordPool(unittest.TestCase):
+
+    def test_check(self):
+        pool = utils.PasswordPool(2, 1)
+        self.addCleanup(pool.shutdown)
+        hashed = utils.hashpw("secret")
+        self.assertTrue(pool.checkpw("secret", hashed))
+        self.assertFalse(pool.checkpw("public", hashed))
+        stats = pool.stats()
+        self.assertEqual(stats['checks'], 2)
+        self.assertEqual(stats['pending'], 0)
+        self.assertGreater(stats['hash_time'], 0)
+
+    def test_saturated(self):
+        pool = utils.PasswordPool(1, 1)
+        self.addCleanup(pool.shutdown)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with mock.patch.object(utils, 'checkpw',
+                               side_effect=lambda *args: release.wait()):
+            # One check runs, one waits, the next one is turned away
+            futures = [pool.submit("p", "h") for i in range(2)]
+            with self.assertRaises(utils.PoolSaturated) as e:
+                pool.submit("p", "h")
+            self.assertGreaterEqual(e.exception.retry_after, 1)
+            release.set()
+            self.assertEqual([future.result() for future in futures],
+                             [True, True])
+        stats = pool.stats()
+        self.assertEqual(stats['checks'], 2)
+        self.assertEqual(stats['rejections'], 1)
+        self.assertEqual(stats['pending'], 0)
+        self.assertGreater(stats['max_wait'], 0)
+
 
 class TestConfig(unittest.TestCase):
 
@@ -83,3 +182,204 @@ class TestConfig(unittest.TestCase):
     def test_empty_option(self):
         CONF = opp_config.OppConfig()
         self.assertIsNone(CONF['test_option'])
+
+    def test_typed_options(self):
+        with open(self.file_path, 'w') as f:
+            f.write("[DEFAULT]\n")
+            f.write("db_pool_size = 20\n")
+            f.write("db_pool_pre_ping = true\n")
+            f.write("db_pool_timeout = blah\n")
+        CONF = opp_config.OppConfig(self.file_path)
+        self.assertEqual(CONF.getint('db_pool_size'), 20)
+        self.assertTrue(CONF.getboolean('db_pool_pre_ping'))
+        self.assertEqual(CONF.getint('db_pool_timeout', 30), 30)
+        self.assertEqual(CONF.getint('test_option', 5), 5)
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        lru = cache.TTLCache(2, 60)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.put('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+        stats = lru.stats()
+        self.assertEqual((stats['size'], stats['hits'], stats['misses'],
+                          stats['evictions']), (2, 3, 1, 1))
+
+    def test_expiry(self):
+        lru = cache.TTLCache(2, 60)
+        with mock.patch('time.monotonic', return_value=100):
+            lru.put('a', 1)
+        with mock.patch('time.monotonic', return_value=159):
+            self.assertEqual(lru.get('a'), 1)
+        with mock.patch('time.monotonic', return_value=160):
+            self.assertIsNone(lru.get('a'))
+        self.assertEqual(lru.stats()['size'], 0)
+
+    def test_check(self):
+        lru = cache.TTLCache(2, 60)
+        lru.put('a', 1)
+        self.assertEqual(lru.get('a', lambda value: value >= 1), 1)
+        self.assertIsNone(lru.get('a', lambda value: value >= 2))
+        self.assertIsNone(lru.get('a'))
+
+    def test_invalidate(self):
+        lru = cache.TTLCache(2, 60)
+        lru.put('a', 1)
+        generation = lru.generation
+        lru.invalidate('a')
+        self.assertIsNone(lru.get('a'))
+        # Values loaded before the invalidation are dropped
+        lru.put('a', 1, generation)
+        self.assertIsNone(lru.get('a'))
+        lru.put('a', 2, lru.generation)
+        self.assertEqual(lru.get('a'), 2)
+
+    def test_disabled(self):
+        lru = cache.TTLCache(0, 60)
+        lru.put('a', 1)
+        self.assertIsNone(lru.get('a'))
+
+
+class TestVerifiedCipher(unittest.TestCase):
+
+    def setUp(self):
+        aescipher.get_cipher_cache().clear()
+        phrase_cipher = aescipher.AESCipher("123456")
+        self.user = types.SimpleNamespace(
+            id=1, phrase_check=phrase_cipher.encrypt("OK"), kdf=None,
+            kdf_salt=None, data_key=aescipher.new_data_key(phrase_cipher),
+            next_data_key=None, key_version=1)
+
+    def _change_phrase(self, old_phrase, new_phrase):
+        new_cipher = aescipher.AESCipher(new_phrase)
+        data_cipher = aescipher.get_data_cipher(
+            self.user, aescipher.check_phrase(self.user, old_phrase))
+        self.user.data_key = aescipher.wrap_data_key(new_cipher, data_cipher)
+        self.user.phrase_check = new_cipher.encrypt("OK")
+
+    def test_verified_cipher_cached(self):
+        cipher = aescipher.get_verified_cipher(self.user, "123456")
+        self.assertEqual(cipher.decrypt(cipher.encrypt("data")), "data")
+        with mock.patch.object(aescipher.AESCipher, 'decrypt') as decrypt:
+            self.assertIs(aescipher.get_verified_cipher(self.user, "123456"),
+                          cipher)
+        decrypt.assert_not_called()
+
+        # Keys are digests, passphrases are not kept
+        ciphers = aescipher.get_cipher_cache()
+        self.assertNotIn(b"123456", b"".join(
+            key[1] for key in ciphers._entries))
+
+    def test_incorrect_phrase(self):
+        self.assertIsNone(aescipher.get_verified_cipher(self.user, "654321"))
+        self.assertIsNone(aescipher.get_verified_cipher(self.user, "654321"))
+        self.assertEqual(aescipher.get_cipher_cache().stats()['size'], 0)
+
+    def test_data_key(self):
+        cipher = aescipher.get_verified_cipher(self.user, "123456")
+        self.assertNotEqual(cipher.key, aescipher.AESCipher("123456").key)
+        self.assertIsNone(aescipher.check_phrase(self.user, "654321"))
+
+        # Users without a data key use the passphrase cipher
+        legacy = types.SimpleNamespace(id=2, phrase_check=self.user.phrase_check,
+                                       kdf=None, kdf_salt=None, data_key=None,
+                                       next_data_key=None, key_version=1)
+        self.assertEqual(aescipher.get_verified_cipher(legacy, "123456").key,
+                         aescipher.AESCipher("123456").key)
+
+    def test_key_rotation(self):
+        cipher = aescipher.get_verified_cipher(self.user, "123456")
+        encrypted = cipher.encrypt("data")
+        self.assertEqual(cipher.key_version, 1)
+
+        # New data uses the next key, old data the retired one
+        self.user.next_data_key = aescipher.new_data_key(
+            aescipher.AESCipher("123456"))
+        next_cipher = aescipher.get_verified_cipher(self.user, "123456")
+        self.assertEqual(next_cipher.key_version, 2)
+        self.assertNotEqual(next_cipher.key, cipher.key)
+        self.assertIs(aescipher.get_version_cipher(next_cipher, 2),
+                      next_cipher)
+        retired = aescipher.get_version_cipher(next_cipher, 1)
+        self.assertEqual(retired.decrypt(encrypted), "data")
+        self.assertRaises(ValueError, aescipher.get_version_cipher,
+                          next_cipher, 3)
+
+        # Once switched, only the new key is left
+        self.user.data_key = self.user.next_data_key
+        self.user.next_data_key = None
+        self.user.key_version = 2
+        cipher = aescipher.get_verified_cipher(self.user, "123456")
+        self.assertEqual(cipher.key, next_cipher.key)
+        self.assertIsNone(cipher.retired)
+        self.assertRaises(ValueError, aescipher.get_version_cipher, cipher, 1)
+
+    def test_phrase_change(self):
+        cipher = aescipher.get_verified_cipher(self.user, "123456")
+        self._change_phrase("123456", "abcdef")
+        self.assertIsNone(aescipher.get_verified_cipher(self.user, "123456"))
+        new_cipher = aescipher.get_verified_cipher(self.user, "abcdef")
+        self.assertIsNot(new_cipher, cipher)
+        # The data key stays the same
+        self.assertEqual(new_cipher.key, cipher.key)
+
+    def test_invalidate(self):
+        cipher = aescipher.get_verified_cipher(self.user, "123456")
+        aescipher.invalidate_ciphers(2)
+        self.assertIs(aescipher.get_verified_cipher(self.user, "123456"),
+                      cipher)
+        aescipher.invalidate_ciphers(1)
+        self.assertIsNot(aescipher.get_verified_cipher(self.user, "123456"),
+                         cipher)
+
+
+class TestPhraseKdf(unittest.TestCase):
+
+    def setUp(self):
+        aescipher.get_key_cache().clear()
+        self.kdf, self.salt = aescipher.new_phrase_kdf()
+        self.user = types.SimpleNamespace(id=1, kdf=self.kdf,
+                                          kdf_salt=self.salt, data_key=None,
+                                          next_data_key=None, key_version=1)
+        self.user.phrase_check = aescipher.get_phrase_cipher(
+            "123456", self.kdf, self.salt).encrypt("OK")
+
+    def test_new_phrase_kdf(self):
+        self.assertEqual(self.kdf, aescipher.KDF_SCRYPT)
+        self.assertNotEqual(aescipher.new_phrase_kdf()[1], self.salt)
+        conf = {'phrase_kdf': "md5"}
+        self.assertRaises(ValueError, aescipher.new_phrase_kdf, conf)
+
+    def test_derive_key(self):
+        key = aescipher.derive_key("123456", self.kdf, self.salt)
+        self.assertEqual(len(key), 32)
+        self.assertNotEqual(key, aescipher.AESCipher("123456").key)
+        salt = aescipher.new_phrase_kdf()[1]
+        self.assertNotEqual(key, aescipher.derive_key("123456", self.kdf,
+                                                      salt))
+        # Users without a function derive with SHA-256
+        self.assertEqual(aescipher.derive_key("123456"),
+                         aescipher.AESCipher("123456").key)
+        self.assertRaises(ValueError, aescipher.derive_key, "123456", "md5")
+
+    def test_derived_keys_cached(self):
+        self.assertIsNotNone(aescipher.check_phrase(self.user, "123456"))
+        self.assertIsNone(aescipher.check_phrase(self.user, "654321"))
+        with mock.patch.dict(aescipher.KDFS) as kdfs:
+            kdfs[self.kdf] = mock.Mock()
+            # Updates of the user leave the derived keys valid
+            aescipher.invalidate_ciphers(self.user.id)
+            self.assertIsNotNone(aescipher.check_phrase(self.user, "123456"))
+            self.assertIsNone(aescipher.check_phrase(self.user, "654321"))
+            kdfs[self.kdf].assert_not_called()
+
+        # Keys are digests, passphrases are not kept
+        keys = aescipher.get_key_cache()
+        self.assertEqual(keys.stats()['size'], 2)
+        self.assertNotIn(b"123456", b"".join(keys._entries))
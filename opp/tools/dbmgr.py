@@ -15,7 +15,9 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from datetime import datetime, timedelta
 import sys
+import time
 from pickle import dump, load
 
 import click
@@ -23,7 +25,7 @@ from sqlalchemy import create_engine, exc
 from sqlalchemy_utils import database_exists, create_database
 
 from opp.common import aescipher, opp_config, utils
-from opp.db import api, models
+from opp.db import api, migrations, models
 
 
 class Config:
@@ -85,7 +87,8 @@ def add_user(config, u, p, phrase):
     if len(phrase) < 6:
         sys.exit("Error: passphrase must be at least 6 characters long!")
     try:
-        cipher = aescipher.AESCipher(phrase)
+        kdf, salt = aescipher.new_phrase_kdf(config.conf)
+        cipher = aescipher.get_phrase_cipher(phrase, kdf, salt)
         ok = cipher.encrypt("OK")
         s = api.get_scoped_session(config.conf)
         with s.begin():
@@ -93,7 +96,9 @@ def add_user(config, u, p, phrase):
             if user:
                 sys.exit("Error: user already exists!")
             hashed = utils.hashpw(p)
-            user = models.User(username=u, password=hashed, phrase_check=ok)
+            user = models.User(username=u, password=hashed, phrase_check=ok,
+                               kdf=kdf, kdf_salt=salt,
+                               data_key=aescipher.new_data_key(cipher))
             api.user_create(s, user)
             user = api.user_get_by_username(s, u)
             if user:
@@ -104,6 +109,55 @@ def add_user(config, u, p, phrase):
         sys.exit("Error: %s" % str(e))
 
 
+def _migrate(config, step):
+    db_connect = config.conf['db_connect']
+    if not db_connect:
+        sys.exit("Error: database connection string not "
+                 "found in any of the configuration files")
+    try:
+        engine = create_engine(db_connect)
+    except exc.NoSuchModuleError as e:
+        sys.exit("Error: %s" % str(e))
+    try:
+        return step(engine)
+    except exc.SQLAlchemyError as e:
+        sys.exit("Error: %s" % str(e))
+
+
+@main.command()
+@pass_config
+def upgrade(config):
+    for change in _migrate(config, migrations.upgrade):
+        printv(config, change)
+    print("Database schema is up to date.")
+
+
+@main.command(name='add-indexes')
+@pass_config
+def add_indexes(config):
+    created = _migrate(config, migrations.upgrade_indexes)
+    for index in created:
+        printv(config, "Created index '%s'" % index)
+    print("Created %d missing indexes." % len(created))
+
+
+@click.option('--days', default=None, type=int,
+              help="Age in days of the oldest deletion records to keep")
+@main.command(name='prune-tombstones')
+@pass_config
+def prune_tombstones(config, days):
+    if days is None:
+        days = config.conf.getint('sync_tombstone_days', 30)
+    try:
+        s = api.get_scoped_session(config.conf)
+        with s.begin():
+            before = datetime.now() - timedelta(days=days)
+            deleted = api.tombstone_delete_before(s, before)
+        print("Pruned %d deletion records." % deleted)
+    except Exception as e:
+        sys.exit("Error: %s" % str(e))
+
+
 @click.option('--remove_data', is_flag=True,
               help="Remove all of the data associated with the user")
 @click.option('-p', default=None, required=True,
@@ -122,12 +176,11 @@ def del_user(config, u, p, remove_data):
             if not utils.checkpw(p, user.password):
                 sys.exit("Error: incorrect password!")
 
-            if remove_data:
-                printv(config, "Removing user's categories data ...")
-                api.category_delete_all(s, user, True)
-                printv(config, "Removing user's items data ...")
-                api.item_delete_all(s, user)
+            if not remove_data and api.user_has_data(s, user):
+                sys.exit("Error: user has categories or items, specify "
+                         "--remove_data to delete them along with the user!")
 
+            # Categories and items are removed by the database
             printv(config, "Removing user ...")
             api.user_delete(s, user)
 
@@ -187,14 +240,19 @@ def update_user(config, u, p, new_username, new_password):
               help="password")
 @click.option('-u', default=None, required=True,
               help="username")
-@main.command(name='update-phrase')
+@main.command(name='update-phrase', help=(
+    "Change a user's passphrase. The user's version is incremented, so "
+    "tokens issued afterwards bypass the copies of the user cached by "
+    "running servers. Requests bearing older tokens may still be served "
+    "with the old passphrase until those copies expire, see the "
+    "identity_cache_ttl option."))
 @pass_config
 def update_phrase(config, u, p, old_phrase, new_phrase):
     if len(new_phrase) < 6:
         sys.exit("Error: passphrase must be at least 6 characters long!")
     try:
-        old_cipher = aescipher.AESCipher(old_phrase)
-        new_cipher = aescipher.AESCipher(new_phrase)
+        kdf, salt = aescipher.new_phrase_kdf(config.conf)
+        new_cipher = aescipher.get_phrase_cipher(new_phrase, kdf, salt)
         s = api.get_scoped_session(config.conf)
         with s.begin():
             user = api.user_get_by_username(s, u)
@@ -202,27 +260,169 @@ def update_phrase(config, u, p, old_phrase, new_phrase):
                 sys.exit("Error: user does not exist!")
             if not utils.checkpw(p, user.password):
                 sys.exit("Error: incorrect password!")
-            try:
-                if old_cipher.decrypt(user.phrase_check) != "OK":
-                    sys.exit("Error: incorrect old passphrase supplied!")
-            except UnicodeDecodeError:
+            old_cipher = aescipher.check_phrase(user, old_phrase)
+            if old_cipher is None:
                 sys.exit("Error: incorrect old passphrase supplied!")
 
+            # The data stays encrypted with the data key, which only needs
+            # to be wrapped with the new passphrase. The new passphrase
+            # moves to the configured key derivation function as well
             printv(config, "Updating user information")
+            data_cipher = aescipher.get_data_cipher(user, old_cipher)
+            if data_cipher.retired is not None:
+                # The data key is being rotated, see rotate-key
+                user.next_data_key = aescipher.wrap_data_key(new_cipher,
+                                                             data_cipher)
+                data_cipher = data_cipher.retired
+            user.data_key = aescipher.wrap_data_key(new_cipher, data_cipher)
             user.phrase_check = new_cipher.encrypt("OK")
+            user.kdf = kdf
+            user.kdf_salt = salt
+            api.user_update(s, user)
+            print("User's passphrase has been successfully updated.")
+    except Exception as e:
+        sys.exit("Error: %s" % str(e))
+
+
+@click.option('--pause', default=0.0, type=float,
+              help="Seconds to wait between batches")
+@click.option('--batch_size', default=500, type=int,
+              help="Number of items converted per transaction")
+@click.option('--phrase', default=None, required=True,
+              help="passphrase for decryption")
+@click.option('-p', default=None, required=True,
+              help="password")
+@click.option('-u', default=None, required=True,
+              help="username")
+@main.command(name='migrate-items')
+@pass_config
+def migrate_items(config, u, p, phrase, batch_size, pause):
+    try:
+        s = api.get_scoped_session(config.conf)
+        with s.begin():
+            user = api.user_get_by_username(s, u)
+            if not user:
+                sys.exit("Error: user does not exist!")
+            if not utils.checkpw(p, user.password):
+                sys.exit("Error: incorrect password!")
+            cipher = aescipher.check_phrase(user, phrase)
+            if cipher is None:
+                sys.exit("Error: incorrect passphrase supplied!")
+            cipher = aescipher.get_data_cipher(user, cipher)
+
+        # Short transactions let the server keep writing meanwhile
+        migrated = 0
+        while True:
+            with s.begin():
+                items = api.item_getall_legacy(s, user, batch_size)
+                rows = models.Item.upgrade_many(items, cipher)
+                migrated += api.item_upgrade_bulk(s, user, items, rows)
+            printv(config, "Migrated %d items" % migrated)
+            if len(items) < batch_size:
+                break
+            time.sleep(pause)
+        print("Migrated %d of user's items to the current record format." %
+              migrated)
+    except Exception as e:
+        sys.exit("Error: %s" % str(e))
+
+
+def _recrypt_all(config, s, user, cipher, batch_size, pause):
+    """
+    Re-encrypt the user's categories and items which are not encrypted with
+    the current data key yet, one batch per transaction.
+
+    :returns: number of re-encrypted categories and items
+    """
+    recrypted = 0
+    for name, model, getall, recrypt in (
+            ('categories', models.Category, api.category_getall_stale_key,
+             api.category_recrypt_bulk),
+            ('items', models.Item, api.item_getall_stale_key,
+             api.item_recrypt_bulk)):
+        after = 0
+        while True:
+            with s.begin():
+                records = getall(s, user, cipher.key_version, batch_size,
+                                 after)
+                rows = model.upgrade_many(records, cipher)
+                recrypted += recrypt(s, user, records, rows)
+                if records:
+                    after = records[-1].id
+            # Keep memory use constant
+            s.expunge_all()
+            printv(config, "Re-encrypted %d categories and items, at %s "
+                   "id %d" % (recrypted, name, after))
+            if len(records) < batch_size:
+                break
+            time.sleep(pause)
+    return recrypted
+
+
+@click.option('--pause', default=0.0, type=float,
+              help="Seconds to wait between batches")
+@click.option('--batch_size', default=500, type=int,
+              help="Number of records re-encrypted per transaction")
+@click.option('--phrase', default=None, required=True,
+              help="passphrase for decryption")
+@click.option('-p', default=None, required=True,
+              help="password")
+@click.option('-u', default=None, required=True,
+              help="username")
+@main.command(name='rotate-key')
+@pass_config
+def rotate_key(config, u, p, phrase, batch_size, pause):
+    try:
+        s = api.get_scoped_session(config.conf)
+        with s.begin():
+            user = api.user_get_by_username(s, u)
+            if not user:
+                sys.exit("Error: user does not exist!")
+            if not utils.checkpw(p, user.password):
+                sys.exit("Error: incorrect password!")
+            phrase_cipher = aescipher.check_phrase(user, phrase)
+            if phrase_cipher is None:
+                sys.exit("Error: incorrect passphrase supplied!")
+            # An interrupted rotation resumes with the same next key
+            if user.next_data_key is None:
+                printv(config, "Generating the next data key")
+                user.next_data_key = aescipher.new_data_key(phrase_cipher)
+                api.user_update(s, user)
+            else:
+                printv(config, "Resuming the rotation of the data key")
+        started = time.monotonic()
+        with s.begin():
+            user = api.user_get_by_username(s, u)
+            cipher = aescipher.get_data_cipher(user, phrase_cipher)
+            s.expunge(user)
+
+        # Both keys stay valid until the switch below, so the server keeps
+        # serving and writing meanwhile
+        recrypted = _recrypt_all(config, s, user, cipher, batch_size, pause)
+
+        # Servers pick up the next key once their cached user expires, and
+        # may write with the current one until then
+        ttl = config.conf.getint('identity_cache_ttl', 60)
+        wait = started + ttl - time.monotonic()
+        if wait > 0:
+            printv(config, "Waiting %.0f seconds for the servers to use the "
+                   "next data key" % wait)
+            time.sleep(wait)
+        recrypted += _recrypt_all(config, s, user, cipher, batch_size, pause)
+
+        with s.begin():
+            user = api.user_get_by_username(s, u)
+            pending = api.user_count_stale_key(s, user, cipher.key_version)
+            if pending:
+                sys.exit("Error: %d categories and items were updated with "
+                         "the previous data key meanwhile, run rotate-key "
+                         "again!" % pending)
+            user.data_key = user.next_data_key
+            user.next_data_key = None
+            user.key_version = cipher.key_version
             api.user_update(s, user)
-            printv(config, "Updating user's categories")
-            categories = api.category_getall(s, user)
-            for category in categories:
-                category.recrypt(old_cipher, new_cipher)
-            api.category_update(s, categories)
-            printv(config, "Updating user's items")
-            items = api.item_getall(s, user)
-            for item in items:
-                item.recrypt(old_cipher, new_cipher)
-            api.item_update(s, items)
-            print("All of user's data has been successfuly "
-                  "re-encrypted with the new passphrase.")
+        print("Re-encrypted %d of user's categories and items with a new "
+              "data key." % recrypted)
     except Exception as e:
         sys.exit("Error: %s" % str(e))
 